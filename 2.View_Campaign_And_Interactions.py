@@ -16,12 +16,16 @@
 
 # Imports
 
-import boto3
 import json
-import numpy as np
 import pandas as pd
 import time
-import uuid
+
+from aws_clients import NO_RETRIES, get_client
+from catalog_index import CatalogIndex
+from event_sender import EventSender
+from history_store import HistoryStore
+from recommendation_cache import RecommendationCache
+from session_store import SessionStore
 
 
 # Below you will paste in the campaign ARN that you used in your previous notebook. Also pick a random user ID from 50 - 300. 
@@ -33,8 +37,9 @@ import uuid
 
 # Setup and Config
 # Recommendations from Event data
-personalize = boto3.client('personalize')
-personalize_runtime = boto3.client('personalize-runtime')
+personalize = get_client('personalize')
+personalize_runtime = get_client('personalize-runtime')
+recommendations = RecommendationCache(personalize_runtime, ttl=5*60)
 
 
 HRNN_Campaign_ARN = "arn:aws:personalize:us-east-1:059124553121:campaign/personalize-demo-camp2"
@@ -46,7 +51,8 @@ USER_ID = "676"
 datasetGroupArn = "arn:aws:personalize:us-east-1:370791210052:dataset-group/personalize-launch-demo1"
 
 # Establish a connection to Personalize's Event Streaming
-personalize_events = boto3.client(service_name='personalize-events')
+# (EventSender below paces and retries its own calls)
+personalize_events = get_client('personalize-events', retries=NO_RETRIES)
 
 
 # ## Creating an Event Tracker
@@ -84,11 +90,11 @@ data
 
 
 # Item Config
-items = pd.read_csv('./ml-100k/u.item', sep='|', usecols=[0,1], encoding='latin-1')
-items.columns = ['ITEM_ID', 'TITLE']
+catalog = CatalogIndex.from_movielens('./ml-100k/u.item')
+items = catalog.items
 
 user_id, item_id, _ = data.sample().values[0]
-item_title = items.loc[items['ITEM_ID'] == item_id].values[0][-1]
+item_title = catalog.titles([item_id])[0]
 print("USER: {}".format(user_id))
 print("ITEM: {}".format(item_title))
 
@@ -103,18 +109,32 @@ items
 
 
 # Get Recommendations as is
-get_recommendations_response = personalize_runtime.get_recommendations(
+get_recommendations_response = recommendations.get_recommendations(
     campaignArn = HRNN_Campaign_ARN,
     userId = USER_ID,
 )
 
 item_list = get_recommendations_response['itemList']
-title_list = [items.loc[items['ITEM_ID'] == np.int(item['itemId'])].values[0][-1] for item in item_list]
+title_list = catalog.titles_for(item_list)
 
 print("Recommendations: {}".format(json.dumps(title_list, indent=2)))
 print(item_list)
 
 
+# #### Leaving Out Movies the User Has Already Rated
+# 
+# `HistoryStore` keeps every user's interactions in time order as memory-mapped arrays in `history_store/`, built from `u.data` the first time it runs. It removes the movies a user has already rated from a recommendation list in one vectorized lookup, and returns the user's latest movies as context for the session.
+
+# In[ ]:
+
+
+history = HistoryStore.from_movielens('./ml-100k/u.data', 'history_store')
+
+unseen = history.filter_item_list(USER_ID, item_list)
+print("Not rated yet: {}".format(json.dumps(catalog.titles_for(unseen), indent=2)))
+print("Latest movies: {}".format(catalog.titles(history.recent_items(USER_ID, 5))))
+
+
 # ## Simulating User Behavior
 # 
 # The lines below provide a code sample that simulates a user interacting with a particular item, you will then get recommendations that differ from those when you started.
@@ -122,7 +142,8 @@ print(item_list)
 # In[35]:
 
 
-session_dict = {}
+session_store = SessionStore(ttl=30*60)
+event_sender = EventSender(personalize_events, TRACKING_ID, on_sent=recommendations.on_events_sent)
 
 
 # In[36]:
@@ -133,30 +154,14 @@ def send_movie_click(USER_ID, ITEM_ID):
     Simulates a click as an envent
     to send an event to Amazon Personalize's Event Tracker
     """
-    # Configure Session
-    try:
-        session_ID = session_dict[USER_ID]
-    except:
-        session_dict[USER_ID] = str(uuid.uuid1())
-        session_ID = session_dict[USER_ID]
-        
-    # Configure Properties:
-    event = {
-    "itemId": str(ITEM_ID),
-    }
-    event_json = json.dumps(event)
-        
-    # Make Call
-    personalize_events.put_events(
-    trackingId = TRACKING_ID,
-    userId= USER_ID,
-    sessionId = session_ID,
-    eventList = [{
-        'sentAt': int(time.time()),
-        'eventType': 'EVENT_TYPE',
-        'properties': event_json
-        }]
-)
+    # Configure Session, a new one starts after 30 minutes of inactivity
+    session_ID = session_store.session_id(USER_ID)
+
+    # Queue the click, the sender batches it with other clicks in this session
+    event_sender.send(USER_ID, session_ID, ITEM_ID)
+
+    # Remember the click so it is left out of later recommendations
+    history.append([USER_ID], [ITEM_ID])
 
 
 # Immediately below this line will update the tracker as if the user has clicked a particular title.
@@ -166,6 +171,7 @@ def send_movie_click(USER_ID, ITEM_ID):
 
 # Pick a movie, we will use ID 207 or Gattica
 send_movie_click(USER_ID=USER_ID, ITEM_ID=207)
+event_sender.flush() # make sure the click is delivered before asking for new recommendations
 
 
 # After executing this block you will see the alterations in the recommendations now that you have event tracking enabled and that you have sent the events to the service.
@@ -173,13 +179,13 @@ send_movie_click(USER_ID=USER_ID, ITEM_ID=207)
 # In[38]:
 
 
-get_recommendations_response = personalize_runtime.get_recommendations(
+get_recommendations_response = recommendations.get_recommendations(
     campaignArn = HRNN_Campaign_ARN,
     userId = str(USER_ID),
 )
 
 item_list = get_recommendations_response['itemList']
-title_list = [items.loc[items['ITEM_ID'] == np.int(item['itemId'])].values[0][-1] for item in item_list]
+title_list = catalog.titles_for(item_list)
 
 print("Recommendations: {}".format(json.dumps(title_list, indent=2)))
 print(item_list)
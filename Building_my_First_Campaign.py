@@ -24,12 +24,18 @@
 
 
 # Imports
-import boto3
 import json
-import numpy as np
 import pandas as pd
 import time
 
+from aws_clients import get_client, get_factory
+from catalog_index import CatalogIndex
+from incremental_import import IncrementalImport
+from interaction_prep import prepare_interactions
+from item_cooccurrence import CooccurrenceRecommender, FallbackRecommendations
+from personalize_waiter import wait_for_resource
+from rec_benchmark import PersonalizeBackend, movielens_holdout, run_benchmark, write_report
+
 
 # Next you will want to validate that your environment can communicate successfully with Amazon Personalize, the lines below do just that.
 
@@ -37,8 +43,8 @@ import time
 
 
 # Configure the SDK to Personalize:
-personalize = boto3.client('personalize')
-personalize_runtime = boto3.client('personalize-runtime')
+personalize = get_client('personalize')
+personalize_runtime = get_client('personalize-runtime')
 
 
 # ## Configure the data
@@ -78,7 +84,7 @@ data
 # 
 # We are now going to remove the items with low rankings, and remove that column before we build our model.
 # 
-# Once done we will now save the file as a new CSV and then upload it to S3.
+# Once done we will write the result as a new CSV straight into S3, processing the file in chunks so it also works for logs that do not fit in memory.
 # 
 # All of that is done by simply executing the lines below.
 
@@ -87,8 +93,9 @@ data
 
 data = data[data['RATING'] > 3]                # Keep only movies rated higher than 3 out of 5.
 data = data[['USER_ID', 'ITEM_ID', 'TIMESTAMP']] # select columns that match the columns in the schema below
-data.to_csv(filename, index=False)
-boto3.Session().resource('s3').Bucket(bucket).Object(filename).upload_file(filename)
+
+# Apply the same filter in chunks and stream the CSV straight into S3, this scales to logs that do not fit in memory
+prepare_interactions('./ml-100k/u.data', 's3://{}/{}'.format(bucket, filename))
 
 
 # ### Create Schema
@@ -152,18 +159,7 @@ print(json.dumps(create_dataset_group_response, indent=2))
 # In[34]:
 
 
-max_time = time.time() + 3*60*60 # 3 hours
-while time.time() < max_time:
-    describe_dataset_group_response = personalize.describe_dataset_group(
-        datasetGroupArn = dataset_group_arn
-    )
-    status = describe_dataset_group_response["datasetGroup"]["status"]
-    print("DatasetGroup: {}".format(status))
-    
-    if status == "ACTIVE" or status == "CREATE FAILED":
-        break
-        
-    time.sleep(60)
+describe_dataset_group_response = wait_for_resource(personalize, "dataset_group", dataset_group_arn)
 
 
 # ### Create Dataset
@@ -192,7 +188,7 @@ print(json.dumps(create_dataset_response, indent=2))
 # In[36]:
 
 
-s3 = boto3.client("s3")
+s3 = get_client("s3")
 
 policy = {
     "Version": "2012-10-17",
@@ -226,7 +222,7 @@ s3.put_bucket_policy(Bucket=bucket, Policy=json.dumps(policy))
 # In[37]:
 
 
-iam = boto3.client("iam")
+iam = get_client("iam")
 
 role_name = "PersonalizeRoleDemo"
 assume_role_policy_document = {
@@ -296,18 +292,7 @@ print(json.dumps(create_dataset_import_job_response, indent=2))
 # In[42]:
 
 
-max_time = time.time() + 3*60*60 # 3 hours
-while time.time() < max_time:
-    describe_dataset_import_job_response = personalize.describe_dataset_import_job(
-        datasetImportJobArn = dataset_import_job_arn
-    )
-    status = describe_dataset_import_job_response["datasetImportJob"]['status']
-    print("DatasetImportJob: {}".format(status))
-    
-    if status == "ACTIVE" or status == "CREATE FAILED":
-        break
-        
-    time.sleep(60)
+describe_dataset_import_job_response = wait_for_resource(personalize, "dataset_import_job", dataset_import_job_arn)
 
 
 # ## Create the Solution and Version
@@ -372,18 +357,7 @@ print(json.dumps(create_solution_version_response, indent=2))
 # In[52]:
 
 
-max_time = time.time() + 3*60*60 # 3 hours
-while time.time() < max_time:
-    describe_solution_version_response = personalize.describe_solution_version(
-        solutionVersionArn = solution_version_arn
-    )
-    status = describe_solution_version_response["solutionVersion"]["status"]
-    print("SolutionVersion: {}".format(status))
-    
-    if status == "ACTIVE" or status == "CREATE FAILED":
-        break
-        
-    time.sleep(60)
+describe_solution_version_response = wait_for_resource(personalize, "solution_version", solution_version_arn)
 
 
 # #### Get Metrics of Solution Version
@@ -424,18 +398,7 @@ print(json.dumps(create_campaign_response, indent=2))
 # In[ ]:
 
 
-max_time = time.time() + 3*60*60 # 3 hours
-while time.time() < max_time:
-    describe_campaign_response = personalize.describe_campaign(
-        campaignArn = campaign_arn
-    )
-    status = describe_campaign_response["campaign"]["status"]
-    print("Campaign: {}".format(status))
-    
-    if status == "ACTIVE" or status == "CREATE FAILED":
-        break
-        
-    time.sleep(60)
+describe_campaign_response = wait_for_resource(personalize, "campaign", campaign_arn)
 
 
 # ## Get Sample Recommendations
@@ -447,11 +410,11 @@ while time.time() < max_time:
 # In[61]:
 
 
-items = pd.read_csv('./ml-100k/u.item', sep='|', usecols=[0,1], encoding='latin-1')
-items.columns = ['ITEM_ID', 'TITLE']
+catalog = CatalogIndex.from_movielens('./ml-100k/u.item')
+items = catalog.items
 
 user_id, item_id, _ = data.sample().values[0]
-item_title = items.loc[items['ITEM_ID'] == item_id].values[0][-1]
+item_title = catalog.titles([item_id])[0]
 print("USER: {}".format(user_id))
 print("ITEM: {}".format(item_title))
 
@@ -472,11 +435,66 @@ get_recommendations_response = personalize_runtime.get_recommendations(
 )
 
 item_list = get_recommendations_response['itemList']
-title_list = [items.loc[items['ITEM_ID'] == np.int(item['itemId'])].values[0][-1] for item in item_list]
+title_list = catalog.titles_for(item_list)
 
 print("Recommendations: {}".format(json.dumps(title_list, indent=2)))
 
 
+# #### Benchmark the Campaign
+# 
+# The lines below hold out each user's latest positive interaction, ask the campaign for recommendations for a sample of those users and write precision@K, NDCG, coverage and latency percentiles to a JSON report. The campaign was trained on these interactions too, so use the report to compare solution versions with `rec_benchmark.compare_reports` rather than as an absolute score. Keep the concurrency within the campaign's `minProvisionedTPS`.
+
+# In[ ]:
+
+
+train_data, holdout = movielens_holdout('./ml-100k/u.data', rating_threshold=3)
+benchmark_report = run_benchmark(PersonalizeBackend(personalize_runtime, campaign_arn), holdout, k=25,
+                                 concurrency=1, catalog_size=train_data['ITEM_ID'].nunique(), max_users=200)
+write_report(benchmark_report, 'campaign_benchmark.json')
+benchmark_report
+
+
+# #### Local Fallback Recommender
+# 
+# If the campaign is throttled or unreachable there is nothing to serve. `CooccurrenceRecommender` builds an item-to-item model from the same interactions in well under a second and answers `get_recommendations` locally, with the same arguments and response shape. `FallbackRecommendations` asks the campaign first and serves the local model only when that call fails. The cell below benchmarks the local model on the same held-out interactions as the campaign.
+
+# In[ ]:
+
+
+fallback_model = CooccurrenceRecommender(train_data['USER_ID'].values, train_data['ITEM_ID'].values)
+run_benchmark(fallback_model, holdout, k=25, catalog_size=train_data['ITEM_ID'].nunique(), max_users=200)
+
+recommendations_with_fallback = FallbackRecommendations(personalize_runtime, fallback_model)
+recommendations_with_fallback.get_recommendations(campaignArn=campaign_arn, userId=str(user_id))['itemList'][:5]
+
+
+# #### Incremental Refresh
+# 
+# When new interactions are appended to the log, there is no need to upload the whole file and retrain from scratch. `IncrementalImport` remembers the newest TIMESTAMP imported so far in `import_state.json`. It uploads only the newer rows as a small delta object and imports them with `importMode='INCREMENTAL'`. It then trains a new solution version and deploys it to the campaign. Recipes that support it (User-Personalization, HRNN-Coldstart) are retrained with `trainingMode='UPDATE'`; `aws-hrnn` used here is retrained in FULL mode. The first cell records that the import above already covered `u.data`.
+
+# In[ ]:
+
+
+sync = IncrementalImport(dataset_arn, role_arn, bucket, personalize=personalize, s3=s3)
+sync.mark_imported('./ml-100k/u.data')
+
+
+# In[ ]:
+
+
+# Run this after new interactions have been added to the log
+refresh = sync.sync('./ml-100k/u.data', solution_arn=solution_arn, campaign_arn=campaign_arn)
+refresh
+
+
+# The clients above all come from `aws_clients.get_client`, which records every API call. The summary below shows the calls, errors, throttles, retries and latency of each operation used in this notebook, busiest first.
+
+# In[ ]:
+
+
+get_factory().metrics.print_summary()
+
+
 # ## Review
 # 
 # Using the codes above you have successfully trained a deep learning model to generate movie recommendations based on prior user behavior. Think about other types of problems where this data is available and what it might look like to build a system like this to offer those recommendations.
@@ -0,0 +1,271 @@
+"""
+Shared, pooled and instrumented boto3 clients.
+
+The notebooks and helper modules each used to build their own clients with
+botocore's default 10-connection pool and legacy retry mode. get_client
+returns one cached client per (service, region, endpoint, config) from a
+single ClientFactory:
+
+- clients are created under a lock (creating clients from one session is
+  not thread-safe) and reused by every thread, since calls on a client are;
+- the cache is per process, so a forked worker builds its own clients;
+- the default config uses adaptive retries (after a throttle the client
+  also slows its own send rate), max_pool_connections sized for thread
+  pools, and explicit connect/read timeouts. Callers that pace and retry
+  themselves (TokenBucket in bulk_recommendations, EventSender) take a
+  client with retries=NO_RETRIES instead, or botocore's attempts would
+  multiply theirs and bypass the pacing.
+
+Every client reports to a ClientMetrics through botocore event hooks:
+per-operation call counts, latency histograms, errors, throttled attempts
+and retries. print_summary() shows which operations the wall-clock time
+went to:
+
+    from aws_clients import get_client, get_factory
+    personalize = get_client('personalize')
+    ...
+    get_factory().metrics.print_summary()
+"""
+import bisect
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import boto3
+from botocore.config import Config
+from botocore.exceptions import ConnectTimeoutError, EndpointConnectionError, ReadTimeoutError
+
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+DEFAULT_MAX_ATTEMPTS = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+# retries= override for clients whose callers have their own retry loop
+NO_RETRIES = {'mode': 'standard', 'total_max_attempts': 1}
+
+# Upper bounds of the latency histogram buckets: 0.1 ms to about 9 minutes,
+# each 20% wider than the last, so percentiles are within 20%.
+LATENCY_BUCKETS_MS = [0.1 * 1.2 ** i for i in range(86)]
+
+THROTTLING_ERRORS = ('Throttling', 'ThrottlingException', 'ThrottledException',
+                     'RequestThrottledException', 'TooManyRequestsException',
+                     'ProvisionedThroughputExceededException', 'RequestLimitExceeded',
+                     'SlowDown', 'LimitExceededException')
+
+# Errors that callers with their own retry loop (NO_RETRIES clients) retry
+# like throttles; any other BotoCoreError, e.g. ParamValidationError, would
+# only fail again.
+CONNECTION_ERRORS = (EndpointConnectionError, ConnectTimeoutError, ReadTimeoutError, IOError)
+
+
+def _error_code(parsed):
+    return (parsed or {}).get('Error', {}).get('Code')
+
+
+class _OperationStats(object):
+
+    def __init__(self):
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.calls = 0
+        self.errors = 0
+        self.throttles = 0
+        self.retries = 0
+        self.seconds = 0.0
+        self.max_seconds = 0.0
+
+    def percentile(self, q):
+        # Upper bound of the bucket holding the q-th percentile, in ms.
+        if not self.calls:
+            return None
+        rank = q / 100.0 * self.calls
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(LATENCY_BUCKETS_MS[i] if i < len(LATENCY_BUCKETS_MS) else float('inf'),
+                           self.max_seconds * 1000)
+        return self.max_seconds * 1000
+
+
+class ClientMetrics(object):
+    """
+    Per-operation counters fed by the event hooks that attach() registers
+    on a client. Keys are 'service.Operation'.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._operations = {}
+
+    def attach(self, client):
+        service = client.meta.service_model.service_name
+        events = client.meta.events
+        events.register('before-call', self._before_call)
+        events.register('after-call', self._after_call(service))
+        events.register('after-call-error', self._after_call_error(service))
+        events.register('needs-retry', self._needs_retry(service))
+        return client
+
+    def _stats(self, service, operation):
+        # call with the lock held
+        key = '{}.{}'.format(service, operation)
+        if key not in self._operations:
+            self._operations[key] = _OperationStats()
+        return self._operations[key]
+
+    @staticmethod
+    def _before_call(model=None, context=None, **kwargs):
+        if context is not None:
+            context['metrics_call'] = (model.name, time.time())
+
+    def _record(self, service, context, error=False, retries=0):
+        if not context or 'metrics_call' not in context:
+            return
+        operation, start = context['metrics_call']
+        seconds = time.time() - start
+        with self._lock:
+            stats = self._stats(service, operation)
+            stats.calls += 1
+            stats.errors += int(error)
+            stats.retries += retries
+            stats.seconds += seconds
+            stats.max_seconds = max(stats.max_seconds, seconds)
+            stats.buckets[bisect.bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+
+    def _after_call(self, service):
+        def handler(http_response=None, parsed=None, model=None, context=None, **kwargs):
+            retries = (parsed or {}).get('ResponseMetadata', {}).get('RetryAttempts', 0)
+            self._record(service, context,
+                         error=http_response is not None and http_response.status_code >= 300,
+                         retries=retries)
+        return handler
+
+    def _after_call_error(self, service):
+        # connection errors and timeouts that exhausted the retries
+        def handler(context=None, **kwargs):
+            self._record(service, context, error=True)
+        return handler
+
+    def _needs_retry(self, service):
+        # Called after every attempt; only counts throttled ones and
+        # returns None so the retry decision is left to botocore.
+        def handler(response=None, operation=None, **kwargs):
+            if response and _error_code(response[1]) in THROTTLING_ERRORS:
+                with self._lock:
+                    self._stats(service, operation.name).throttles += 1
+        return handler
+
+    def reset(self):
+        with self._lock:
+            self._operations = {}
+
+    def stats(self):
+        """
+        OrderedDict of 'service.Operation' -> counters and latency
+        percentiles in ms, busiest (by total time) first.
+        """
+        with self._lock:
+            items = sorted(self._operations.items(), key=lambda item: -item[1].seconds)
+            return OrderedDict((key, {
+                'calls': s.calls,
+                'errors': s.errors,
+                'throttles': s.throttles,
+                'retries': s.retries,
+                'seconds': s.seconds,
+                'mean_ms': s.seconds * 1000 / s.calls if s.calls else None,
+                'p50_ms': s.percentile(50),
+                'p95_ms': s.percentile(95),
+                'p99_ms': s.percentile(99),
+                'max_ms': s.max_seconds * 1000,
+            }) for key, s in items)
+
+    def print_summary(self, log=print):
+        log("{:<44}{:>8}{:>8}{:>10}{:>9}{:>10}{:>10}{:>10}".format(
+            'operation', 'calls', 'errors', 'throttles', 'retries', 'p50 ms', 'p99 ms', 'total s'))
+        for key, s in self.stats().items():
+            log("{:<44}{:>8}{:>8}{:>10}{:>9}{:>10.1f}{:>10.1f}{:>10.1f}".format(
+                key, s['calls'], s['errors'], s['throttles'], s['retries'],
+                s['p50_ms'] or 0.0, s['p99_ms'] or 0.0, s['seconds']))
+
+
+class ClientFactory(object):
+    """
+    Creates and caches instrumented clients from one boto3 session.
+    Keyword arguments to client() are botocore Config options that
+    override the factory defaults for that client.
+    """
+
+    def __init__(self, session=None, region_name=None, max_pool_connections=DEFAULT_MAX_POOL_CONNECTIONS,
+                 retry_mode='adaptive', max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                 metrics=None):
+        self._session = session
+        self.region_name = region_name
+        self.config = Config(max_pool_connections=max_pool_connections,
+                             retries={'mode': retry_mode, 'total_max_attempts': max_attempts},
+                             connect_timeout=connect_timeout, read_timeout=read_timeout)
+        self.metrics = metrics or ClientMetrics()
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._pid = None
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._session = boto3.session.Session(region_name=self.region_name)
+        return self._session
+
+    def client(self, service_name, endpoint_url=None, region_name=None, **config):
+        # overrides equal to the defaults share the default client
+        config = dict((name, value) for name, value in config.items() if getattr(self.config, name) != value)
+        key = (service_name, region_name or self.region_name, endpoint_url, repr(sorted(config.items())))
+        with self._lock:
+            if self._pid != os.getpid():
+                # Clients and their connection pools must not cross a fork.
+                self._clients = {}
+                self._pid = os.getpid()
+            if key not in self._clients:
+                client = self.session.client(
+                    service_name, endpoint_url=endpoint_url, region_name=region_name or self.region_name,
+                    config=self.config.merge(Config(**config)) if config else self.config)
+                self._clients[key] = self.metrics.attach(client)
+            return self._clients[key]
+
+    def clear(self):
+        with self._lock:
+            self._clients = {}
+
+
+_factory = None
+_factory_lock = threading.Lock()
+
+
+def get_factory():
+    """
+    The process-wide ClientFactory, created with the defaults on first use.
+    """
+    global _factory
+    with _factory_lock:
+        if _factory is None:
+            _factory = ClientFactory()
+        return _factory
+
+
+def configure(**kwargs):
+    """
+    Replaces the process-wide factory with ClientFactory(**kwargs), e.g. to
+    change the pool size or timeouts everywhere. Clients already handed out
+    keep their old settings.
+    """
+    global _factory
+    with _factory_lock:
+        _factory = ClientFactory(**kwargs)
+        return _factory
+
+
+def get_client(service_name, **kwargs):
+    """
+    Cached client from the process-wide factory; see ClientFactory.client.
+    """
+    return get_factory().client(service_name, **kwargs)
@@ -0,0 +1,159 @@
+"""
+Streaming BlazingText corpus builder.
+
+The notebook lowercases and hyphenates the title of every review with a
+row-wise apply, sorts all of reduced_df by (customer_id, review_date) and
+writes one line per customer from a groupby loop. write_corpus works on
+the review arrays instead:
+
+- titles are normalized once per product with vectorized string methods
+  and stored as one byte blob;
+- rows are sorted by (user, review day) with one argsort, and each chunk
+  of sentences is assembled as bytes by gathering token bytes with numpy,
+  with no Python work per customer;
+- output is streamed chunk by chunk, gzip-compressed when the path ends in
+  .gz, and can be split by user ranges across worker processes.
+"""
+import gzip
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from fm_split import group_bounds, sort_by_user
+
+DEFAULT_CHUNK_ROWS = 1000000
+
+_tokens = None
+
+
+def title_tokens(titles):
+    """
+    Titles as BlazingText words: lowercase with spaces replaced by '-'.
+    """
+    return pd.Series(titles, dtype=object).str.lower().str.replace(' ', '-', regex=False).values
+
+
+def encode_tokens(tokens):
+    """
+    (blob, offsets) with every token's UTF-8 bytes at blob[offsets[i]:offsets[i + 1]].
+    """
+    encoded = [token.encode('utf-8') for token in tokens]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(token) for token in encoded], out=offsets[1:])
+    return np.frombuffer(b''.join(encoded), dtype=np.uint8), offsets
+
+
+def sentence_bytes(items, sentence_end, blob, offsets):
+    """
+    Joins the tokens of items (codes into offsets) into text: a space after
+    each token, or a newline where sentence_end is set.
+    """
+    starts = offsets[items]
+    lengths = offsets[items + 1] - starts
+    ends = np.cumsum(lengths + 1)
+    before = np.cumsum(lengths) - lengths  # token bytes before each token
+    position = np.arange(lengths.sum())
+    out = np.empty(ends[-1] if len(ends) else 0, dtype=np.uint8)
+    out[np.repeat(ends - lengths - 1 - before, lengths) + position] = \
+        blob[np.repeat(starts - before, lengths) + position]
+    out[ends - 1] = np.where(sentence_end, ord('\n'), ord(' '))
+    return out.tobytes()
+
+
+def _open(path):
+    return gzip.open(path, 'wb', compresslevel=6) if path.endswith('.gz') else open(path, 'wb')
+
+
+def _init_worker(blob, offsets):
+    global _tokens
+    _tokens = (blob, offsets)
+
+
+def _write_part(path, items, sentence_end, chunk_rows):
+    blob, offsets = _tokens
+    with _open(path) as f:
+        for lo, hi in _chunk_bounds(sentence_end, chunk_rows):
+            f.write(sentence_bytes(items[lo:hi], sentence_end[lo:hi], blob, offsets))
+    return path, len(items), int(sentence_end.sum())
+
+
+def _chunk_bounds(sentence_end, chunk_rows):
+    # (lo, hi) row ranges of about chunk_rows rows that end on a sentence end
+    ends = np.flatnonzero(sentence_end) + 1
+    bounds = []
+    lo = 0
+    while lo < len(sentence_end):
+        i = np.searchsorted(ends, lo + chunk_rows, side='right') - 1
+        if i < 0 or ends[i] <= lo:
+            i = np.searchsorted(ends, lo, side='right')  # one sentence longer than chunk_rows
+        bounds.append((lo, int(ends[i])))
+        lo = int(ends[i])
+    return bounds
+
+
+def write_corpus(path, users, items, tokens, order=None, shards=1, processes=None,
+                 chunk_rows=DEFAULT_CHUNK_ROWS, merge=True, log=print):
+    """
+    Writes one line per user of the tokens of items, in order (e.g. review
+    days) within each user, to path.
+
+    items are codes into tokens. With shards > 1 the users are split into
+    contiguous ranges written to path-part-NNNNN files in parallel; with
+    merge they are then concatenated into path (concatenated gzip members
+    are a valid gzip file) and removed. Without users, path is written
+    empty. Returns the paths written.
+    """
+    start = time.time()
+    users = np.asarray(users)
+    if not len(users):
+        # nothing to shard; the corpus is one empty file
+        with _open(path):
+            pass
+        return [path]
+    perm = sort_by_user(users, order)
+    _, starts, ends = group_bounds(users[perm])
+    sorted_items = np.asarray(items)[perm]
+    sentence_end = np.zeros(len(perm), dtype=bool)
+    sentence_end[ends - 1] = True
+    blob, offsets = encode_tokens(tokens)
+
+    shards = max(1, min(shards, len(starts)))
+    cuts = np.append(starts[np.linspace(0, len(starts), shards + 1).astype(np.int64)[:-1]], len(perm))
+    if shards == 1:
+        _init_worker(blob, offsets)
+        results = [_write_part(path, sorted_items, sentence_end, chunk_rows)]
+    else:
+        root, ext = (path[:-3], '.gz') if path.endswith('.gz') else os.path.splitext(path)
+        parts = ['{}-part-{:05d}{}'.format(root, i, ext) for i in range(shards)]
+        with ProcessPoolExecutor(max_workers=processes or os.cpu_count() or 1,
+                                 initializer=_init_worker, initargs=(blob, offsets)) as pool:
+            results = list(pool.map(_write_part, parts,
+                                    [sorted_items[lo:hi] for lo, hi in zip(cuts[:-1], cuts[1:])],
+                                    [sentence_end[lo:hi] for lo, hi in zip(cuts[:-1], cuts[1:])],
+                                    [chunk_rows] * shards))
+        if merge:
+            with open(path, 'wb') as out:
+                for part in parts:
+                    with open(part, 'rb') as f:
+                        shutil.copyfileobj(f, out, 16 * 1024 * 1024)
+                    os.remove(part)
+            results = [(path, sum(r[1] for r in results), sum(r[2] for r in results))]
+
+    if log:
+        log("Wrote {} sentences ({} words) to {} file(s) in {:.1f}s".format(
+            sum(r[2] for r in results), sum(r[1] for r in results), len(results), time.time() - start))
+    return [r[0] for r in results]
+
+
+def write_review_corpus(review_index, path, **kwargs):
+    """
+    write_corpus for an fm_indexing.ReviewIndex: each customer's product
+    titles ordered by review date.
+    """
+    tokens = title_tokens(review_index.products['product_title'].values)
+    items = review_index['item'] - len(review_index.customers)
+    return write_corpus(path, review_index['user'], items, tokens, order=review_index['review_day'], **kwargs)
@@ -0,0 +1,258 @@
+"""
+Precompute recommendations for many users, e.g. every USER_ID in u.data.
+
+Requests run on a thread pool with a concurrency limit and a token-bucket
+rate limiter matched to the campaign's provisioned TPS. Throttled calls and
+connection errors are retried with backoff (on a client without botocore
+retries, so every attempt goes through the rate limiter) and results are
+streamed to JSON Lines (or Parquet part files when pyarrow is installed) as
+they arrive. Users already present in the output are skipped, so a crashed
+run picks up where it stopped:
+
+    python bulk_recommendations.py --campaign-arn <arn> --tps 1 --output recs.jsonl
+"""
+import argparse
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+import pandas as pd
+from botocore.exceptions import BotoCoreError, ClientError
+
+from aws_clients import CONNECTION_ERRORS, NO_RETRIES, THROTTLING_ERRORS, get_client
+from personalize_waiter import Backoff
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+
+class TokenBucket(object):
+    """
+    Allows rate calls per second on average with bursts of up to capacity.
+    """
+
+    def __init__(self, rate, capacity=None, clock=time.monotonic, sleep=time.sleep):
+        if rate <= 0:
+            raise ValueError("rate must be positive, got {}".format(rate))
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, rate))
+        self.clock = clock
+        self.sleep = sleep
+        self._tokens = self.capacity
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        while True:
+            with self._lock:
+                now = self.clock()
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    return
+                wait_for = (tokens - self._tokens) / self.rate
+            self.sleep(wait_for)
+
+
+class JsonLinesWriter(object):
+
+    def __init__(self, path):
+        self.path = path
+        self._file = None
+
+    def completed(self):
+        """
+        User IDs already written. A partial last line from a crash is cut off,
+        even if it happens to parse: a line only counts once its newline is
+        written.
+        """
+        users = set()
+        if not os.path.exists(self.path):
+            return users
+        good_bytes = 0
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    users.add(json.loads(line.decode('utf-8'))['userId'])
+                except (ValueError, KeyError):
+                    break
+                good_bytes += len(line)
+        if good_bytes < os.path.getsize(self.path):
+            with open(self.path, 'r+b') as f:
+                f.truncate(good_bytes)
+        return users
+
+    def write(self, record):
+        if self._file is None:
+            self._file = open(self.path, 'a')
+        self._file.write(json.dumps(record) + '\n')
+        self._file.flush()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+class ParquetWriter(object):
+    """
+    Writes a directory of part-NNNNN.parquet files, one per batch_size users.
+    """
+
+    def __init__(self, path, batch_size=1000):
+        if pa is None:
+            raise ImportError("Writing Parquet requires pyarrow")
+        self.path = path
+        self.batch_size = batch_size
+        self._rows = []
+        self._parts = 0
+
+    def completed(self):
+        users = set()
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+            return users
+        for name in sorted(os.listdir(self.path)):
+            if name.startswith('part-') and name.endswith('.parquet'):
+                users.update(pq.read_table(os.path.join(self.path, name), columns=['userId'])
+                             .column('userId').to_pylist())
+                self._parts += 1
+        return users
+
+    def write(self, record):
+        self._rows.append(record)
+        if len(self._rows) >= self.batch_size:
+            self._flush()
+
+    def _flush(self):
+        if not self._rows:
+            return
+        table = pa.table({
+            'userId': [r['userId'] for r in self._rows],
+            'itemIds': [[i['itemId'] for i in r['itemList']] for r in self._rows],
+            'scores': [[i.get('score') for i in r['itemList']] for r in self._rows],
+        })
+        # Write then rename so a crash never leaves a half-written part.
+        name = os.path.join(self.path, 'part-{:05d}.parquet'.format(self._parts))
+        pq.write_table(table, name + '.tmp')
+        os.replace(name + '.tmp', name)
+        self._parts += 1
+        self._rows = []
+
+    def close(self):
+        self._flush()
+
+
+def fetch_all_recommendations(client, campaign_arn, user_ids, output, num_results=25,
+                              tps=1.0, concurrency=4, max_retries=8, backoff=None,
+                              log=print, log_every=1000):
+    """
+    Fetches recommendations for every user in user_ids and streams them to
+    output (a .jsonl file, or a directory when it ends in .parquet).
+    Returns a dict with counts and elapsed time. client should not retry on
+    its own (see aws_clients.NO_RETRIES); this loop retries up to
+    max_retries times per user.
+    """
+    writer = ParquetWriter(output) if output.endswith('.parquet') else JsonLinesWriter(output)
+    done = writer.completed()
+    bucket = TokenBucket(tps)
+    backoff = backoff or Backoff(initial_delay=0.5, max_delay=20)
+    stats = {'skipped': 0, 'fetched': 0, 'failed': 0, 'retries': 0}
+    stats_lock = threading.Lock()
+
+    def fetch(user_id):
+        attempt = 0
+        while True:
+            bucket.acquire()
+            try:
+                response = client.get_recommendations(
+                    campaignArn=campaign_arn,
+                    userId=user_id,
+                    numResults=num_results
+                )
+                return {'userId': user_id,
+                        'itemList': [dict((k, item[k]) for k in ('itemId', 'score') if k in item)
+                                     for item in response['itemList']]}
+            except (ClientError, BotoCoreError) as e:
+                if isinstance(e, ClientError):
+                    retry = e.response.get('Error', {}).get('Code') in THROTTLING_ERRORS
+                else:
+                    retry = isinstance(e, CONNECTION_ERRORS)
+                if not retry or attempt >= max_retries:
+                    raise
+                with stats_lock:
+                    stats['retries'] += 1
+                time.sleep(backoff.delay(attempt))
+                attempt += 1
+
+    start = time.time()
+    running = {}
+    try:
+        with ThreadPoolExecutor(max_workers=concurrency) as pool:
+            def drain(return_when):
+                finished, _ = wait(running, return_when=return_when)
+                for future in finished:
+                    user_id = running.pop(future)
+                    try:
+                        writer.write(future.result())
+                        stats['fetched'] += 1
+                    except Exception as e:
+                        stats['failed'] += 1
+                        if log:
+                            log("User {} failed: {}".format(user_id, e))
+                    if log and log_every and stats['fetched'] % log_every == 0 and stats['fetched']:
+                        log("{} users fetched ({:.1f}/s)".format(
+                            stats['fetched'], stats['fetched'] / (time.time() - start)))
+
+            for user_id in user_ids:
+                user_id = str(user_id)
+                if user_id in done:
+                    stats['skipped'] += 1
+                    continue
+                done.add(user_id)
+                running[pool.submit(fetch, user_id)] = user_id
+                # Keep only a few requests queued so huge user lists stay lazy.
+                if len(running) >= 2 * concurrency:
+                    drain(FIRST_COMPLETED)
+            while running:
+                drain(FIRST_COMPLETED)
+    finally:
+        writer.close()
+
+    stats['elapsed'] = time.time() - start
+    return stats
+
+
+def movielens_user_ids(path='./ml-100k/u.data'):
+    """
+    Unique user IDs in the interactions file, in first-seen order.
+    """
+    data = pd.read_csv(path, sep='\t', names=['USER_ID', 'ITEM_ID', 'RATING', 'TIMESTAMP'],
+                       usecols=['USER_ID'])
+    return data['USER_ID'].unique()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Precompute recommendations for every user')
+    parser.add_argument('--campaign-arn', required=True)
+    parser.add_argument('--data', default='./ml-100k/u.data')
+    parser.add_argument('--output', default='recommendations.jsonl')
+    parser.add_argument('--num-results', type=int, default=25)
+    parser.add_argument('--tps', type=float, default=1.0, help="match the campaign's minProvisionedTPS")
+    parser.add_argument('--concurrency', type=int, default=4)
+    args = parser.parse_args()
+
+    runtime = get_client('personalize-runtime', retries=NO_RETRIES)
+    result = fetch_all_recommendations(runtime, args.campaign_arn,
+                                       movielens_user_ids(args.data), args.output,
+                                       num_results=args.num_results, tps=args.tps,
+                                       concurrency=args.concurrency)
+    print(json.dumps(result, indent=2))
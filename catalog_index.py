@@ -0,0 +1,126 @@
+"""
+Array-backed item catalog for turning recommended item IDs into titles.
+
+The notebooks resolve each recommended item with a boolean scan of the whole
+item table. CatalogIndex is built once and resolves a whole batch of IDs in a
+single vectorized call: dense integer IDs (MovieLens) go through a direct
+ID -> row array, anything else through a pandas hash index.
+"""
+import numpy as np
+import pandas as pd
+
+MOVIELENS_ITEM_COLUMNS = ['ITEM_ID', 'TITLE', 'RELEASE_DATE', 'VIDEO_RELEASE_DATE', 'IMDB_URL']
+
+# Only use a direct lookup array when it is at most this many times larger
+# than the catalog itself.
+MAX_DENSE_RATIO = 4
+
+
+def _integral_ids(item_ids):
+    # -1 (missing) for anything that is not a whole number
+    numeric = pd.to_numeric(pd.Series(item_ids.ravel()), errors='coerce').values.astype(np.float64)
+    valid = np.isfinite(numeric) & (numeric == np.floor(numeric))
+    return np.where(valid, numeric, -1).astype(np.int64).reshape(item_ids.shape)
+
+
+class CatalogIndex(object):
+    """
+    Resolves batches of item IDs to catalog rows.
+
+    Missing IDs are controlled by on_missing: 'fill' (default) returns the
+    missing value in their place, 'drop' leaves them out and 'raise' raises
+    KeyError listing them.
+    """
+
+    def __init__(self, items, id_column='ITEM_ID', title_column='TITLE'):
+        self.items = items.reset_index(drop=True)
+        self.id_column = id_column
+        self.title_column = title_column
+        self._titles = self.items[title_column].values
+
+        ids = self.items[id_column]
+        self._dense = None
+        self._hashed = None
+        if pd.api.types.is_integer_dtype(ids) and len(ids) and ids.min() >= 0 \
+                and ids.max() < MAX_DENSE_RATIO * len(ids) + 1024:
+            self._dense = np.full(ids.max() + 1, -1, dtype=np.int32)
+            self._dense[ids.values] = np.arange(len(ids), dtype=np.int32)
+        else:
+            self._hashed = pd.Index(ids.astype(str).values)
+
+    @classmethod
+    def from_movielens(cls, path='./ml-100k/u.item'):
+        items = pd.read_csv(path, sep='|', header=None, usecols=range(len(MOVIELENS_ITEM_COLUMNS)),
+                            names=MOVIELENS_ITEM_COLUMNS, encoding='latin-1')
+        return cls(items)
+
+    @classmethod
+    def from_csv(cls, path, id_column='ITEM_ID', title_column='TITLE', **read_csv_kwargs):
+        return cls(pd.read_csv(path, **read_csv_kwargs), id_column=id_column, title_column=title_column)
+
+    def __len__(self):
+        return len(self.items)
+
+    def positions(self, item_ids):
+        """
+        Returns the catalog row of every ID as an int array, -1 where missing.
+        Accepts ints or the string IDs returned by Personalize; IDs that are
+        not whole numbers, such as 3.7 or '3.7', are missing.
+        """
+        item_ids = np.asarray(item_ids)
+        if self._hashed is not None:
+            return self._hashed.get_indexer(item_ids.astype(str))
+
+        if item_ids.dtype.kind in 'US':
+            try:
+                item_ids = item_ids.astype(np.int64)
+            except ValueError:
+                item_ids = _integral_ids(item_ids)
+        elif not np.issubdtype(item_ids.dtype, np.integer):
+            # astype(np.int64) would truncate 3.7 to item 3
+            item_ids = _integral_ids(item_ids)
+        positions = np.full(item_ids.shape, -1, dtype=np.int32)
+        in_range = (item_ids >= 0) & (item_ids < len(self._dense))
+        positions[in_range] = self._dense[item_ids[in_range]]
+        return positions
+
+    def _resolve(self, item_ids, on_missing):
+        positions = self.positions(item_ids)
+        missing = positions < 0
+        if missing.any():
+            if on_missing == 'raise':
+                raise KeyError("Item IDs not in catalog: {}".format(
+                    np.asarray(item_ids)[missing].tolist()))
+            if on_missing == 'drop':
+                positions = positions[~missing]
+                missing = missing[~missing]
+            elif on_missing != 'fill':
+                raise ValueError("on_missing must be 'fill', 'drop' or 'raise'")
+        return positions, missing
+
+    def titles(self, item_ids, on_missing='fill', missing=None):
+        """
+        Returns a list of titles for item_ids in the same order.
+        """
+        positions, is_missing = self._resolve(item_ids, on_missing)
+        titles = self._titles[positions].astype(object)
+        titles[is_missing] = missing
+        return titles.tolist()
+
+    def rows(self, item_ids, on_missing='fill'):
+        """
+        Returns the catalog rows for item_ids as a DataFrame in the same
+        order. With on_missing='fill' missing IDs become rows of NaN.
+        """
+        positions, is_missing = self._resolve(item_ids, on_missing)
+        if not is_missing.any():
+            return self.items.take(positions).reset_index(drop=True)
+        rows = self.items.reindex(np.where(is_missing, -1, positions)).reset_index(drop=True)
+        rows[self.id_column] = np.asarray(item_ids)
+        return rows
+
+    def titles_for(self, item_list, **kwargs):
+        """
+        Titles for an itemList returned by get_recommendations.
+        """
+        return self.titles([item['itemId'] for item in item_list], **kwargs)
@@ -0,0 +1,377 @@
+"""
+Click-stream replay load test for the real-time event path.
+
+Replays u.data interactions in TIMESTAMP order, speedup times faster than
+they happened, through the same SessionStore and EventSender the second
+notebook uses, so every user in the log is an independent simulated user
+with their own sessions. A run reports
+
+- sustained events/sec against the rate the replay asked for, and how far
+  the replay fell behind its schedule (send() blocks when the sender's
+  queue is full, so lag means PutEvents cannot keep up);
+- PutEvents and GetRecommendations latency percentiles, throttles and
+  retries from a ClientMetrics on the clients;
+- freshness: for a sample of events, the time from sending the event until
+  the campaign's recommendations for that user change. A probe holds the
+  user's other events back until it is done, waits until the user's earlier
+  events are acknowledged and their recommendations have not changed for
+  settle_time seconds, then sends the event and polls every poll_interval
+  seconds. Freshness is accurate to about poll_interval and includes the
+  time the event waits in the sender's batch (max_latency).
+
+By default it runs against a local PersonalizeStub whose latency,
+throttling, capacity and update delay are set on the command line, to size
+the event tracker and the campaign's provisioned TPS before going live:
+
+    python clickstream_replay.py ./ml-100k/u.data --speedup 100000 --latency 0.02 --recommendation-tps 20
+
+Pass --tracking-id and --campaign-arn to replay against a real campaign.
+"""
+import argparse
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from aws_clients import ClientMetrics
+from event_sender import EventSender
+from interaction_prep import iter_interactions
+from session_store import SessionStore
+
+
+def load_clicks(path='./ml-100k/u.data', rating_threshold=3, **kwargs):
+    """
+    The interactions iter_interactions keeps from path, sorted by
+    TIMESTAMP (ties keep file order).
+    """
+    clicks = pd.concat(list(iter_interactions(path, rating_threshold=rating_threshold, **kwargs)),
+                       ignore_index=True)
+    return clicks.sort_values('TIMESTAMP', kind='mergesort').reset_index(drop=True)
+
+
+def _percentiles(values, scale=1.0):
+    if not values:
+        return dict.fromkeys(('p50', 'p95', 'p99', 'max'), None)
+    p50, p95, p99 = np.percentile(values, [50, 95, 99]) * scale
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99), 'max': float(max(values)) * scale}
+
+
+def _format(value, spec):
+    return 'n/a' if value is None else format(value, spec)
+
+
+class ClickstreamReplay(object):
+    """
+    Replays clicks (a load_clicks frame) through an EventSender on
+    events_client and probes freshness on runtime_client.
+
+    Every probe_every-th event is probed if fewer than max_probes probes
+    are running. settle_time should exceed the time the campaign takes to
+    use an event, or earlier events can still change the recommendations
+    during a probe. metrics is attached to both clients unless given, e.g.
+    pass get_factory().metrics for get_client clients, which already report
+    to it. sender_options go to EventSender.
+    """
+
+    def __init__(self, events_client, runtime_client, tracking_id, campaign_arn, speedup=100000.0,
+                 probe_every=100, max_probes=8, poll_interval=0.25, freshness_timeout=60.0,
+                 settle_time=5.0, num_results=25, session_ttl=30*60, metrics=None, log=print, **sender_options):
+        self.events_client = events_client
+        self.runtime_client = runtime_client
+        self.tracking_id = tracking_id
+        self.campaign_arn = campaign_arn
+        self.speedup = float(speedup)
+        self.probe_every = probe_every
+        self.max_probes = max_probes
+        self.poll_interval = poll_interval
+        self.freshness_timeout = freshness_timeout
+        self.settle_time = settle_time
+        self.num_results = num_results
+        self.session_ttl = session_ttl
+        if metrics is None:
+            metrics = ClientMetrics()
+            metrics.attach(events_client)
+            metrics.attach(runtime_client)
+        self.metrics = metrics
+        self.log = log
+        self.sender_options = sender_options
+
+        self._lock = threading.Lock()
+        # user -> events held back while that user is probed
+        self._probing = {}
+        # user -> events sent but not yet acknowledged
+        self._unacked = {}
+        self._slots = threading.Semaphore(max_probes)
+        self._freshness = []
+        self._probe_counters = dict.fromkeys(('probes', 'changed', 'timeouts', 'errors'), 0)
+        self._acked = {}
+
+    def _recommendations(self, user_id):
+        response = self.runtime_client.get_recommendations(campaignArn=self.campaign_arn, userId=user_id,
+                                                           numResults=self.num_results)
+        return [item['itemId'] for item in response['itemList']]
+
+    def _send(self, sender, user_id, session_id, item_id):
+        with self._lock:
+            self._unacked[user_id] = self._unacked.get(user_id, 0) + 1
+        sender.send(user_id, session_id, item_id)
+
+    def _hold(self, user_id, session_id, item_id):
+        # False unless user_id is being probed, in which case the event is
+        # sent when the probe ends
+        with self._lock:
+            held = self._probing.get(user_id)
+            if held is None:
+                return False
+            held.append((session_id, item_id))
+            return True
+
+    def _settled(self, user_id, deadline):
+        # The user's recommendations once their earlier events are
+        # acknowledged and the list has not changed for settle_time, or None
+        # (failed events are never acknowledged).
+        while True:
+            with self._lock:
+                if not self._unacked.get(user_id):
+                    break
+            if time.time() > deadline:
+                return None
+            time.sleep(self.poll_interval)
+        current, since = None, time.time()
+        while current is None or time.time() - since < self.settle_time:
+            if time.time() > deadline:
+                return None
+            try:
+                latest = self._recommendations(user_id)
+            except Exception:
+                latest = None
+            if latest is not None and latest != current:
+                current, since = latest, time.time()
+            time.sleep(self.poll_interval)
+        return current
+
+    def _probe(self, sender, user_id, session_id, item_id):
+        try:
+            before = self._settled(user_id, time.time() + self.freshness_timeout)
+            sent = time.time()
+            self._send(sender, user_id, session_id, item_id)
+            if before is None:
+                with self._lock:
+                    self._probe_counters['errors'] += 1
+                return
+            while time.time() - sent < self.freshness_timeout:
+                time.sleep(self.poll_interval)
+                try:
+                    after = self._recommendations(user_id)
+                except Exception:
+                    continue  # throttled polls are retried on the next interval
+                if after != before:
+                    with self._lock:
+                        self._probe_counters['changed'] += 1
+                        self._freshness.append(time.time() - sent)
+                    return
+            with self._lock:
+                self._probe_counters['timeouts'] += 1
+        finally:
+            # send the held events in order before the user is released
+            while True:
+                with self._lock:
+                    held = self._probing[user_id]
+                    if not held:
+                        del self._probing[user_id]
+                        break
+                    self._probing[user_id] = []
+                for held_session, held_item in held:
+                    self._send(sender, user_id, held_session, held_item)
+            self._slots.release()
+
+    def _start_probe(self, pool, sender, user_id, session_id, item_id):
+        # False if no probe slot is free or the user is already being probed
+        if not self._slots.acquire(False):
+            return False
+        with self._lock:
+            if user_id in self._probing:
+                self._slots.release()
+                return False
+            self._probing[user_id] = []
+            self._probe_counters['probes'] += 1
+        pool.submit(self._probe, sender, user_id, session_id, item_id)
+        return True
+
+    def _on_sent(self, user_id, session_id, events):
+        second = int(time.time())
+        with self._lock:
+            self._acked[second] = self._acked.get(second, 0) + len(events)
+            left = self._unacked.get(user_id, 0) - len(events)
+            if left > 0:
+                self._unacked[user_id] = left
+            else:
+                self._unacked.pop(user_id, None)
+
+    def run(self, clicks, max_events=None):
+        """
+        Replays clicks (the first max_events of them) and returns the
+        report dict.
+        """
+        if max_events:
+            clicks = clicks.iloc[:max_events]
+        users = clicks['USER_ID'].astype(str).tolist()
+        items = clicks['ITEM_ID'].astype(str).tolist()
+        timestamps = clicks['TIMESTAMP'].values
+        if not len(timestamps):
+            raise ValueError("No clicks to replay")
+        offsets = ((timestamps - timestamps[0]) / self.speedup).tolist()
+        span = offsets[-1]
+
+        started = time.time()
+        # sessions expire after session_ttl seconds of replayed time
+        sessions = SessionStore(ttl=self.session_ttl,
+                                clock=lambda: timestamps[0] + (time.time() - started) * self.speedup)
+        options = dict(self.sender_options)
+        options.setdefault('log', self.log)
+        sender = EventSender(self.events_client, self.tracking_id, on_sent=self._on_sent,
+                             **options)
+        lags = []
+        probe_pool = ThreadPoolExecutor(max_workers=self.max_probes)
+        if self.log:
+            self.log("Replaying {} events from {} users over {:.1f}s ({:.0f} events/s)".format(
+                len(users), len(set(users)), span, len(users) / span if span else float('inf')))
+        try:
+            for i, (user_id, item_id, offset) in enumerate(zip(users, items, offsets)):
+                delay = started + offset - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                lags.append(max(0.0, -delay))
+                session_id = sessions.session_id(user_id)
+                if self._hold(user_id, session_id, item_id):
+                    continue
+                if i % self.probe_every == 0 and self._start_probe(probe_pool, sender, user_id,
+                                                                   session_id, item_id):
+                    continue
+                self._send(sender, user_id, session_id, item_id)
+            replayed = time.time() - started
+        finally:
+            probe_pool.shutdown(wait=True)
+            sender.close()
+        elapsed = time.time() - started
+
+        report = self._report(sender.stats(), len(users), span, replayed, elapsed, lags)
+        if self.log:
+            self.print_report(report)
+        return report
+
+    def _report(self, sent, events, span, replayed, elapsed, lags):
+        metrics = self.metrics.stats()
+        put_events = metrics.get('personalize-events.PutEvents', {})
+        recommendations = metrics.get('personalize-runtime.GetRecommendations', {})
+        with self._lock:
+            probes = dict(self._probe_counters)
+            freshness = list(self._freshness)
+            peak = max(self._acked.values()) if self._acked else 0
+        return OrderedDict([
+            ('events', events),
+            ('events_sent', sent['events_sent']),
+            ('events_failed', sent['events_failed']),
+            ('speedup', self.speedup),
+            ('target_events_per_sec', events / span if span else None),
+            ('events_per_sec', sent['events_sent'] / elapsed if elapsed else None),
+            ('peak_events_per_sec', peak),
+            ('schedule_lag_seconds', _percentiles(lags)),
+            ('put_events', OrderedDict([
+                ('calls', put_events.get('calls', 0)),
+                ('calls_per_sec', put_events.get('calls', 0) / elapsed if elapsed else None),
+                ('throttles', put_events.get('throttles', 0)),
+                ('sender_retries', sent['retries']),
+                ('latency_ms', dict((name, put_events.get(name + '_ms')) for name in ('p50', 'p95', 'p99'))),
+            ])),
+            ('get_recommendations', OrderedDict([
+                ('calls', recommendations.get('calls', 0)),
+                ('calls_per_sec', recommendations.get('calls', 0) / elapsed if elapsed else None),
+                ('errors', recommendations.get('errors', 0)),
+                ('throttles', recommendations.get('throttles', 0)),
+                ('latency_ms', dict((name, recommendations.get(name + '_ms')) for name in ('p50', 'p95', 'p99'))),
+            ])),
+            ('freshness_seconds', dict(probes, **_percentiles(freshness))),
+            ('replay_seconds', replayed),
+            ('elapsed_seconds', elapsed),
+        ])
+
+    def print_report(self, report):
+        lag = report['schedule_lag_seconds']
+        put = report['put_events']
+        rec = report['get_recommendations']
+        fresh = report['freshness_seconds']
+        self.log("Events: {} sent, {} failed, {} events/s sustained (target {}, peak {}/s), "
+                 "schedule lag p95 {}s max {}s".format(
+                     report['events_sent'], report['events_failed'], _format(report['events_per_sec'], '.1f'),
+                     _format(report['target_events_per_sec'], '.1f'), report['peak_events_per_sec'],
+                     _format(lag['p95'], '.2f'), _format(lag['max'], '.2f')))
+        self.log("PutEvents: {} calls ({}/s), p50 {} ms, p95 {} ms, p99 {} ms, {} throttles, {} retries".format(
+            put['calls'], _format(put['calls_per_sec'], '.1f'), _format(put['latency_ms']['p50'], '.1f'),
+            _format(put['latency_ms']['p95'], '.1f'), _format(put['latency_ms']['p99'], '.1f'),
+            put['throttles'], put['sender_retries']))
+        self.log("GetRecommendations: {} calls ({}/s), p50 {} ms, p95 {} ms, p99 {} ms, {} throttles".format(
+            rec['calls'], _format(rec['calls_per_sec'], '.1f'), _format(rec['latency_ms']['p50'], '.1f'),
+            _format(rec['latency_ms']['p95'], '.1f'), _format(rec['latency_ms']['p99'], '.1f'),
+            rec['throttles']))
+        self.log("Freshness: {} probes, {} changed, {} timed out, {} failed; p50 {}s, p95 {}s, p99 {}s".format(
+            fresh['probes'], fresh['changed'], fresh['timeouts'], fresh['errors'], _format(fresh['p50'], '.2f'),
+            _format(fresh['p95'], '.2f'), _format(fresh['p99'], '.2f')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay u.data clicks through the event path and measure '
+                                                 'throughput, latency and recommendation freshness')
+    parser.add_argument('data', nargs='?', default='./ml-100k/u.data', help='u.data-style interactions')
+    parser.add_argument('--speedup', type=float, default=100000.0, help='replay this many times faster than real time')
+    parser.add_argument('--max-events', type=int)
+    parser.add_argument('--rating-threshold', type=int, default=3)
+    parser.add_argument('--probe-every', type=int, default=100, help='probe freshness on every Nth event')
+    parser.add_argument('--max-probes', type=int, default=8)
+    parser.add_argument('--poll-interval', type=float, default=0.25)
+    parser.add_argument('--settle-time', type=float, default=5.0,
+                        help='seconds a probed user\'s recommendations must stay unchanged before the probe')
+    parser.add_argument('--senders', type=int, default=8)
+    parser.add_argument('--report', help='write the report as JSON to this path')
+    parser.add_argument('--tracking-id', help='replay against this event tracker instead of the stub')
+    parser.add_argument('--campaign-arn', help='campaign to probe freshness on (with --tracking-id)')
+    stub_options = parser.add_argument_group('stub')
+    stub_options.add_argument('--latency', type=float, default=0.02, help='stub latency per call in seconds')
+    stub_options.add_argument('--throttle-rate', type=float, default=0.0)
+    stub_options.add_argument('--event-tps', type=int, help='PutEvents calls the stub accepts per second')
+    stub_options.add_argument('--recommendation-tps', type=int,
+                              help='GetRecommendations calls the stub accepts per second')
+    stub_options.add_argument('--update-delay', type=float, default=1.0,
+                              help='seconds before the stub uses an event in recommendations')
+    args = parser.parse_args()
+
+    clicks = load_clicks(args.data, rating_threshold=args.rating_threshold)
+    options = dict(speedup=args.speedup, probe_every=args.probe_every, max_probes=args.max_probes,
+                   poll_interval=args.poll_interval, settle_time=args.settle_time, senders=args.senders)
+    if args.tracking_id:
+        if not args.campaign_arn:
+            parser.error('--campaign-arn is required with --tracking-id')
+        from aws_clients import NO_RETRIES, get_client, get_factory
+        replay = ClickstreamReplay(get_client('personalize-events', retries=NO_RETRIES),
+                                   get_client('personalize-runtime'),
+                                   args.tracking_id, args.campaign_arn, metrics=get_factory().metrics, **options)
+        report = replay.run(clicks, max_events=args.max_events)
+    else:
+        from personalize_stub import PersonalizeStub
+        with PersonalizeStub(latency=args.latency, throttle_rate=args.throttle_rate,
+                             update_delay=args.update_delay, event_tps=args.event_tps,
+                             recommendation_tps=args.recommendation_tps,
+                             catalog=clicks['ITEM_ID'].unique()) as stub:
+            replay = ClickstreamReplay(stub.client(max_pool_connections=args.senders),
+                                       stub.client('personalize-runtime', max_pool_connections=args.max_probes),
+                                       'stub', 'arn:aws:personalize:us-east-1:000000000000:campaign/stub',
+                                       **options)
+            report = replay.run(clicks, max_events=args.max_events)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+        print("Report written to {}".format(args.report))
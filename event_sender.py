@@ -0,0 +1,313 @@
+"""
+Buffered, batched sender for Amazon Personalize events.
+
+send_movie_click in the second notebook makes one synchronous put_events call
+per click. EventSender buffers events per (user, session), flushes them in
+batches of up to MAX_BATCH_SIZE from a background worker, and retries
+throttled batches with backoff. Only one batch per (user, session) is in
+flight at a time, so a session's events arrive in the order they were sent. The producer queue is bounded, so a slow
+endpoint pushes back on callers instead of growing memory.
+
+Run this module to benchmark it against the one-call-per-click approach on a
+local stub endpoint:
+
+    python event_sender.py --events 2000 --latency 0.02
+"""
+import argparse
+import json
+import queue
+import threading
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from aws_clients import CONNECTION_ERRORS, THROTTLING_ERRORS
+from personalize_waiter import Backoff
+
+# PutEvents accepts at most 10 events per call.
+MAX_BATCH_SIZE = 10
+
+_STOP = object()
+
+
+class _FlushRequest(object):
+
+    def __init__(self):
+        self.ready = threading.Event()
+        self.futures = []
+
+
+def item_properties(item_id):
+    """
+    JSON properties string for a click on item_id.
+    """
+    return json.dumps({"itemId": str(item_id)})
+
+
+class EventSender(object):
+    """
+    Batches events per (user, session) and sends them on a background worker.
+
+    A batch is sent when it reaches batch_size events, when its oldest event
+    has waited max_latency seconds, or on flush()/close(); close() sends
+    everything queued before it returns. send() blocks while
+    max_queue_size events are waiting (pass block=False to get queue.Full
+    instead). Throttled batches and connection errors are retried up to
+    max_retries times, so client should not retry on its own (see
+    aws_clients.NO_RETRIES); batches that still fail, or hit any other
+    error, are counted in events_failed and reported to log.
+    """
+
+    def __init__(self, client, tracking_id, batch_size=MAX_BATCH_SIZE, max_latency=1.0,
+                 max_queue_size=10000, senders=4, max_retries=5, backoff=None,
+                 event_type='EVENT_TYPE', on_sent=None, log=print):
+        if not 1 <= batch_size <= MAX_BATCH_SIZE:
+            raise ValueError("batch_size must be between 1 and {}".format(MAX_BATCH_SIZE))
+        self.client = client
+        self.tracking_id = tracking_id
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.max_retries = max_retries
+        self.backoff = backoff or Backoff(initial_delay=0.1, max_delay=5)
+        self.event_type = event_type
+        self.on_sent = on_sent
+        self.log = log
+
+        self._queue = queue.Queue(max_queue_size)
+        self._pool = ThreadPoolExecutor(max_workers=senders)
+        self._lock = threading.Lock()
+        self._started = time.time()
+        self._latencies = deque(maxlen=10000)
+        self._counters = dict.fromkeys(
+            ('events_queued', 'events_sent', 'events_failed', 'batches_sent', 'retries'), 0)
+        self._closed = False
+        # held while queueing, so nothing lands on the queue after _STOP
+        self._close_lock = threading.Lock()
+        # (user, session) -> batches waiting for the one in flight
+        self._sessions = {}
+        self._sessions_lock = threading.Lock()
+        self._worker = threading.Thread(target=self._run, name='EventSender', daemon=True)
+        self._worker.start()
+
+    def send(self, user_id, session_id, item_id=None, properties=None, event_type=None,
+             sent_at=None, block=True, timeout=None):
+        """
+        Queues one event. properties defaults to {"itemId": item_id}.
+        """
+        if properties is None:
+            properties = item_properties(item_id)
+        elif not isinstance(properties, str):
+            properties = json.dumps(properties)
+        event = {
+            'sentAt': sent_at if sent_at is not None else time.time(),
+            'eventType': event_type or self.event_type,
+            'properties': properties,
+        }
+        with self._close_lock:
+            if self._closed:
+                raise RuntimeError("EventSender is closed")
+            self._queue.put((str(user_id), session_id, event, time.time()), block, timeout)
+        with self._lock:
+            self._counters['events_queued'] += 1
+
+    def flush(self, timeout=None):
+        """
+        Sends everything buffered so far and waits for it to be acknowledged.
+        Returns at once after close(), which has already flushed.
+        """
+        request = _FlushRequest()
+        with self._close_lock:
+            if self._closed:
+                return
+            self._queue.put(request)
+        request.ready.wait(timeout)
+        wait(request.futures, timeout)
+
+    def close(self, timeout=None):
+        with self._close_lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._queue.put(_STOP)
+        # the worker sends what is left and waits for it before exiting
+        self._worker.join(timeout)
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _run(self):
+        # (user, session) -> [first event queued at, events]
+        buffers = OrderedDict()
+        in_flight = set()
+        while True:
+            timeout = None
+            if buffers:
+                oldest = next(iter(buffers.values()))[0]
+                timeout = max(0, oldest + self.max_latency - time.time())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+
+            if item is _STOP:
+                for key in list(buffers):
+                    in_flight.add(self._submit(key, buffers.pop(key)))
+                wait(in_flight)
+                break
+            if isinstance(item, _FlushRequest):
+                for key in list(buffers):
+                    in_flight.add(self._submit(key, buffers.pop(key)))
+                in_flight = set(f for f in in_flight if not f.done())
+                item.futures = list(in_flight)
+                item.ready.set()
+                continue
+            if item is not None:
+                user_id, session_id, event, queued_at = item
+                key = (user_id, session_id)
+                buffer = buffers.get(key)
+                if buffer is None:
+                    buffer = buffers[key] = [queued_at, []]
+                buffer[1].append(event)
+                if len(buffer[1]) >= self.batch_size:
+                    in_flight.add(self._submit(key, buffers.pop(key)))
+
+            now = time.time()
+            for key in list(buffers):
+                if buffers[key][0] + self.max_latency > now:
+                    break
+                in_flight.add(self._submit(key, buffers.pop(key)))
+            if len(in_flight) > 1000:
+                in_flight = set(f for f in in_flight if not f.done())
+
+    def _submit(self, key, buffer):
+        # Returns a future for the batch. It only starts once the session's
+        # previous batch is done.
+        done = Future()
+        with self._sessions_lock:
+            waiting = self._sessions.get(key)
+            if waiting is not None:
+                waiting.append((buffer, done))
+                return done
+            self._sessions[key] = deque()
+        self._pool.submit(self._send_in_order, key, buffer, done)
+        return done
+
+    def _send_in_order(self, key, buffer, done):
+        try:
+            queued_at, events = buffer
+            self._send_batch(key[0], key[1], events, queued_at)
+        finally:
+            with self._sessions_lock:
+                waiting = self._sessions[key]
+                if waiting:
+                    following = waiting.popleft()
+                else:
+                    following = None
+                    del self._sessions[key]
+            if following:
+                self._pool.submit(self._send_in_order, key, *following)
+            done.set_result(None)
+
+    def _send_batch(self, user_id, session_id, events, queued_at):
+        attempt = 0
+        while True:
+            try:
+                self.client.put_events(
+                    trackingId=self.tracking_id,
+                    userId=user_id,
+                    sessionId=session_id,
+                    eventList=events
+                )
+                break
+            except (ClientError, BotoCoreError, IOError) as e:
+                # no error may kill the worker or go uncounted
+                if isinstance(e, ClientError):
+                    retry = e.response.get('Error', {}).get('Code') in THROTTLING_ERRORS
+                else:
+                    retry = isinstance(e, CONNECTION_ERRORS)
+                if not retry or attempt >= self.max_retries:
+                    self._failed(user_id, events, e)
+                    return
+                time.sleep(self.backoff.delay(attempt))
+                attempt += 1
+                with self._lock:
+                    self._counters['retries'] += 1
+
+        with self._lock:
+            self._counters['events_sent'] += len(events)
+            self._counters['batches_sent'] += 1
+            self._latencies.append(time.time() - queued_at)
+        if self.on_sent:
+            self.on_sent(user_id, session_id, events)
+
+    def _failed(self, user_id, events, error):
+        with self._lock:
+            self._counters['events_failed'] += len(events)
+        if self.log:
+            self.log("put_events failed for user {}: {}".format(user_id, error))
+
+    def stats(self):
+        """
+        Counters plus events/sec since start and flush latency percentiles
+        (seconds from an event being queued to its batch being acknowledged).
+        """
+        with self._lock:
+            stats = dict(self._counters)
+            latencies = sorted(self._latencies)
+        elapsed = time.time() - self._started
+        stats['events_per_sec'] = stats['events_sent'] / elapsed if elapsed else 0.0
+        stats['queue_size'] = self._queue.qsize()
+        for name, q in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99)):
+            stats['flush_latency_' + name] = latencies[int(q * (len(latencies) - 1))] if latencies else None
+        return stats
+
+
+def _benchmark(events, users, latency, senders):
+    from personalize_stub import PersonalizeStub
+
+    with PersonalizeStub(latency=latency) as stub:
+        client = stub.client(max_pool_connections=senders)
+        sessions = dict((user, str(uuid.uuid4())) for user in range(users))
+        clicks = [(i % users, i) for i in range(events)]
+
+        start = time.time()
+        for user, item in clicks:
+            client.put_events(
+                trackingId='stub',
+                userId=str(user),
+                sessionId=sessions[user],
+                eventList=[{
+                    'sentAt': int(time.time()),
+                    'eventType': 'EVENT_TYPE',
+                    'properties': json.dumps({"itemId": str(item)})
+                }]
+            )
+        single = time.time() - start
+
+        start = time.time()
+        with EventSender(client, 'stub', senders=senders, max_latency=0.05) as sender:
+            for user, item in clicks:
+                sender.send(user, sessions[user], item)
+        batched = time.time() - start
+        stats = sender.stats()
+
+    print("one call per click: {:8.0f} events/sec".format(events / single))
+    print("EventSender:        {:8.0f} events/sec ({} batches, p95 flush latency {:.3f}s)".format(
+        events / batched, stats['batches_sent'], stats['flush_latency_p95']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark EventSender against a local stub endpoint')
+    parser.add_argument('--events', type=int, default=2000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--latency', type=float, default=0.02, help='stub latency per call in seconds')
+    parser.add_argument('--senders', type=int, default=8)
+    args = parser.parse_args()
+    _benchmark(args.events, args.users, args.latency, args.senders)
@@ -0,0 +1,102 @@
+"""
+Local HTTP stand-in for a SageMaker Factorization Machines endpoint.
+
+Accepts InvokeEndpoint calls with JSON (the notebook's fm_serializer
+format) or recordIO-protobuf bodies and answers with one score per row, so
+fm_inference.py can be benchmarked without deploying a model.
+"""
+import json
+import struct
+import threading
+import time
+
+import boto3
+from botocore.config import Config
+
+from personalize_stub import ThreadingHTTPServer, _Handler as _JsonHandler
+
+
+def count_recordio_records(body):
+    """
+    Number of records in a recordIO buffer.
+    """
+    count = 0
+    position = 0
+    while position < len(body):
+        length = struct.unpack_from('<I', body, position + 4)[0]
+        position += 8 + length + (-length % 4)
+        count += 1
+    return count
+
+
+class _Handler(_JsonHandler):
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if stub.latency:
+            time.sleep(stub.latency)
+
+        if not self.path.endswith('/invocations'):
+            self._reply(404, {'message': self.path}, error_type='ValidationError')
+            return
+        if self.headers.get('Content-Type') == 'application/json':
+            rows = len(json.loads(body.decode('utf-8'))['instances'])
+        else:
+            rows = count_recordio_records(body)
+        with stub.lock:
+            stub.calls += 1
+            stub.rows += rows
+            stub.bytes += len(body)
+        self._reply(200, {'predictions': [{'score': stub.score}] * rows})
+
+
+class FMEndpointStub(object):
+    """
+    Threaded local server that scores every row with score after latency
+    seconds per request. calls, rows and bytes count what it received.
+    """
+
+    def __init__(self, latency=0.0, score=4.0, host='127.0.0.1', port=0):
+        self.latency = latency
+        self.score = score
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.rows = 0
+        self.bytes = 0
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def endpoint_url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def client(self, max_pool_connections=50):
+        """
+        Returns a sagemaker-runtime client that talks to this stub.
+        """
+        return boto3.client(
+            'sagemaker-runtime',
+            endpoint_url=self.endpoint_url,
+            region_name='us-east-1',
+            aws_access_key_id='stub',
+            aws_secret_access_key='stub',
+            config=Config(retries={'max_attempts': 0}, max_pool_connections=max_pool_connections))
@@ -0,0 +1,142 @@
+"""
+Feature encoding for SageMaker Factorization Machines.
+
+Every row of the FM training matrix has the same number of nonzeros (one for
+the user, one for the item, one per side feature), so the CSR indptr,
+indices and data arrays can be written directly into preallocated int32 and
+float32 arrays instead of building COO lists and float64 temporaries.
+FeatureEncoder can also emit the matrix in row chunks to feed
+fm_shards.write_chunks_to_s3 without holding the whole matrix.
+
+Feature layout: users | items | one-hot side features | numeric features.
+With the defaults this is the notebook's layout, with days_since_first in
+the last column.
+"""
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+
+def date_buckets(dates, edges):
+    """
+    Bucket codes for dates given sorted bucket edges: 0 before edges[0],
+    len(edges) on or after edges[-1]. Use len(edges) + 1 as the cardinality.
+    """
+    dates = pd.to_datetime(pd.Series(dates)).values.astype('datetime64[ns]')
+    edges = pd.to_datetime(pd.Series(edges)).values.astype('datetime64[ns]')
+    return np.searchsorted(edges, dates, side='right').astype(np.int32)
+
+
+class FeatureEncoder(object):
+    """
+    Encodes frames with user, item and side-feature columns into CSR rows.
+
+    user values must be in [0, num_users) and item values in
+    [num_users, num_users + num_items) (the notebook's item index is already
+    offset by the number of users). onehot maps column name -> cardinality
+    for categorical side features (e.g. date_buckets codes), whose codes
+    must be in [0, cardinality), and numeric is the list of numeric columns.
+    """
+
+    def __init__(self, num_users, num_items, onehot=None, numeric=('days_since_first',),
+                 user_column='user', item_column='item'):
+        self.num_users = num_users
+        self.num_items = num_items
+        self.onehot = list((onehot or {}).items())
+        self.numeric = list(numeric)
+        self.user_column = user_column
+        self.item_column = item_column
+
+        offset = num_users + num_items
+        self._onehot_offsets = []
+        for _, cardinality in self.onehot:
+            self._onehot_offsets.append(offset)
+            offset += cardinality
+        self._numeric_offset = offset
+        self.feature_dim = offset + len(self.numeric)
+        self.nonzeros_per_row = 2 + len(self.onehot) + len(self.numeric)
+        self._index_dtype = np.int32 if self.feature_dim < np.iinfo(np.int32).max else np.int64
+
+    def _columns(self, frame):
+        return ([frame[self.user_column].values, frame[self.item_column].values] +
+                [frame[name].values for name, _ in self.onehot] +
+                [frame[name].values for name in self.numeric])
+
+    def _encode(self, columns, lo, hi):
+        rows = hi - lo
+        k = self.nonzeros_per_row
+        nnz = rows * k
+        indptr_dtype = np.int32 if nnz < np.iinfo(np.int32).max else np.int64
+        indptr = np.arange(0, nnz + 1, k, dtype=indptr_dtype)
+        indices = np.empty((rows, k), dtype=self._index_dtype)
+        data = np.ones((rows, k), dtype=np.float32)
+
+        users, items = columns[0][lo:hi], columns[1][lo:hi]
+        # out-of-range values would break the sorted, canonical CSR below
+        if len(users) and (users.min() < 0 or users.max() >= self.num_users):
+            raise ValueError("{} values must be in [0, {}), got {} to {}".format(
+                self.user_column, self.num_users, users.min(), users.max()))
+        if len(items) and (items.min() < self.num_users or items.max() >= self.num_users + self.num_items):
+            raise ValueError("{} values must be in [{}, {}), got {} to {}".format(
+                self.item_column, self.num_users, self.num_users + self.num_items, items.min(), items.max()))
+        indices[:, 0] = users
+        indices[:, 1] = items
+        col = 2
+        for (name, cardinality), offset in zip(self.onehot, self._onehot_offsets):
+            codes = columns[col][lo:hi]
+            if len(codes) and (codes.min() < 0 or codes.max() >= cardinality):
+                raise ValueError("{} codes must be in [0, {}), got {} to {}".format(
+                    name, cardinality, codes.min(), codes.max()))
+            indices[:, col] = codes
+            indices[:, col] += offset
+            col += 1
+        for j in range(len(self.numeric)):
+            indices[:, col] = self._numeric_offset + j
+            data[:, col] = columns[col][lo:hi]
+            col += 1
+
+        # Columns ascend within each row, so the matrix is already canonical.
+        matrix = csr_matrix((data.ravel(), indices.ravel(), indptr),
+                            shape=(rows, self.feature_dim), copy=False)
+        matrix.has_sorted_indices = True
+        return matrix
+
+    def encode(self, frame):
+        """
+        Returns the whole frame as a float32 CSR matrix.
+        """
+        return self._encode(self._columns(frame), 0, len(frame))
+
+    def context(self, user, features=None):
+        """
+        (keys, values) for the non-item part of one row: the user plus the
+        side features given in features (column -> code or value; missing
+        one-hot columns are left out and missing numeric ones are 0).
+        """
+        features = features or {}
+        keys = [user]
+        values = [1.0]
+        for (name, cardinality), offset in zip(self.onehot, self._onehot_offsets):
+            if name in features:
+                if not 0 <= features[name] < cardinality:
+                    raise ValueError("{} code must be in [0, {}), got {}".format(
+                        name, cardinality, features[name]))
+                keys.append(offset + features[name])
+                values.append(1.0)
+        for j, name in enumerate(self.numeric):
+            keys.append(self._numeric_offset + j)
+            values.append(float(features.get(name, 0.0)))
+        return np.array(keys, dtype=np.int64), np.array(values, dtype=np.float32)
+
+    def iter_chunks(self, frame, labels, chunks):
+        """
+        Yields (csr, labels) for chunks contiguous row ranges of frame. Each
+        chunk is encoded when the next one is requested, so the whole matrix
+        is never built unless the caller keeps every chunk.
+        """
+        columns = self._columns(frame)
+        labels = np.asarray(labels, dtype=np.float32)
+        bounds = np.linspace(0, len(frame), chunks + 1).astype(np.int64)
+        for lo, hi in zip(bounds[:-1], bounds[1:]):
+            yield self._encode(columns, lo, hi), labels[lo:hi]
+
@@ -0,0 +1,180 @@
+"""
+Out-of-core frequency filtering and dense ID indexing for the Amazon reviews TSV.
+
+The FM notebook reads the whole review file into pandas, filters customers
+and products by review count and attaches dense indices and
+days_since_first through repeated merges, each of which copies the frame.
+build_review_index streams the file twice instead:
+
+1. count_reviews counts reviews per customer_id and product_id chunk by chunk.
+2. Rows of customers and products above the thresholds are mapped to codes
+   through a hash index and kept as compact int32/int8 arrays.
+
+Dense user/item indices (ordered by review count, items offset by the number
+of users, as in the notebook) and days_since_first are then computed with
+vectorized array operations. ReviewIndex.save writes the arrays as .npy
+files and the ID maps as CSV so inference can reuse them.
+"""
+import os
+
+import numpy as np
+import pandas as pd
+
+REVIEW_COLUMNS = ['customer_id', 'product_id', 'product_title', 'star_rating', 'review_date']
+ARRAYS = ('user', 'item', 'star_rating', 'review_day', 'days_since_first')
+
+# review_day value for rows without a parseable review_date
+MISSING_DAY = np.iinfo(np.int32).min
+
+
+def _read_chunks(path, chunksize, usecols):
+    kwargs = dict(delimiter='\t', usecols=usecols, chunksize=chunksize, dtype={'customer_id': str})
+    try:
+        return pd.read_csv(path, on_bad_lines='skip', **kwargs)
+    except TypeError:  # pandas < 1.3
+        return pd.read_csv(path, error_bad_lines=False, **kwargs)
+
+
+def count_reviews(path, chunksize=1000000):
+    """
+    Pass one: review counts per customer_id and product_id, sorted
+    descending like value_counts.
+    """
+    customers = pd.Series(dtype=np.int64)
+    products = pd.Series(dtype=np.int64)
+    for chunk in _read_chunks(path, chunksize, ['customer_id', 'product_id']):
+        customers = customers.add(chunk['customer_id'].value_counts(), fill_value=0)
+        products = products.add(chunk['product_id'].value_counts(), fill_value=0)
+    return (customers.astype(np.int64).sort_values(ascending=False),
+            products.astype(np.int64).sort_values(ascending=False))
+
+
+class ReviewIndex(object):
+    """
+    Filtered reviews as parallel arrays plus the customer and product maps.
+
+    customers has columns customer_id, user; products has product_id, item,
+    product_title. user/item in the arrays index into those maps.
+    """
+
+    def __init__(self, arrays, customers, products):
+        self.arrays = arrays
+        self.customers = customers
+        self.products = products
+
+    def __len__(self):
+        return len(self.arrays['user'])
+
+    def __getitem__(self, name):
+        return self.arrays[name]
+
+    def to_frame(self, with_ids=True):
+        """
+        DataFrame with the notebook's reduced_df columns. Without with_ids
+        only the numeric columns are included.
+        """
+        days = self.arrays['review_day']
+        review_date = pd.to_datetime(np.where(days == MISSING_DAY, np.nan, days), unit='D')
+        frame = pd.DataFrame({
+            'star_rating': self.arrays['star_rating'],
+            'review_date': review_date,
+            'user': self.arrays['user'],
+            'item': self.arrays['item'],
+            'days_since_first': self.arrays['days_since_first'],
+        })
+        if with_ids:
+            users = self.arrays['user']
+            items = self.arrays['item'] - len(self.customers)
+            frame.insert(0, 'customer_id', self.customers['customer_id'].values[users])
+            frame.insert(1, 'product_id', self.products['product_id'].values[items])
+            frame.insert(2, 'product_title', self.products['product_title'].values[items])
+        return frame
+
+    def save(self, directory):
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        for name in ARRAYS:
+            np.save(os.path.join(directory, name + '.npy'), self.arrays[name])
+        self.customers.to_csv(os.path.join(directory, 'customers.csv'), index=False)
+        self.products.to_csv(os.path.join(directory, 'products.csv'), index=False)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        arrays = dict((name, np.load(os.path.join(directory, name + '.npy'), mmap_mode=mmap_mode))
+                      for name in ARRAYS)
+        customers = pd.read_csv(os.path.join(directory, 'customers.csv'), dtype={'customer_id': str})
+        products = pd.read_csv(os.path.join(directory, 'products.csv'), keep_default_na=False)
+        return cls(arrays, customers, products)
+
+
+def build_review_index(path, min_customer_reviews=5, min_product_reviews=10, counts=None,
+                       chunksize=1000000):
+    """
+    Streams path twice (once if counts from count_reviews is passed) and
+    returns a ReviewIndex of customers with at least min_customer_reviews
+    reviews and products with at least min_product_reviews.
+    """
+    customer_counts, product_counts = counts if counts is not None else count_reviews(path, chunksize)
+    kept_customers = pd.Index(customer_counts.index[customer_counts.values >= min_customer_reviews])
+    kept_products = pd.Index(product_counts.index[product_counts.values >= min_product_reviews])
+    titles = np.empty(len(kept_products), dtype=object)
+    has_title = np.zeros(len(kept_products), dtype=bool)
+
+    parts = dict((name, []) for name in ('customer', 'product', 'star_rating', 'review_day'))
+    for chunk in _read_chunks(path, chunksize, REVIEW_COLUMNS):
+        customer = kept_customers.get_indexer(chunk['customer_id'])
+        product = kept_products.get_indexer(chunk['product_id'])
+        rating = pd.to_numeric(chunk['star_rating'], errors='coerce').values
+        keep = (customer >= 0) & (product >= 0) & ~np.isnan(rating)
+
+        dates = pd.to_datetime(chunk['review_date'].values[keep], errors='coerce')
+        day = np.asarray(dates.values.astype('datetime64[D]').astype(np.int64))
+        day[np.asarray(dates.isna())] = MISSING_DAY
+
+        product = product[keep]
+        new = ~has_title[product]
+        if new.any():
+            codes, first = np.unique(product[new], return_index=True)
+            titles[codes] = chunk['product_title'].values[keep][new][first]
+            has_title[codes] = True
+
+        parts['customer'].append(customer[keep].astype(np.int32))
+        parts['product'].append(product.astype(np.int32))
+        parts['star_rating'].append(rating[keep].astype(np.int8))
+        parts['review_day'].append(day.astype(np.int32))
+
+    customer = np.concatenate(parts['customer'])
+    product = np.concatenate(parts['product'])
+    review_day = np.concatenate(parts['review_day'])
+
+    # Dense indices over the customers/products left after filtering,
+    # ordered by their remaining review count like reduced_df.value_counts().
+    customer_hits = np.bincount(customer, minlength=len(kept_customers))
+    product_hits = np.bincount(product, minlength=len(kept_products))
+    customer_order = np.argsort(-customer_hits, kind='stable')[:np.count_nonzero(customer_hits)]
+    product_order = np.argsort(-product_hits, kind='stable')[:np.count_nonzero(product_hits)]
+    user_of = np.full(len(kept_customers), -1, dtype=np.int32)
+    user_of[customer_order] = np.arange(len(customer_order), dtype=np.int32)
+    item_of = np.full(len(kept_products), -1, dtype=np.int32)
+    item_of[product_order] = np.arange(len(product_order), dtype=np.int32) + len(customer_order)
+    user = user_of[customer]
+    item = item_of[product]
+
+    valid = review_day != MISSING_DAY
+    first_day = np.full(len(customer_order), np.iinfo(np.int32).max, dtype=np.int32)
+    np.minimum.at(first_day, user[valid], review_day[valid])
+    days_since_first = np.where(valid, review_day - first_day[user], 0).astype(np.float32)
+
+    arrays = {
+        'user': user,
+        'item': item,
+        'star_rating': np.concatenate(parts['star_rating']),
+        'review_day': review_day,
+        'days_since_first': days_since_first,
+    }
+    customers = pd.DataFrame({'customer_id': kept_customers.values[customer_order],
+                              'user': np.arange(len(customer_order), dtype=np.int32)})
+    products = pd.DataFrame({'product_id': kept_products.values[product_order],
+                             'item': item_of[product_order],
+                             'product_title': titles[product_order]})
+    return ReviewIndex(arrays, customers, products)
@@ -0,0 +1,261 @@
+"""
+Local scoring with a trained Factorization Machines model.
+
+Ranking every item for a user through fm_predictor.predict costs a request
+per batch of candidates. FMScorer keeps the model's bias w0, linear weights
+w and factor matrix V in memory instead. With the user's context fixed, the
+FM score of each item j
+
+    w0 + sum(w[c]) + w[j] + <V[j], sum(x_c V[c])> + (context-only terms)
+
+is one matrix-vector product over the item factors, and argpartition picks
+the top K. Item factors can be stored as float16 or int8 with a per-item
+scale to cut memory; they are upcast a block at a time while scoring.
+
+Model artifacts are read with MXNet when it is installed. Run this module
+for a check against the full FM formula with synthetic weights:
+
+    python fm_scoring.py --items 200000
+"""
+import argparse
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+import zipfile
+
+import numpy as np
+
+BLOCK_ROWS = 8192
+
+
+def fm_scores(csr, bias, linear, factors):
+    """
+    Full FM regression scores for every row of a sparse matrix.
+    """
+    csr = csr.tocsr().astype(np.float32)
+    xv = csr.dot(factors)
+    x2v2 = csr.multiply(csr).dot(factors * factors)
+    pairwise = 0.5 * (xv * xv - x2v2).sum(axis=1)
+    return (bias + csr.dot(linear.ravel()) + pairwise).astype(np.float32)
+
+
+class FactorStore(object):
+    """
+    Item factor rows kept as float32, float16 or int8 (symmetric, one
+    scale per row). dot(q) returns factors @ q in float32, upcasting
+    BLOCK_ROWS rows at a time.
+    """
+
+    DTYPES = ('float32', 'float16', 'int8')
+
+    def __init__(self, factors, dtype='float32'):
+        if dtype not in self.DTYPES:
+            raise ValueError("dtype must be one of {}".format(self.DTYPES))
+        factors = np.asarray(factors, dtype=np.float32)
+        self.dtype = dtype
+        self.scale = None
+        if dtype == 'int8':
+            self.scale = np.abs(factors).max(axis=1) / 127.0
+            self.scale[self.scale == 0] = 1.0
+            self.values = np.round(factors / self.scale[:, None]).astype(np.int8)
+        else:
+            self.values = np.ascontiguousarray(factors, dtype=dtype)
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def nbytes(self):
+        return self.values.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    def dot(self, q, rows=None):
+        """
+        factors[rows] @ q for q of shape (num_factors,) or
+        (num_factors, n).
+        """
+        q = np.asarray(q, dtype=np.float32)
+        values = self.values if rows is None else self.values[rows]
+        scale = self.scale if rows is None or self.scale is None else self.scale[rows]
+        if self.dtype == 'float32':
+            return values.dot(q)
+        out = np.empty((len(values),) + q.shape[1:], dtype=np.float32)
+        for lo in range(0, len(values), BLOCK_ROWS):
+            block = values[lo:lo + BLOCK_ROWS].astype(np.float32).dot(q)
+            if scale is not None:
+                block *= scale[lo:lo + BLOCK_ROWS].reshape((-1,) + (1,) * (q.ndim - 1))
+            out[lo:lo + BLOCK_ROWS] = block
+        return out
+
+
+def top_k(scores, k, exclude=None):
+    """
+    Indices of the k highest scores, best first. exclude lists indices
+    that must not be returned (e.g. items the user already rated), so
+    fewer than k come back when fewer than k items are left.
+    """
+    k = min(k, len(scores))
+    if exclude is not None and len(exclude):
+        scores = scores.copy()
+        scores[np.asarray(exclude)] = -np.inf
+        # never pad the result with excluded items
+        k = min(k, int(np.isfinite(scores).sum()))
+    if k <= 0:
+        return np.zeros(0, dtype=np.int64)
+    best = np.argpartition(-scores, k - 1)[:k]
+    return best[np.argsort(-scores[best], kind='stable')]
+
+
+class FMScorer(object):
+    """
+    Scores users against all items with a trained FM model.
+
+    encoder is the fm_features.FeatureEncoder used for training; it gives
+    the feature layout (users, then items, then side features). Item ids
+    in and out are the encoder's item indices, i.e. offset by num_users.
+    factor_dtype picks the FactorStore for the item factors.
+    """
+
+    def __init__(self, bias, linear, factors, encoder, factor_dtype='float32'):
+        linear = np.asarray(linear, dtype=np.float32).ravel()
+        factors = np.asarray(factors, dtype=np.float32)
+        if len(linear) != encoder.feature_dim or len(factors) != encoder.feature_dim:
+            raise ValueError("model has {} features, encoder expects {}".format(
+                len(linear), encoder.feature_dim))
+        self.encoder = encoder
+        self.bias = float(np.asarray(bias).ravel()[0])
+        self.num_factors = factors.shape[1]
+        items = slice(encoder.num_users, encoder.num_users + encoder.num_items)
+        self.item_linear = linear[items].copy()
+        self.items = FactorStore(factors[items], factor_dtype)
+        # Everything but the item rows stays float32; it is small.
+        self.linear = linear
+        self.context_factors = np.concatenate([factors[:items.start], factors[items.stop:]])
+
+    @classmethod
+    def from_artifacts(cls, path, encoder, factor_dtype='float32'):
+        """
+        Loads model.tar.gz as downloaded from the training job's
+        output_path (or the model_algo-1 file inside it). Needs mxnet.
+        """
+        return cls(*load_fm_weights(path), encoder=encoder, factor_dtype=factor_dtype)
+
+    def _query(self, user, features):
+        keys, values = self.encoder.context(user, features)
+        rows = np.where(keys < self.encoder.num_users, keys, keys - self.encoder.num_items)
+        context = self.context_factors[rows] * values[:, None]
+        summed = context.sum(axis=0)
+        constant = (self.bias + self.linear[keys].dot(values) +
+                    0.5 * (summed.dot(summed) - (context * context).sum()))
+        return summed, constant
+
+    def score_items(self, user, features=None, items=None):
+        """
+        FM scores of user (with side features, see
+        FeatureEncoder.context) against items, or against every item.
+        """
+        q, constant = self._query(user, features)
+        rows = None if items is None else np.asarray(items) - self.encoder.num_users
+        linear = self.item_linear if rows is None else self.item_linear[rows]
+        return self.items.dot(q, rows) + linear + np.float32(constant)
+
+    def recommend(self, user, k=10, features=None, exclude=None):
+        """
+        (items, scores) of the k best items for user, best first.
+        exclude holds item ids to skip.
+        """
+        scores = self.score_items(user, features)
+        if exclude is not None:
+            exclude = np.asarray(exclude) - self.encoder.num_users
+        best = top_k(scores, k, exclude)
+        return best + self.encoder.num_users, scores[best]
+
+    def recommend_many(self, users, k=10, features=None):
+        """
+        Top k items for each of users with one matrix product per
+        BLOCK_ROWS items. Returns (items, scores), each (len(users), k).
+        """
+        queries = [self._query(user, features) for user in users]
+        q = np.stack([query for query, _ in queries], axis=1)
+        constant = np.array([c for _, c in queries], dtype=np.float32)
+        scores = self.items.dot(q) + self.item_linear[:, None] + constant
+        k = min(k, scores.shape[0])
+        best = np.argpartition(-scores, k - 1, axis=0)[:k]
+        best_scores = np.take_along_axis(scores, best, axis=0)
+        order = np.argsort(-best_scores, axis=0, kind='stable')
+        best = np.take_along_axis(best, order, axis=0).T
+        return best + self.encoder.num_users, np.take_along_axis(best_scores, order, axis=0).T
+
+
+def load_fm_weights(path):
+    """
+    (w0, w, V) from FM model artifacts: model.tar.gz, or the model_algo-1
+    zip inside it.
+    """
+    try:
+        import mxnet as mx
+    except ImportError:
+        raise ImportError("Reading FM model artifacts requires mxnet (pip install mxnet)")
+
+    # Only the two members needed are read, into a temporary directory, so
+    # nothing in the archive can write elsewhere.
+    with tempfile.TemporaryDirectory() as directory:
+        if tarfile.is_tarfile(path):
+            with tarfile.open(path) as tar:
+                model = tar.extractfile('model_algo-1')
+                path = os.path.join(directory, 'model_algo-1')
+                with open(path, 'wb') as f:
+                    shutil.copyfileobj(model, f)
+        with zipfile.ZipFile(path) as archive:
+            params = [name for name in archive.namelist() if name.endswith('.params')][0]
+            params_path = os.path.join(directory, 'model.params')
+            with open(params_path, 'wb') as f:
+                f.write(archive.read(params))
+        arrays = mx.nd.load(params_path)
+    arrays = dict((name.split(':', 1)[-1], value.asnumpy()) for name, value in arrays.items())
+    return arrays['w0_weight'], arrays['w1_weight'], arrays['v']
+
+
+def _check(users, items, num_factors, k):
+    from scipy.sparse import csr_matrix
+    from fm_features import FeatureEncoder
+
+    rng = np.random.RandomState(0)
+    encoder = FeatureEncoder(users, items)
+    bias = np.array([3.5], dtype=np.float32)
+    linear = rng.normal(0, 0.1, encoder.feature_dim).astype(np.float32)
+    factors = rng.normal(0, 0.05, (encoder.feature_dim, num_factors)).astype(np.float32)
+
+    user, days = 7, 120.0
+    rows = csr_matrix((np.tile([1, 1, days], items).astype(np.float32),
+                       np.column_stack([np.full(items, user), users + np.arange(items),
+                                        np.full(items, encoder.feature_dim - 1)]).ravel(),
+                       np.arange(0, 3 * items + 1, 3)), shape=(items, encoder.feature_dim))
+    expected = fm_scores(rows, bias[0], linear, factors)
+    exact = top_k(expected, k)
+
+    for dtype in FactorStore.DTYPES:
+        scorer = FMScorer(bias, linear, factors, encoder, factor_dtype=dtype)
+        start = time.time()
+        best, _ = scorer.recommend(user, k, features={'days_since_first': days})
+        elapsed = time.time() - start
+        error = np.abs(scorer.score_items(user, {'days_since_first': days}) - expected).max()
+        print("{:8} factors {:7.1f} MB  max error {:.2e}  top-{} overlap {:.2f}  {:.1f} ms/user".format(
+            dtype, scorer.items.nbytes / 1e6, error, k,
+            len(np.intersect1d(best - users, exact)) / float(k), elapsed * 1000))
+
+    scorer = FMScorer(bias, linear, factors, encoder)
+    start = time.time()
+    scorer.recommend_many(np.arange(64), k)
+    print("recommend_many: {:.1f} ms/user for 64 users".format((time.time() - start) * 1000 / 64))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check FMScorer against the FM formula with synthetic weights')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--items', type=int, default=100000)
+    parser.add_argument('--factors', type=int, default=256)
+    parser.add_argument('-k', type=int, default=10)
+    args = parser.parse_args()
+    _check(args.users, args.items, args.factors, args.k)
@@ -0,0 +1,101 @@
+"""
+Parallel recordIO-protobuf shard writer for SageMaker Factorization Machines.
+
+to_s3_protobuf in fm_amazon_recommender.ipynb serializes each split with
+write_spmatrix_to_sparse_tensor into a BytesIO and uploads it, one after
+another. write_shards_to_s3 serializes the shards in a process pool, and
+each worker streams its records straight into an S3 multipart upload, so no
+shard is ever held whole in memory. The shard count is picked from a target
+shard size and rounded to a multiple of the training instance count, so
+ShardedByS3Key hands every instance the same amount of data.
+"""
+import math
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import numpy as np
+import sagemaker.amazon.common as smac
+
+from aws_clients import get_client
+from s3_upload import S3MultipartWriter, DEFAULT_PART_SIZE
+
+DEFAULT_SHARD_BYTES = 128 * 1024 * 1024
+
+# Rough recordIO-protobuf cost: a float32 value plus a varint key per
+# nonzero, and the label, shape and framing per record.
+_BYTES_PER_NONZERO = 9
+_BYTES_PER_RECORD = 48
+
+
+def estimate_protobuf_bytes(rows, nnz):
+    return nnz * _BYTES_PER_NONZERO + rows * _BYTES_PER_RECORD
+
+
+def choose_shard_count(rows, nnz, target_shard_bytes=DEFAULT_SHARD_BYTES, instance_count=1):
+    """
+    Number of shards of about target_shard_bytes each for a matrix with
+    rows rows and nnz nonzeros, rounded up to a multiple of instance_count
+    and never more than the number of rows.
+    """
+    shards = max(1, int(math.ceil(estimate_protobuf_bytes(rows, nnz) / float(target_shard_bytes))))
+    shards = int(math.ceil(shards / float(instance_count))) * instance_count
+    return max(1, min(shards, rows))
+
+
+def _write_shard(csr, labels, bucket, key, part_size):
+    start = time.time()
+    with S3MultipartWriter(bucket, key, client=get_client('s3'), part_size=part_size, max_workers=2) as f:
+        smac.write_spmatrix_to_sparse_tensor(f, csr, labels)
+    return key, csr.shape[0], f.bytes_written, time.time() - start
+
+
+def write_shards_to_s3(csr, labels, bucket, prefix, channel='train', shards=None,
+                       target_shard_bytes=DEFAULT_SHARD_BYTES, instance_count=1,
+                       processes=None, part_size=DEFAULT_PART_SIZE, log=print):
+    """
+    Writes csr and labels as s3://bucket/prefix/channel/data-N shards.
+
+    shards defaults to choose_shard_count for target_shard_bytes and
+    instance_count. Rows are split into contiguous ranges, serialized in
+    parallel and streamed to S3. Returns the list of keys written.
+    """
+    labels = np.asarray(labels, dtype=np.float32)
+    if shards is None:
+        shards = choose_shard_count(csr.shape[0], csr.nnz, target_shard_bytes, instance_count)
+    bounds = np.linspace(0, csr.shape[0], shards + 1).astype(np.int64)
+    chunks = ((csr[lo:hi], labels[lo:hi]) for lo, hi in zip(bounds[:-1], bounds[1:]))
+    return write_chunks_to_s3(chunks, bucket, prefix, channel=channel,
+                              processes=min(shards, processes or os.cpu_count() or 1),
+                              part_size=part_size, log=log)
+
+
+def write_chunks_to_s3(chunks, bucket, prefix, channel='train', processes=None,
+                       part_size=DEFAULT_PART_SIZE, log=print):
+    """
+    Writes each (csr, labels) pair from chunks as one shard. chunks may be a
+    generator such as FeatureEncoder.iter_chunks; only a couple of chunks
+    per process are pulled ahead, so the whole matrix never exists at once.
+    Returns the list of keys written.
+    """
+    processes = processes or os.cpu_count() or 1
+    start = time.time()
+    results = []
+    running = set()
+    with ProcessPoolExecutor(max_workers=processes) as pool:
+        for i, (csr, labels) in enumerate(chunks):
+            key = '{}/{}/data-{}'.format(prefix, channel, i)
+            running.add(pool.submit(_write_shard, csr, np.asarray(labels, dtype=np.float32),
+                                    bucket, key, part_size))
+            if len(running) >= 2 * processes:
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                results.extend(future.result() for future in finished)
+        results.extend(future.result() for future in wait(running)[0])
+
+    results.sort(key=lambda r: int(r[0].rsplit('-', 1)[1]))
+    if log:
+        total = sum(r[2] for r in results)
+        elapsed = time.time() - start
+        log("Wrote {} shards ({} rows, {:.1f} MB) to s3://{}/{}/{}/ in {:.1f}s with {} processes".format(
+            len(results), sum(r[1] for r in results), total / 1e6, bucket, prefix, channel, elapsed, processes))
+    return [r[0] for r in results]
@@ -0,0 +1,101 @@
+"""
+Train/test splits over review arrays, returned as row index arrays.
+
+The FM notebook takes groupby('customer_id').last() as the test set and
+outer-merges it back into the whole frame to find the training rows, which
+copies the frame, hash-joins on (customer_id, product_id) and drops every
+earlier review of a held-out (customer, product) pair along with the last
+one. These functions sort row numbers once and find the per-user
+boundaries in the sorted order, so a split costs one argsort and a few
+int64 arrays, and the caller selects rows with .iloc or fancy indexing.
+"""
+import numpy as np
+
+
+def group_bounds(sorted_keys):
+    """
+    (keys, starts, ends) for the runs of equal values in sorted_keys, so
+    rows starts[i]:ends[i] belong to keys[i].
+    """
+    sorted_keys = np.asarray(sorted_keys)
+    if len(sorted_keys) == 0:
+        empty = np.zeros(0, dtype=np.int64)
+        return sorted_keys[:0], empty, empty
+    starts = np.concatenate(([0], np.flatnonzero(sorted_keys[1:] != sorted_keys[:-1]) + 1))
+    ends = np.append(starts[1:], len(sorted_keys))
+    return sorted_keys[starts], starts, ends
+
+
+def sort_by_user(users, order=None):
+    """
+    Stable permutation that sorts rows by user, then by order if given.
+    """
+    users = np.asarray(users)
+    if order is not None:
+        order = np.asarray(order)
+        if np.issubdtype(order.dtype, np.datetime64):
+            order = order.view(np.int64)
+        if (len(users) and np.issubdtype(users.dtype, np.integer) and
+                np.issubdtype(order.dtype, np.integer) and users.min() >= 0):
+            # Pack (user, order) into one int64 key: a single stable sort is
+            # about twice as fast as lexsort over two keys.
+            low = int(order.min())
+            span = int(order.max()) - low + 1
+            if (int(users.max()) + 1) * span < 2 ** 62:
+                # int64 before subtracting: an int32 order minus int32 min overflows
+                key = users.astype(np.int64) * span + (order.astype(np.int64) - low)
+                return np.argsort(key, kind='stable')
+        # lexsort is stable too: ties in order keep their row order
+        return np.lexsort((order, users))
+    if len(users) < 2 or np.all(users[1:] >= users[:-1]):
+        return np.arange(len(users))
+    return np.argsort(users, kind='stable')
+
+
+def leave_last_out(users, order=None, n=1, min_train=0):
+    """
+    Holds out the last n rows of every user.
+
+    users holds one user key per row; order (e.g. review days or
+    timestamps) decides which rows are last, and rows keep their original
+    order when it is None or tied. By default users with n rows or fewer go
+    entirely to test, like the notebook's split; with min_train, users with
+    fewer than n + min_train rows keep all of their rows in train instead.
+    Returns (train_index, test_index), each sorted ascending.
+    """
+    users = np.asarray(users)
+    perm = sort_by_user(users, order)
+    _, starts, ends = group_bounds(users[perm])
+    counts = ends - starts
+
+    # Rank of each sorted row from the end of its user's run: 1 for the last row.
+    rank = np.repeat(ends, counts) - np.arange(len(perm))
+    held_out = rank <= n
+    if min_train:
+        held_out &= np.repeat(counts >= n + min_train, counts)
+
+    test = np.sort(perm[held_out])
+    train = np.sort(perm[~held_out])
+    return train, test
+
+
+def time_cutoff_split(times, cutoff, users=None):
+    """
+    Rows with times before cutoff go to train, the rest to test. cutoff
+    may be anything np.datetime64 accepts when times are datetimes. With
+    users (non-negative integer keys, like the notebook's user index) test
+    rows of users that have no training rows are dropped, since the model
+    has no factors for them. Returns (train_index, test_index).
+    """
+    times = np.asarray(times)
+    if np.issubdtype(times.dtype, np.datetime64):
+        cutoff = np.datetime64(cutoff).astype(times.dtype)
+    before = times < cutoff
+    train = np.flatnonzero(before)
+    test = np.flatnonzero(~before)
+    if users is not None and len(test):
+        users = np.asarray(users)
+        seen = np.zeros(int(users.max()) + 1, dtype=bool)
+        seen[users[train]] = True
+        test = test[seen[users[test]]]
+    return train, test
@@ -0,0 +1,373 @@
+"""
+Memory-mapped per-user interaction history.
+
+Both notebooks hold the interactions as a DataFrame and only ever sample a
+row from it. HistoryStore keeps every user's items in time order as CSR
+arrays in a directory, memory-mapped on load:
+
+- user_ids.npy: the users (int64, ascending), and offsets.npy: where each
+  user's rows start, so a user's history is one slice of
+- items.npy (int32) and timestamps.npy (int64): rows sorted by user, then
+  time
+- item_keys.npy: row << 32 | item for every row, sorted, so "has this user
+  seen these items" is one searchsorted for a whole batch of users
+- manifest.json
+
+Clicks added with append() go to appended.bin, an append-only log in the
+same directory that is replayed on load, and to an in-memory overlay.
+compact() (run automatically every compact_rows appended rows) merges
+them into new arrays written to a temporary directory and swapped in with
+vector_cache.swap_directory; opening a store recovers from a swap that a
+crash interrupted.
+
+    python history_store.py ./ml-100k/u.data history_store
+"""
+import argparse
+import json
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from catalog_index import MAX_DENSE_RATIO
+from interaction_prep import iter_interactions
+from vector_cache import recover_directory, staging_directory, swap_directory
+
+STORE_VERSION = 1
+LOG_DTYPE = np.dtype([('user', '<i8'), ('item', '<i4'), ('timestamp', '<i8')])
+DEFAULT_COMPACT_ROWS = 100000
+
+
+def _item_keys(rows, items):
+    return (np.asarray(rows, dtype=np.int64) << 32) | np.asarray(items, dtype=np.int64)
+
+
+def write_history(directory, users, items, timestamps):
+    """
+    Writes (user, item, timestamp) rows as a store directory, sorted by user
+    and then time (ties keep their order). The files are written to a
+    temporary directory first and swapped in. Returns directory.
+    """
+    users = np.asarray(users, dtype=np.int64)
+    items = np.asarray(items, dtype=np.int32)
+    timestamps = np.asarray(timestamps, dtype=np.int64)
+    order = np.lexsort((timestamps, users))
+    users, items, timestamps = users[order], items[order], timestamps[order]
+    user_ids, starts = np.unique(users, return_index=True)
+    offsets = np.append(starts, len(users)).astype(np.int64)
+    rows = np.repeat(np.arange(len(user_ids)), np.diff(offsets))
+    manifest = {'version': STORE_VERSION, 'users': int(len(user_ids)), 'rows': int(len(users)),
+                'built': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())}
+
+    staging = staging_directory(directory)
+    try:
+        np.save(os.path.join(staging, 'user_ids.npy'), user_ids)
+        np.save(os.path.join(staging, 'offsets.npy'), offsets)
+        np.save(os.path.join(staging, 'items.npy'), items)
+        np.save(os.path.join(staging, 'timestamps.npy'), timestamps)
+        np.save(os.path.join(staging, 'item_keys.npy'), np.sort(_item_keys(rows, items)))
+        with open(os.path.join(staging, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        swap_directory(staging, directory)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    return directory
+
+
+class HistoryStore(object):
+    """
+    Per-user item histories from a write_history directory. Ids are
+    integers, as in u.data; the string ids Personalize returns are
+    converted. It is thread-safe; reads wait while compact() swaps in new
+    files.
+    """
+
+    def __init__(self, directory, mmap_mode='r', compact_rows=DEFAULT_COMPACT_ROWS):
+        self.directory = directory
+        self.mmap_mode = mmap_mode
+        self.compact_rows = compact_rows
+        self._lock = threading.RLock()
+        self._log = None
+        self._open()
+
+    @classmethod
+    def build(cls, directory, users, items, timestamps, **kwargs):
+        write_history(directory, users, items, timestamps)
+        return cls(directory, **kwargs)
+
+    @classmethod
+    def from_chunks(cls, directory, chunks, **kwargs):
+        """
+        Builds a store from an iterable of DataFrames with USER_ID, ITEM_ID
+        and TIMESTAMP columns, e.g. interaction_prep.iter_interactions.
+        Only the three columns are kept in memory while reading.
+        """
+        columns = ([], [], [])
+        for chunk in chunks:
+            columns[0].append(chunk['USER_ID'].values.astype(np.int64))
+            columns[1].append(chunk['ITEM_ID'].values.astype(np.int32))
+            columns[2].append(chunk['TIMESTAMP'].values.astype(np.int64))
+        users, items, timestamps = [np.concatenate(column) if column else np.zeros(0, dtype=np.int64)
+                                    for column in columns]
+        return cls.build(directory, users, items, timestamps, **kwargs)
+
+    @classmethod
+    def from_movielens(cls, path='./ml-100k/u.data', directory='history_store', rating_threshold=None,
+                       rebuild=False, **kwargs):
+        """
+        Opens the store in directory, building it from a u.data-style log
+        first if it does not exist (or rebuild is set). Every rating counts
+        as seen unless rating_threshold is given.
+        """
+        recover_directory(directory)
+        if rebuild or not os.path.exists(os.path.join(directory, 'manifest.json')):
+            return cls.from_chunks(directory, iter_interactions(path, rating_threshold=rating_threshold), **kwargs)
+        return cls(directory, **kwargs)
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _open(self):
+        recover_directory(self.directory)
+        with open(self._path('manifest.json')) as f:
+            self.manifest = json.load(f)
+        if self.manifest.get('version') != STORE_VERSION:
+            raise ValueError("Unsupported history store version: {}".format(self.manifest.get('version')))
+        self.user_ids = np.load(self._path('user_ids.npy'), mmap_mode=self.mmap_mode)
+        self.offsets = np.load(self._path('offsets.npy'), mmap_mode=self.mmap_mode)
+        self.items = np.load(self._path('items.npy'), mmap_mode=self.mmap_mode)
+        self.timestamps = np.load(self._path('timestamps.npy'), mmap_mode=self.mmap_mode)
+        self.item_keys = np.load(self._path('item_keys.npy'), mmap_mode=self.mmap_mode)
+
+        self._dense = None
+        if len(self.user_ids) and self.user_ids[0] >= 0 and \
+                self.user_ids[-1] < MAX_DENSE_RATIO * len(self.user_ids) + 1024:
+            self._dense = np.full(int(self.user_ids[-1]) + 1, -1, dtype=np.int64)
+            self._dense[np.asarray(self.user_ids)] = np.arange(len(self.user_ids))
+
+        # row -> ([items], [timestamps]) appended since the last compaction, and
+        # rows (after the stored ones) for users that are only in the log
+        self._appended = {}
+        self._new_rows = {}
+        self._appended_rows = 0
+        self._appended_keys = None
+        log_path = self._path('appended.bin')
+        if os.path.exists(log_path):
+            size = os.path.getsize(log_path)
+            with open(log_path, 'r+b') as f:
+                # drop a record cut short by a crash so new ones stay aligned
+                f.truncate(size - size % LOG_DTYPE.itemsize)
+                records = np.fromfile(f, dtype=LOG_DTYPE)
+            self._add(records['user'], records['item'], records['timestamp'])
+
+    def close(self):
+        with self._lock:
+            if self._log is not None:
+                self._log.close()
+                self._log = None
+
+    def __len__(self):
+        return len(self.user_ids) + len(self._new_rows)
+
+    def rows(self, user_ids):
+        """
+        Row of every user id, -1 for unknown users.
+        """
+        user_ids = np.asarray(user_ids).astype(np.int64)
+        if self._dense is not None:
+            rows = np.full(user_ids.shape, -1, dtype=np.int64)
+            in_range = (user_ids >= 0) & (user_ids < len(self._dense))
+            rows[in_range] = self._dense[user_ids[in_range]]
+        else:
+            rows = np.full(user_ids.shape, -1, dtype=np.int64)
+            if len(self.user_ids):
+                positions = np.minimum(np.searchsorted(self.user_ids, user_ids), len(self.user_ids) - 1)
+                found = self.user_ids[positions] == user_ids
+                rows[found] = positions[found]
+        if self._new_rows:
+            missing = np.flatnonzero(rows < 0)
+            rows[missing] = [self._new_rows.get(user, -1) for user in user_ids[missing].tolist()]
+        return rows
+
+    def _history(self, row):
+        if 0 <= row < len(self.user_ids):
+            lo, hi = self.offsets[row], self.offsets[row + 1]
+            items, timestamps = self.items[lo:hi], self.timestamps[lo:hi]
+        else:
+            items, timestamps = self.items[:0], self.timestamps[:0]
+        appended = self._appended.get(row)
+        if appended is None:
+            return items, timestamps
+        items = np.concatenate([items, np.array(appended[0], dtype=np.int32)])
+        timestamps = np.concatenate([timestamps, np.array(appended[1], dtype=np.int64)])
+        if (np.diff(timestamps) < 0).any():
+            order = np.argsort(timestamps, kind='stable')
+            items, timestamps = items[order], timestamps[order]
+        return items, timestamps
+
+    def history(self, user_id):
+        """
+        (items, timestamps) of user_id, oldest first; empty for unknown
+        users. Without appended clicks these are views of the mapped files.
+        """
+        with self._lock:
+            return self._history(int(self.rows([user_id])[0]))
+
+    def recent_items(self, user_id, n=10):
+        """
+        The user's last n items, oldest first, e.g. as session context.
+        """
+        return self.history(user_id)[0][-n:]
+
+    def seen_mask(self, user_ids, item_ids):
+        """
+        Boolean array shaped like item_ids, (users, k), that is True where
+        the row's user has interacted with the item. item_ids may hold the
+        string ids from get_recommendations.
+        """
+        item_ids = np.atleast_2d(np.asarray(item_ids).astype(np.int64))
+        with self._lock:
+            rows = self.rows(user_ids)
+            keys = _item_keys(np.maximum(rows, 0)[:, None], item_ids)
+            seen = np.zeros(item_ids.shape, dtype=bool)
+            for stored in (self.item_keys, self._appended_key_array()):
+                if len(stored):
+                    positions = np.minimum(np.searchsorted(stored, keys), len(stored) - 1)
+                    seen |= stored[positions] == keys
+        return seen & (rows >= 0)[:, None] & (item_ids >= 0)
+
+    def filter_seen(self, user_id, item_ids):
+        """
+        item_ids without the ones user_id has interacted with, in order.
+        """
+        if not len(item_ids):
+            return list(item_ids)
+        mask = self.seen_mask([user_id], [item_ids])[0]
+        return [item for item, seen in zip(item_ids, mask) if not seen]
+
+    def filter_item_list(self, user_id, item_list):
+        """
+        filter_seen for an itemList returned by get_recommendations.
+        """
+        if not item_list:
+            return []
+        mask = self.seen_mask([user_id], [[item['itemId'] for item in item_list]])[0]
+        return [item for item, seen in zip(item_list, mask) if not seen]
+
+    def _appended_key_array(self):
+        # call with the lock held
+        if self._appended_keys is None:
+            parts = [_item_keys(np.full(len(items), row), np.array(items, dtype=np.int64))
+                     for row, (items, _) in self._appended.items()]
+            self._appended_keys = np.sort(np.concatenate(parts)) if parts else np.zeros(0, dtype=np.int64)
+        return self._appended_keys
+
+    def _add(self, users, items, timestamps):
+        # call with the lock held (or from _open)
+        rows = self.rows(users)
+        for i in np.flatnonzero(rows < 0):
+            user = int(users[i])
+            if user not in self._new_rows:
+                self._new_rows[user] = len(self.user_ids) + len(self._new_rows)
+            rows[i] = self._new_rows[user]
+        for row, item, timestamp in zip(rows.tolist(), np.asarray(items).tolist(), np.asarray(timestamps).tolist()):
+            appended = self._appended.setdefault(row, ([], []))
+            appended[0].append(item)
+            appended[1].append(timestamp)
+        self._appended_rows += len(rows)
+        self._appended_keys = None
+
+    def append(self, user_ids, item_ids, timestamps=None):
+        """
+        Adds interactions (timestamps default to now) to the log and to
+        the in-memory overlay, compacting once compact_rows have been
+        appended since the last compaction.
+        """
+        records = np.zeros(len(user_ids), dtype=LOG_DTYPE)
+        records['user'] = np.asarray(user_ids).astype(np.int64)
+        records['item'] = np.asarray(item_ids).astype(np.int32)
+        records['timestamp'] = int(time.time()) if timestamps is None else np.asarray(timestamps).astype(np.int64)
+        with self._lock:
+            if self._log is None:
+                self._log = open(self._path('appended.bin'), 'ab')
+            self._log.write(records.tobytes())
+            self._log.flush()
+            self._add(records['user'], records['item'], records['timestamp'])
+            if self.compact_rows and self._appended_rows >= self.compact_rows:
+                self.compact()
+
+    def on_events_sent(self, user_id, session_id, events):
+        """
+        EventSender on_sent callback: appends the clicked items.
+        """
+        clicks = [(json.loads(event['properties']).get('itemId'), event['sentAt']) for event in events]
+        clicks = [(item, sent_at) for item, sent_at in clicks if item is not None]
+        if clicks:
+            self.append([user_id] * len(clicks), [item for item, _ in clicks],
+                        [int(sent_at) for _, sent_at in clicks])
+
+    def compact(self):
+        """
+        Merges the appended interactions into new arrays, swaps them in and
+        starts a new, empty log. Returns the number of rows.
+        """
+        with self._lock:
+            users = [np.repeat(np.asarray(self.user_ids), np.diff(self.offsets))]
+            items, timestamps = [np.asarray(self.items)], [np.asarray(self.timestamps)]
+            row_users = dict((row, user) for user, row in self._new_rows.items())
+            for row, (appended_items, appended_timestamps) in self._appended.items():
+                user = self.user_ids[row] if row < len(self.user_ids) else row_users[row]
+                users.append(np.full(len(appended_items), user, dtype=np.int64))
+                items.append(np.array(appended_items, dtype=np.int32))
+                timestamps.append(np.array(appended_timestamps, dtype=np.int64))
+            self.close()
+            write_history(self.directory, np.concatenate(users), np.concatenate(items),
+                          np.concatenate(timestamps))
+            self._open()
+            return len(self.items)
+
+    def stats(self):
+        return {'users': len(self), 'stored_rows': len(self.items), 'appended_rows': self._appended_rows}
+
+
+def _benchmark(path, directory, queries, k):
+    start = time.time()
+    store = HistoryStore.from_movielens(path, directory, rebuild=True)
+    print("Built {} rows for {} users in {:.2f}s".format(len(store.items), len(store), time.time() - start))
+
+    rng = np.random.RandomState(0)
+    users = rng.choice(np.asarray(store.user_ids), queries)
+    candidates = rng.choice(np.unique(store.items), (queries, k))
+    latencies = []
+    for user in users:
+        start = time.time()
+        store.history(user)
+        latencies.append((time.time() - start) * 1e6)
+    print("history: p50 {:.1f} us, p99 {:.1f} us".format(*np.percentile(latencies, [50, 99])))
+
+    start = time.time()
+    seen = store.seen_mask(users, candidates)
+    print("seen_mask: {} users x {} items in {:.2f} ms ({:.1%} seen)".format(
+        queries, k, (time.time() - start) * 1000, seen.mean()))
+
+    start = time.time()
+    for user, item in zip(users[:1000], candidates[:1000, 0]):
+        store.append([user], [item])
+    print("append: {:.1f} us per click".format((time.time() - start) * 1e6 / 1000))
+    start = time.time()
+    store.compact()
+    print("compact: {:.2f}s".format(time.time() - start))
+    store.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and benchmark the memory-mapped history store')
+    parser.add_argument('data', nargs='?', default='./ml-100k/u.data', help='u.data-style interactions')
+    parser.add_argument('directory', nargs='?', default='history_store')
+    parser.add_argument('--queries', type=int, default=10000)
+    parser.add_argument('-k', type=int, default=25)
+    args = parser.parse_args()
+    _benchmark(args.data, args.directory, args.queries, args.k)
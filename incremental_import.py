@@ -0,0 +1,283 @@
+"""
+Incremental interaction imports for Amazon Personalize.
+
+The first notebook rewrites and uploads the whole filtered u.data and runs a
+full dataset import and a full retrain on every refresh. IncrementalImport
+keeps a watermark per dataset in a local JSON state file: the largest
+TIMESTAMP already imported, plus the USER_ID/ITEM_ID pairs imported at that
+second. A sync then
+
+1. streams the log through interaction_prep and keeps only rows at or after
+   the watermark, minus those pairs (so rows logged in the same second as
+   the last import are neither skipped nor imported twice), stopping early
+   if there are none;
+2. uploads those rows as their own delta object
+   (<prefix>/delta-<watermark>-<sync time>.csv);
+3. imports the delta with importMode INCREMENTAL, which appends to the
+   dataset instead of replacing it;
+4. optionally trains a new solution version, with trainingMode UPDATE when
+   the solution's recipe supports it (FULL otherwise), and points a
+   campaign at it.
+
+The watermark only moves once the import job is ACTIVE. A sync that stops
+while a job is running leaves it recorded as pending, and the next sync
+waits for it instead of importing the same rows again (and retrains if it
+finished). Rows are assumed to be appended in time order: an interaction
+that arrives after the watermark has passed its TIMESTAMP is not imported.
+
+    python incremental_import.py ./ml-100k/u.data --dataset-arn <arn> --role-arn <arn> --bucket <bucket>
+"""
+import argparse
+import itertools
+import json
+import os
+import time
+
+from aws_clients import get_client
+from interaction_prep import iter_interactions, write_csv_chunks
+from personalize_waiter import ResourceFailedError, wait_for_resource
+from s3_upload import S3MultipartWriter
+
+# Recipes whose solutions can be retrained with trainingMode UPDATE.
+UPDATE_MODE_RECIPES = ('arn:aws:personalize:::recipe/aws-user-personalization',
+                       'arn:aws:personalize:::recipe/aws-hrnn-coldstart')
+
+
+class WatermarkState(object):
+    """
+    JSON state file of dataset ARN -> {'watermark', 'watermark_keys',
+    'rows', 'pending', 'history'}, rewritten atomically on every change.
+    """
+
+    def __init__(self, path='import_state.json'):
+        self.path = path
+        self.datasets = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                self.datasets = json.load(f)
+
+    def get(self, dataset_arn):
+        return self.datasets.setdefault(dataset_arn, {'watermark': None, 'watermark_keys': [], 'rows': 0,
+                                                      'pending': None, 'history': []})
+
+    def save(self):
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.datasets, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+
+def _row_keys(chunk):
+    return chunk['USER_ID'].astype(str) + '\t' + chunk['ITEM_ID'].astype(str)
+
+
+def _newer_chunks(chunks, watermark, imported, span, edge):
+    # Rows at or after watermark except the row keys in imported, which
+    # were imported at the watermark second. span collects [first, last]
+    # TIMESTAMP seen and edge the row keys at the last one.
+    for chunk in chunks:
+        if watermark is not None:
+            chunk = chunk[chunk['TIMESTAMP'] >= watermark]
+            if imported:
+                chunk = chunk[~((chunk['TIMESTAMP'] == watermark) & _row_keys(chunk).isin(imported))]
+        if len(chunk):
+            low, high = int(chunk['TIMESTAMP'].min()), int(chunk['TIMESTAMP'].max())
+            if not span or high > span[1]:
+                edge.clear()
+            if not span or high >= span[1]:
+                edge.update(_row_keys(chunk[chunk['TIMESTAMP'] == high]))
+            span[:] = [min(span[0], low), max(span[1], high)] if span else [low, high]
+            yield chunk
+
+
+class IncrementalImport(object):
+    """
+    Watermark-based delta imports into one Personalize dataset. Delta
+    objects are written to s3://bucket/prefix/; role_arn must be able to
+    read them.
+    """
+
+    def __init__(self, dataset_arn, role_arn, bucket, prefix='interactions-delta',
+                 state_file='import_state.json', personalize=None, s3=None, log=print):
+        self.dataset_arn = dataset_arn
+        self.role_arn = role_arn
+        self.bucket = bucket
+        self.prefix = prefix
+        self.state = WatermarkState(state_file)
+        self.personalize = personalize or get_client('personalize')
+        self.s3 = s3 or get_client('s3')
+        self.log = log
+
+    @property
+    def watermark(self):
+        return self.state.get(self.dataset_arn)['watermark']
+
+    def mark_imported(self, src, **kwargs):
+        """
+        Sets the watermark to the newest interaction in src, e.g. after the
+        notebook's full import of the same file. Returns the watermark.
+        """
+        span, edge = [], set()
+        for _ in _newer_chunks(iter_interactions(src, **kwargs), None, None, span, edge):
+            pass
+        entry = self.state.get(self.dataset_arn)
+        entry['watermark'] = span[1] if span else None
+        entry['watermark_keys'] = sorted(edge)
+        self.state.save()
+        return entry['watermark']
+
+    def _finish_pending(self):
+        entry = self.state.get(self.dataset_arn)
+        pending = entry['pending']
+        if not pending:
+            return None
+        if self.log:
+            self.log("Waiting for pending import {}".format(pending['job_arn']))
+        try:
+            wait_for_resource(self.personalize, 'dataset_import_job', pending['job_arn'], log=None)
+        except ResourceFailedError as e:
+            # its rows are still after the watermark and go into this sync
+            if self.log:
+                self.log("Pending import failed: {}".format(e))
+            entry['pending'] = None
+            self.state.save()
+            return None
+        self._commit(pending)
+        return pending
+
+    def _commit(self, job):
+        entry = self.state.get(self.dataset_arn)
+        last, keys = job['last_timestamp'], job.pop('last_keys', [])
+        if entry['watermark'] is None or last > entry['watermark']:
+            entry['watermark'] = last
+            entry['watermark_keys'] = keys
+        elif last == entry['watermark']:
+            entry['watermark_keys'] = sorted(set(entry.get('watermark_keys', [])) | set(keys))
+        entry['rows'] += job['rows']
+        entry['history'].append(job)
+        entry['pending'] = None
+        self.state.save()
+
+    def import_delta(self, src, **kwargs):
+        """
+        Uploads and imports the rows of src newer than the watermark (all of
+        them, with a FULL import, when there is no watermark yet). kwargs go
+        to iter_interactions. Returns the job record, or None when there was
+        nothing new.
+        """
+        self._finish_pending()
+        watermark = self.watermark
+        imported = set(self.state.get(self.dataset_arn).get('watermark_keys', []))
+        span, edge = [], set()
+        chunks = _newer_chunks(iter_interactions(src, **kwargs), watermark, imported, span, edge)
+        first = next(chunks, None)
+        if first is None:
+            if self.log:
+                self.log("No interactions after {}".format(watermark))
+            return None
+
+        started = time.time()
+        key = '{}/delta-{}-{}.csv'.format(self.prefix, watermark or 0, int(started))
+        with S3MultipartWriter(self.bucket, key, client=self.s3) as f:
+            rows = write_csv_chunks(itertools.chain([first], chunks), f)
+            size = f.bytes_written
+        uploaded = time.time()
+
+        mode = 'INCREMENTAL' if watermark is not None else 'FULL'
+        response = self.personalize.create_dataset_import_job(
+            jobName='delta-{}-{}'.format(watermark or 0, int(started)),
+            datasetArn=self.dataset_arn,
+            dataSource={'dataLocation': 's3://{}/{}'.format(self.bucket, key)},
+            roleArn=self.role_arn,
+            importMode=mode)
+        job = {'job_arn': response['datasetImportJobArn'], 'key': key, 'rows': rows, 'bytes': size,
+               'import_mode': mode, 'first_timestamp': span[0], 'last_timestamp': span[1],
+               'last_keys': sorted(edge)}
+        self.state.get(self.dataset_arn)['pending'] = job
+        self.state.save()
+        if self.log:
+            self.log("Uploaded {} interactions ({:.1f} MB) to s3://{}/{} in {:.1f}s, {} import started".format(
+                rows, size / 1e6, self.bucket, key, uploaded - started, mode))
+
+        try:
+            wait_for_resource(self.personalize, 'dataset_import_job', job['job_arn'], log=None)
+        except ResourceFailedError:
+            self.state.get(self.dataset_arn)['pending'] = None
+            self.state.save()
+            raise
+        job['upload_seconds'] = uploaded - started
+        job['import_seconds'] = time.time() - uploaded
+        self._commit(job)
+        if self.log:
+            self.log("Import finished in {:.1f}s; watermark is now {}".format(
+                job['import_seconds'], self.watermark))
+        return job
+
+    def training_mode(self, solution_arn):
+        recipe = self.personalize.describe_solution(solutionArn=solution_arn)['solution'].get('recipeArn')
+        return 'UPDATE' if recipe in UPDATE_MODE_RECIPES else 'FULL'
+
+    def retrain(self, solution_arn, campaign_arn=None, training_mode=None):
+        """
+        Trains a new solution version (UPDATE mode if the recipe allows it)
+        and, with campaign_arn, deploys it to the campaign. Returns a dict
+        with the version ARN, training mode and timings.
+        """
+        mode = training_mode or self.training_mode(solution_arn)
+        started = time.time()
+        arn = self.personalize.create_solution_version(solutionArn=solution_arn,
+                                                       trainingMode=mode)['solutionVersionArn']
+        wait_for_resource(self.personalize, 'solution_version', arn, log=None)
+        result = {'solution_version_arn': arn, 'training_mode': mode, 'train_seconds': time.time() - started}
+        if self.log:
+            self.log("{} training of {} finished in {:.1f}s".format(mode, arn, result['train_seconds']))
+        if campaign_arn:
+            started = time.time()
+            self.personalize.update_campaign(campaignArn=campaign_arn, solutionVersionArn=arn)
+            wait_for_resource(self.personalize, 'campaign', campaign_arn, log=None)
+            result['deploy_seconds'] = time.time() - started
+            if self.log:
+                self.log("Campaign updated in {:.1f}s".format(result['deploy_seconds']))
+        return result
+
+    def sync(self, src, solution_arn=None, campaign_arn=None, **kwargs):
+        """
+        import_delta, then retrain if solution_arn is given and anything
+        was imported, by this sync or by a pending job from an earlier one
+        (FULL after the first, full import). Returns {'pending': job or None,
+        'import': job or None, 'training': ... or None}.
+        """
+        pending = self._finish_pending()
+        job = self.import_delta(src, **kwargs)
+        imported = [j for j in (pending, job) if j]
+        training = None
+        if imported and solution_arn:
+            # UPDATE needs an earlier FULL version trained on the same dataset
+            mode = 'FULL' if any(j['import_mode'] == 'FULL' for j in imported) else None
+            training = self.retrain(solution_arn, campaign_arn, training_mode=mode)
+        return {'pending': pending, 'import': job, 'training': training}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Import interactions newer than the last import')
+    parser.add_argument('src', help='u.data-style tab separated log')
+    parser.add_argument('--dataset-arn', required=True)
+    parser.add_argument('--role-arn', required=True)
+    parser.add_argument('--bucket', required=True)
+    parser.add_argument('--prefix', default='interactions-delta')
+    parser.add_argument('--state-file', default='import_state.json')
+    parser.add_argument('--solution-arn', help='retrain this solution after importing')
+    parser.add_argument('--campaign-arn', help='deploy the new solution version to this campaign')
+    parser.add_argument('--mark-imported', action='store_true',
+                        help='only set the watermark to the newest row in src (after a full import)')
+    parser.add_argument('--rating-threshold', type=int, default=3)
+    args = parser.parse_args()
+
+    sync = IncrementalImport(args.dataset_arn, args.role_arn, args.bucket, prefix=args.prefix,
+                             state_file=args.state_file)
+    if args.mark_imported:
+        print("Watermark set to {}".format(sync.mark_imported(args.src, rating_threshold=args.rating_threshold)))
+    else:
+        result = sync.sync(args.src, solution_arn=args.solution_arn, campaign_arn=args.campaign_arn,
+                           rating_threshold=args.rating_threshold)
+        print(json.dumps(result, indent=2))
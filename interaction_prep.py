@@ -0,0 +1,190 @@
+"""
+Chunked preprocessing of interaction logs into the Personalize import CSV.
+
+The first notebook loads all of u.data into memory, filters and projects it,
+writes movie-lens-100k.csv and uploads that file. prepare_interactions does
+the same work one chunk at a time with compact dtypes, checks each chunk
+against the Avro schema and streams the CSV either to a local file or
+straight into a multipart S3 upload, so peak memory depends only on
+chunksize:
+
+    python interaction_prep.py ./ml-100k/u.data s3://<your-bucket>/movie-lens-100k.csv
+"""
+import argparse
+import io
+import itertools
+
+import pandas as pd
+
+from s3_upload import S3MultipartWriter, split_s3_url
+
+MOVIELENS_COLUMNS = ['USER_ID', 'ITEM_ID', 'RATING', 'TIMESTAMP']
+MOVIELENS_DTYPES = {'USER_ID': 'int32', 'ITEM_ID': 'int32', 'RATING': 'int8', 'TIMESTAMP': 'int64'}
+
+INTERACTIONS_SCHEMA = {
+    "type": "record",
+    "name": "Interactions",
+    "namespace": "com.amazonaws.personalize.schema",
+    "fields": [
+        {
+            "name": "USER_ID",
+            "type": "string"
+        },
+        {
+            "name": "ITEM_ID",
+            "type": "string"
+        },
+        {
+            "name": "TIMESTAMP",
+            "type": "long"
+        }
+    ],
+    "version": "1.0"
+}
+
+
+class SchemaValidationError(ValueError):
+    pass
+
+
+def _field_types(field):
+    types = field['type'] if isinstance(field['type'], list) else [field['type']]
+    return [t for t in types if t != 'null'], 'null' in types
+
+
+def _reject(chunk, bad, on_invalid, message):
+    # Drops the rows flagged in bad, or raises message.format(count, first row).
+    if bad.any():
+        if on_invalid != 'drop':
+            raise SchemaValidationError(message.format(int(bad.sum()), bad.idxmax()))
+        chunk = chunk[~bad]
+    return chunk
+
+
+def validate_chunk(chunk, schema, on_invalid='raise'):
+    """
+    Checks chunk against an Avro record schema: the columns must be the
+    schema fields, long/int fields must be integers and only fields with a
+    "null" union member may be empty. With on_invalid='drop' bad rows are
+    removed instead of raising SchemaValidationError.
+    """
+    names = [field['name'] for field in schema['fields']]
+    missing = [name for name in names if name not in chunk.columns]
+    if missing:
+        raise SchemaValidationError("Missing schema fields: {}".format(missing))
+
+    bad = pd.Series(False, index=chunk.index)
+    for field in schema['fields']:
+        column = chunk[field['name']]
+        types, nullable = _field_types(field)
+        if not nullable:
+            bad |= column.isna()
+        if set(types) <= {'int', 'long'} and not pd.api.types.is_integer_dtype(column):
+            numeric = pd.to_numeric(column, errors='coerce')
+            bad |= column.notna() & (numeric.isna() | (numeric % 1 != 0))
+        elif set(types) <= {'int', 'long', 'float', 'double'} and not pd.api.types.is_numeric_dtype(column):
+            bad |= column.notna() & pd.to_numeric(column, errors='coerce').isna()
+
+    chunk = _reject(chunk, bad, on_invalid, "{} rows do not match the schema, first at row {}")
+    return chunk[names]
+
+
+def _text_chunks(path, chunksize):
+    # chunksize lines at a time, as text
+    f = open(path) if isinstance(path, str) else path
+    try:
+        while True:
+            lines = list(itertools.islice(f, chunksize))
+            if not lines:
+                return
+            yield ''.join(lines)
+    finally:
+        if isinstance(path, str):
+            f.close()
+
+
+def iter_interactions(path, chunksize=1000000, rating_threshold=3, schema=INTERACTIONS_SCHEMA,
+                      on_invalid='raise', sep='\t', names=MOVIELENS_COLUMNS, dtype=MOVIELENS_DTYPES):
+    """
+    Yields filtered, projected and validated chunks of a u.data-style log,
+    keeping only rows with RATING above rating_threshold. Rows without a
+    numeric RATING are invalid rows like those validate_chunk rejects.
+
+    Chunks are parsed with the compact dtype. Only a chunk that does not
+    parse with it is read as strings, so that its malformed rows reach
+    validate_chunk (and can be dropped with on_invalid='drop'), and is then
+    downcast to dtype.
+    """
+    start = 0
+    for text in _text_chunks(path, chunksize):
+        try:
+            chunk = pd.read_csv(io.StringIO(text), sep=sep, names=names, dtype=dtype)
+            parsed = True
+        except (ValueError, OverflowError):
+            chunk = pd.read_csv(io.StringIO(text), sep=sep, names=names, dtype=object)
+            parsed = False
+        chunk.index = pd.RangeIndex(start, start + len(chunk))
+        start += len(chunk)
+        if rating_threshold is not None:
+            rating = pd.to_numeric(chunk['RATING'], errors='coerce')
+            chunk = _reject(chunk, rating.isna(), on_invalid, "{} rows have no numeric RATING, first at row {}")
+            chunk = chunk[rating[chunk.index] > rating_threshold]
+        chunk = validate_chunk(chunk, schema, on_invalid=on_invalid)
+        yield chunk if parsed else _downcast(chunk, dtype or {}, on_invalid)
+
+
+def _downcast(chunk, dtype, on_invalid):
+    # Casts the validated string columns to dtype; values that do not fit
+    # (e.g. a non-numeric ITEM_ID, a valid Avro string) are invalid rows.
+    columns = [column for column in dtype if column in chunk]
+    numeric = dict((column, pd.to_numeric(chunk[column], errors='coerce')) for column in columns)
+    bad = pd.Series(False, index=chunk.index)
+    for column in columns:
+        bad |= chunk[column].notna() & (numeric[column].isna() | (numeric[column] % 1 != 0))
+    chunk = _reject(chunk, bad, on_invalid, "{} rows do not fit the column types, first at row {}").copy()
+    for column in columns:
+        chunk[column] = numeric[column][~bad].astype(dtype[column])
+    return chunk
+
+
+def write_csv_chunks(chunks, f):
+    """
+    Writes chunks to the binary file-like f as one CSV with a single header.
+    Returns the number of rows written.
+    """
+    rows = 0
+    header = True
+    for chunk in chunks:
+        f.write(chunk.to_csv(index=False, header=header).encode('utf-8'))
+        header = False
+        rows += len(chunk)
+    return rows
+
+
+def prepare_interactions(src, dest, s3=None, **kwargs):
+    """
+    Streams src through iter_interactions into dest, a local path or an
+    s3:// URL. Returns the number of rows written.
+    """
+    chunks = iter_interactions(src, **kwargs)
+    if dest.startswith('s3://'):
+        bucket, key = split_s3_url(dest)
+        with S3MultipartWriter(bucket, key, client=s3) as f:
+            return write_csv_chunks(chunks, f)
+    with open(dest, 'wb') as f:
+        return write_csv_chunks(chunks, f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Filter an interaction log into the Personalize import CSV')
+    parser.add_argument('src', help='u.data-style tab separated log')
+    parser.add_argument('dest', help='output path or s3://bucket/key')
+    parser.add_argument('--chunksize', type=int, default=1000000)
+    parser.add_argument('--rating-threshold', type=int, default=3)
+    parser.add_argument('--drop-invalid', action='store_true')
+    args = parser.parse_args()
+
+    rows = prepare_interactions(args.src, args.dest, chunksize=args.chunksize,
+                                rating_threshold=args.rating_threshold,
+                                on_invalid='drop' if args.drop_invalid else 'raise')
+    print("Wrote {} interactions to {}".format(rows, args.dest))
@@ -0,0 +1,381 @@
+"""
+Local item-to-item recommender from interaction co-occurrence.
+
+A fallback for when the campaign is throttled or slow, built from the same
+filtered u.data interactions the first notebook imports:
+
+- the users x items interactions are a binary CSR matrix X, and item
+  co-occurrence counts are the sparse product C = X.T X, whose diagonal is
+  each item's user count;
+- similarity is cosine, C[i, j] / sqrt(C[i, i] C[j, j]), and only the top
+  neighbours of every item are kept, as int32 ids and float32 similarities
+  in two (items, neighbours) arrays;
+- a user is scored by summing the neighbour similarities of the items in
+  their history with one bincount, so a request is a few array operations;
+- update() folds in new clicks by adding the change in C for the users
+  who clicked and re-ranking only the items whose rows changed, and
+  on_events_sent does it from an EventSender.
+
+get_recommendations takes the runtime client's arguments and returns its
+response shape, so the model can stand in for the campaign, and
+FallbackRecommendations serves it whenever the campaign call fails:
+
+    python item_cooccurrence.py ./ml-100k/u.data
+"""
+import argparse
+import json
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from botocore.exceptions import BotoCoreError, ClientError
+from scipy.sparse import csr_matrix
+
+from interaction_prep import iter_interactions
+
+DEFAULT_NEIGHBORS = 50
+# Catalogs up to this size are scored with a dense bincount over all items.
+DENSE_SCORING_MAX_ITEMS = 200000
+
+
+def _binary(matrix):
+    matrix.sum_duplicates()
+    matrix.eliminate_zeros()
+    matrix.data[:] = 1
+    return matrix
+
+
+def _grow(matrix, shape):
+    # CSR matrix padded to shape with empty rows and columns, sharing its arrays
+    rows = shape[0] - matrix.shape[0]
+    return csr_matrix((matrix.data, matrix.indices, np.append(matrix.indptr, [matrix.nnz] * rows)),
+                      shape=shape)
+
+
+def _top_neighbors(rows, items, counts, k):
+    # (len(items), k) neighbour ids (-1 padded) and cosine similarities, best
+    # first, from the CSR co-occurrence rows of items
+    ids = np.full((len(items), k), -1, dtype=np.int32)
+    sims = np.zeros((len(items), k), dtype=np.float32)
+    norms = np.sqrt(np.maximum(counts, 1)).astype(np.float32)
+    for n, item in enumerate(items):
+        lo, hi = rows.indptr[n], rows.indptr[n + 1]
+        cols = rows.indices[lo:hi]
+        scores = rows.data[lo:hi] / (norms[item] * norms[cols])
+        scores[cols == item] = 0
+        keep = scores > 0
+        cols, scores = cols[keep], scores[keep]
+        if len(cols) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            cols, scores = cols[best], scores[best]
+        order = np.argsort(-scores, kind='stable')
+        ids[n, :len(cols)] = cols[order]
+        sims[n, :len(cols)] = scores[order]
+    return ids, sims
+
+
+class CooccurrenceRecommender(object):
+    """
+    Item-to-item cosine model over (user, item) interactions. Ids are kept
+    as strings, like Personalize's. recommend() and get_recommendations()
+    may be called from many threads while update() runs; they only wait
+    for the brief moments when neighbour rows are being written.
+
+    Updates go to a small pending co-occurrence matrix and a per-user
+    overlay of histories, and only the neighbours of the clicked items and
+    of the users' earlier items are re-ranked. Once the pending matrix
+    holds compact_ratio times as many entries as the main one, compact()
+    merges them and re-ranks every item, which also refreshes similarities
+    that changed only through another item's count, and popularity.
+    """
+
+    name = 'item-cooccurrence'
+
+    def __init__(self, users, items, neighbors=DEFAULT_NEIGHBORS, compact_ratio=0.1):
+        self.k = neighbors
+        self.compact_ratio = compact_ratio
+        self._lock = threading.RLock()
+        # held while neighbors/similarities rows are written or read, so a
+        # reader never pairs new ids with old similarities
+        self._ranking_lock = threading.Lock()
+        user_codes, user_ids = pd.factorize(pd.Series(users).astype(str).values)
+        item_codes, item_ids = pd.factorize(pd.Series(items).astype(str).values)
+        self.user_ids, self.item_ids = pd.Index(user_ids), pd.Index(item_ids)
+        self.interactions = _binary(csr_matrix(
+            (np.ones(len(user_codes), dtype=np.float32), (user_codes, item_codes)),
+            shape=(len(self.user_ids), len(self.item_ids))))
+        self.cooccurrence = self.interactions.T.dot(self.interactions).tocsr()
+        self._pending = csr_matrix(self.cooccurrence.shape, dtype=np.float32)
+        # user code -> item codes, for users updated since the last compaction
+        self._recent = {}
+        self._rank_all()
+
+    @classmethod
+    def from_movielens(cls, path='./ml-100k/u.data', rating_threshold=3, neighbors=DEFAULT_NEIGHBORS, **kwargs):
+        """
+        Builds the model from the interactions iter_interactions keeps.
+        """
+        data = pd.concat(list(iter_interactions(path, rating_threshold=rating_threshold, **kwargs)))
+        return cls(data['USER_ID'].values, data['ITEM_ID'].values, neighbors=neighbors)
+
+    def __len__(self):
+        return len(self.item_ids)
+
+    def _rank_all(self):
+        self.counts = self.cooccurrence.diagonal()
+        neighbors, similarities = _top_neighbors(
+            self.cooccurrence, np.arange(self.cooccurrence.shape[0]), self.counts, self.k)
+        with self._ranking_lock:
+            self.neighbors, self.similarities = neighbors, similarities
+        self._popular = np.argsort(-self.counts, kind='stable')
+
+    def _codes(self, index, ids):
+        # codes of ids in index, appending the ones it does not have yet
+        ids = pd.Index(pd.Series(ids).astype(str).values)
+        new = ids[index.get_indexer(ids) < 0].unique()
+        if len(new):
+            index = index.append(new)
+        return index, index.get_indexer(ids)
+
+    def update(self, users, items):
+        """
+        Adds (user, item) clicks; unseen users and items are added too.
+        Returns the number of items whose neighbours were re-ranked.
+        """
+        if not len(users):
+            return 0
+        with self._lock:
+            self.user_ids, user_codes = self._codes(self.user_ids, users)
+            item_ids, item_codes = self._codes(self.item_ids, items)
+            n_items = len(item_ids)
+            grow = n_items - len(self.counts)
+            if grow:
+                self.cooccurrence = _grow(self.cooccurrence, (n_items, n_items))
+                self._pending = _grow(self._pending, (n_items, n_items))
+                self.counts = np.append(self.counts, np.zeros(grow, dtype=self.counts.dtype))
+                neighbors = np.vstack([self.neighbors, np.full((grow, self.k), -1, dtype=np.int32)])
+                similarities = np.vstack([self.similarities, np.zeros((grow, self.k), dtype=np.float32)])
+                with self._ranking_lock:
+                    self.neighbors, self.similarities = neighbors, similarities
+            # readers may see the new items only once they have rows
+            self.item_ids = item_ids
+
+            # C changes by new.T new - old.T old over the users who clicked
+            rows, local = np.unique(user_codes, return_inverse=True)
+            histories = [self._history(row) for row in rows]
+            indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+            np.cumsum([len(history) for history in histories], out=indptr[1:])
+            old = csr_matrix((np.ones(indptr[-1], dtype=np.float32),
+                              np.concatenate(histories).astype(np.int32), indptr), shape=(len(rows), n_items))
+            new = _binary(old + csr_matrix((np.ones(len(local), dtype=np.float32), (local, item_codes)),
+                                           shape=old.shape))
+            delta = (new.T.dot(new) - old.T.dot(old)).tocsr()
+            delta.eliminate_zeros()
+            if not delta.nnz:
+                return 0
+            for n, row in enumerate(rows):
+                self._recent[row] = new.indices[new.indptr[n]:new.indptr[n + 1]].copy()
+            self._pending = (self._pending + delta).tocsr()
+            self.counts = self.counts + delta.diagonal()
+
+            changed = np.flatnonzero(np.diff(delta.indptr))
+            neighbors, similarities = _top_neighbors(
+                (self.cooccurrence[changed] + self._pending[changed]).tocsr(), changed, self.counts, self.k)
+            with self._ranking_lock:
+                self.neighbors[changed], self.similarities[changed] = neighbors, similarities
+            if self._pending.nnz > self.compact_ratio * self.cooccurrence.nnz:
+                self.compact()
+            return len(changed)
+
+    def compact(self):
+        """
+        Merges the pending updates into the main matrices and re-ranks
+        every item.
+        """
+        with self._lock:
+            self.cooccurrence = (self.cooccurrence + self._pending).tocsr()
+            self._pending = csr_matrix(self.cooccurrence.shape, dtype=np.float32)
+            if self._recent:
+                rows = np.array(sorted(self._recent))
+                n_items = len(self.item_ids)
+                histories = [self._recent[row] for row in rows]
+                indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+                np.cumsum([len(history) for history in histories], out=indptr[1:])
+                updated = csr_matrix((np.ones(indptr[-1], dtype=np.float32), np.concatenate(histories), indptr),
+                                     shape=(len(rows), n_items))
+                interactions = _grow(self.interactions, (len(self.user_ids), n_items))
+                scatter = csr_matrix((np.ones(len(rows), dtype=np.float32), (rows, np.arange(len(rows)))),
+                                     shape=(len(self.user_ids), len(rows)))
+                self.interactions = _binary((interactions + scatter.dot(updated - interactions[rows])).tocsr())
+                self._recent = {}
+            self._rank_all()
+
+    def on_events_sent(self, user_id, session_id, events):
+        """
+        EventSender on_sent callback: adds the clicked items to the model.
+        """
+        items = [json.loads(event['properties']).get('itemId') for event in events]
+        items = [item for item in items if item is not None]
+        if items:
+            self.update([user_id] * len(items), items)
+
+    def history(self, user_id):
+        """
+        Item codes user_id has interacted with (empty for unknown users).
+        """
+        return self._history(self.user_ids.get_indexer([str(user_id)])[0])
+
+    def _history(self, row):
+        recent = self._recent.get(row)
+        if recent is not None:
+            return recent
+        interactions = self.interactions
+        if not 0 <= row < interactions.shape[0]:
+            return np.zeros(0, dtype=np.int32)
+        return interactions.indices[interactions.indptr[row]:interactions.indptr[row + 1]]
+
+    def score_items(self, item_codes, k, exclude=None):
+        """
+        (item codes, scores) of the k items most similar to item_codes in
+        total, best first, leaving out exclude (item codes). Padded with
+        the most popular items, scored 0, when there are too few neighbours.
+        """
+        with self._ranking_lock:
+            n_items = len(self.neighbors)
+            ids = self.neighbors[item_codes].ravel()
+            sims = self.similarities[item_codes].ravel()
+        found = ids >= 0
+        if n_items <= DENSE_SCORING_MAX_ITEMS:
+            scores = np.bincount(ids[found], weights=sims[found], minlength=n_items)
+            if exclude is not None and len(exclude):
+                scores[exclude[exclude >= 0]] = 0
+            candidates = np.flatnonzero(scores > 0)
+            scores = scores[candidates]
+        else:
+            candidates, inverse = np.unique(ids[found], return_inverse=True)
+            scores = np.bincount(inverse, weights=sims[found], minlength=len(candidates))
+            if exclude is not None and len(exclude):
+                keep = ~np.isin(candidates, exclude)
+                candidates, scores = candidates[keep], scores[keep]
+        if len(candidates) > k:
+            best = np.argpartition(-scores, k - 1)[:k]
+            candidates, scores = candidates[best], scores[best]
+        order = np.argsort(-scores, kind='stable')
+        candidates, scores = candidates[order], scores[order]
+        if len(candidates) < k:
+            popular = self._popular[:k + len(candidates) + (len(exclude) if exclude is not None else 0)]
+            popular = popular[~np.isin(popular, candidates)]
+            if exclude is not None and len(exclude):
+                popular = popular[~np.isin(popular, exclude)]
+            popular = popular[:k - len(candidates)]
+            candidates = np.concatenate([candidates, popular])
+            scores = np.concatenate([scores, np.zeros(len(popular))])
+        return candidates, scores
+
+    def recommend(self, user, k=25, exclude_seen=True):
+        """
+        Ids of the k best items for user's history; the most popular items
+        for users without one.
+        """
+        history = self.history(user)
+        # item_ids only grows, so read it after the codes it has to cover
+        codes = self.score_items(history, k, history if exclude_seen else None)[0]
+        return self.item_ids[codes].tolist()
+
+    def similar_items(self, item, k=25):
+        """
+        Ids of item's k nearest neighbours; the most popular items if it is unknown.
+        """
+        code = self.item_ids.get_indexer([str(item)])
+        codes = code[code >= 0]
+        codes = self.score_items(codes, k, codes)[0]
+        return self.item_ids[codes].tolist()
+
+    def get_recommendations(self, campaignArn=None, userId=None, itemId=None, numResults=25, **kwargs):
+        """
+        personalize-runtime get_recommendations response for userId (or,
+        like a SIMS campaign, for itemId). campaignArn and any other
+        arguments are ignored.
+        """
+        if userId is not None:
+            history = self.history(userId)
+            codes, scores = self.score_items(history, numResults, history)
+        else:
+            codes = self.item_ids.get_indexer([str(itemId)])
+            codes, scores = self.score_items(codes[codes >= 0], numResults, codes)
+        return {
+            'itemList': [{'itemId': item, 'score': float(score)}
+                         for item, score in zip(self.item_ids[codes], scores)],
+            'recommendationId': 'local-{}'.format(self.name),
+        }
+
+
+class FallbackRecommendations(object):
+    """
+    get_recommendations on primary (a runtime client or RecommendationCache),
+    answered by fallback (e.g. a CooccurrenceRecommender) when the call
+    fails: throttled after the client's retries, timed out or unreachable.
+    """
+
+    def __init__(self, primary, fallback, log=print):
+        self.primary = primary
+        self.fallback = fallback
+        self.log = log
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(('primary', 'fallback'), 0)
+
+    def get_recommendations(self, **kwargs):
+        try:
+            response = self.primary.get_recommendations(**kwargs)
+            source = 'primary'
+        except (ClientError, BotoCoreError) as e:
+            if self.log:
+                self.log("get_recommendations failed, serving the fallback: {}".format(e))
+            response = self.fallback.get_recommendations(**kwargs)
+            source = 'fallback'
+        with self._lock:
+            self._stats[source] += 1
+        return response
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+def _benchmark(path, rating_threshold, neighbors, k, users):
+    from rec_benchmark import PopularityBackend, movielens_holdout, run_benchmark
+
+    train, holdout = movielens_holdout(path, rating_threshold=rating_threshold)
+    start = time.time()
+    model = CooccurrenceRecommender(train['USER_ID'].values, train['ITEM_ID'].values, neighbors=neighbors)
+    print("Built {} items x {} neighbours from {} interactions in {:.2f}s".format(
+        len(model), model.k, len(train), time.time() - start))
+
+    for backend in (model, PopularityBackend(train['ITEM_ID'])):
+        run_benchmark(backend, holdout, k=k, catalog_size=len(model), max_users=users)
+
+    latencies = []
+    for user in list(holdout)[:users]:
+        start = time.time()
+        model.get_recommendations(userId=user, numResults=k)
+        latencies.append((time.time() - start) * 1000)
+    print("get_recommendations: p50 {:.3f} ms, p99 {:.3f} ms".format(*np.percentile(latencies, [50, 99])))
+
+    rng = np.random.RandomState(0)
+    clicks = list(zip(rng.choice(train['USER_ID'].values, 1000), rng.choice(train['ITEM_ID'].values, 1000)))
+    start = time.time()
+    for user, item in clicks:
+        model.update([user], [item])
+    print("update: {:.2f} ms per click".format((time.time() - start) * 1000 / len(clicks)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Build and benchmark the item co-occurrence fallback recommender')
+    parser.add_argument('data', nargs='?', default='./ml-100k/u.data', help='u.data-style interactions')
+    parser.add_argument('--rating-threshold', type=int, default=3)
+    parser.add_argument('--neighbors', type=int, default=DEFAULT_NEIGHBORS)
+    parser.add_argument('-k', type=int, default=25)
+    parser.add_argument('--users', type=int, default=1000)
+    args = parser.parse_args()
+    _benchmark(args.data, args.rating_threshold, args.neighbors, args.k, args.users)
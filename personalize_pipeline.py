@@ -0,0 +1,369 @@
+"""
+Dependency-aware runner for the Amazon Personalize provisioning steps.
+
+The first notebook creates the schema, dataset group, dataset, bucket policy,
+IAM role, import job, solution, solution version and campaign one after
+another. Here each step declares what it needs, independent steps run
+concurrently on a thread pool, and the ARNs each step produces are
+checkpointed to a local JSON state file so a rerun resumes instead of
+recreating resources. A step checkpoints its ARN as soon as the create call
+returns, so a step that fails while waiting for its resource only waits
+for it on the rerun.
+
+Run the whole pipeline with:
+
+    python personalize_pipeline.py --bucket <your-bucket>
+"""
+import argparse
+import functools
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from aws_clients import get_client
+from interaction_prep import INTERACTIONS_SCHEMA, prepare_interactions
+from personalize_waiter import wait_for_resource
+
+# state file key for outputs checkpointed by steps that have not finished
+PARTIAL = '_partial'
+
+
+class PipelineError(Exception):
+    pass
+
+
+class Step(object):
+    """
+    A named unit of work. func(context) returns a dict of outputs (usually
+    ARNs) that are merged into the context seen by dependent steps.
+
+    func may call context['checkpoint'](outputs) to save outputs before it
+    finishes, e.g. a resource it created and is about to wait for; if the
+    step fails, the next run passes them back in its context.
+    """
+
+    def __init__(self, name, func, requires=()):
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+
+
+class Pipeline(object):
+
+    def __init__(self, steps, state_file='personalize_state.json', max_workers=4, log=print):
+        self.steps = dict((step.name, step) for step in steps)
+        if len(self.steps) != len(steps):
+            raise ValueError("Step names must be unique")
+        for step in steps:
+            for name in step.requires:
+                if name not in self.steps:
+                    raise ValueError("Step {} requires unknown step {}".format(step.name, name))
+        self._check_acyclic()
+        self.state_file = state_file
+        self.max_workers = max_workers
+        self.log = log
+        self.timings = []
+        self._lock = threading.Lock()
+
+    def _check_acyclic(self):
+        visiting, visited = set(), set()
+
+        def visit(name):
+            if name in visited:
+                return
+            if name in visiting:
+                raise ValueError("Dependency cycle through step {}".format(name))
+            visiting.add(name)
+            for dep in self.steps[name].requires:
+                visit(dep)
+            visiting.discard(name)
+            visited.add(name)
+
+        for name in self.steps:
+            visit(name)
+
+    def load_state(self):
+        if self.state_file and os.path.exists(self.state_file):
+            with open(self.state_file) as f:
+                return json.load(f)
+        return {}
+
+    def _save_state(self, state):
+        if not self.state_file:
+            return
+        tmp = self.state_file + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(state, f, indent=2, sort_keys=True)
+        os.replace(tmp, self.state_file)
+
+    def run(self, context=None):
+        """
+        Runs every step not already recorded in the state file and returns
+        the merged context. Raises PipelineError after in-flight steps finish
+        if any step fails; completed steps stay checkpointed.
+        """
+        context = dict(context or {})
+        state = self.load_state()
+        for name, outputs in state.items():
+            if name in self.steps:
+                context.update(outputs)
+
+        start = time.time()
+        self.timings = [(name, 0.0, 0.0, 'resumed') for name in self.steps if name in state]
+        done = set(name for name in self.steps if name in state)
+        remaining = set(self.steps) - done
+        running = {}
+        errors = []
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while remaining or running:
+                if not errors:
+                    ready = [name for name in sorted(remaining)
+                             if all(dep in done for dep in self.steps[name].requires)]
+                    for name in ready:
+                        remaining.discard(name)
+                        with self._lock:
+                            step_context = dict(context, **state.get(PARTIAL, {}).get(name, {}))
+                        step_context['checkpoint'] = functools.partial(self._checkpoint, state, name)
+                        running[pool.submit(self._run_step, self.steps[name], step_context, start)] = name
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    name = running.pop(future)
+                    try:
+                        outputs = future.result()
+                    except Exception as e:
+                        errors.append((name, e))
+                        continue
+                    with self._lock:
+                        context.update(outputs)
+                        state[name] = outputs
+                        state.get(PARTIAL, {}).pop(name, None)
+                        if PARTIAL in state and not state[PARTIAL]:
+                            del state[PARTIAL]
+                        self._save_state(state)
+                    done.add(name)
+
+        self.print_timings(time.time() - start)
+        if errors:
+            name, error = errors[0]
+            raise PipelineError("Step {} failed: {}".format(name, error))
+        return context
+
+    def _checkpoint(self, state, name, outputs):
+        with self._lock:
+            state.setdefault(PARTIAL, {}).setdefault(name, {}).update(outputs)
+            self._save_state(state)
+
+    def _run_step(self, step, context, start):
+        began = time.time()
+        if self.log:
+            self.log("[{}] started".format(step.name))
+        try:
+            outputs = step.func(context) or {}
+        except Exception:
+            self._record(step.name, began - start, time.time() - began, 'failed')
+            raise
+        self._record(step.name, began - start, time.time() - began, 'ok')
+        if self.log:
+            self.log("[{}] finished in {:.1f}s".format(step.name, time.time() - began))
+        return outputs
+
+    def _record(self, name, offset, duration, result):
+        with self._lock:
+            self.timings.append((name, offset, duration, result))
+
+    def print_timings(self, total):
+        if not self.log:
+            return
+        self.log("{:<24}{:>12}{:>14}  {}".format('step', 'start (s)', 'duration (s)', 'result'))
+        for name, offset, duration, result in sorted(self.timings, key=lambda t: t[1]):
+            self.log("{:<24}{:>12.1f}{:>14.1f}  {}".format(name, offset, duration, result))
+        self.log("Total wall-clock time: {:.1f}s".format(total))
+
+
+def build_personalize_pipeline(bucket, filename='movie-lens-100k.csv',
+                               data_path='./ml-100k/u.data',
+                               schema_name='personalize-demo-schema1',
+                               dataset_group_name='personalize-launch-demo1',
+                               dataset_name='personalize-launch-interactions',
+                               role_name='PersonalizeRoleDemo',
+                               import_job_name='personalize-demo-import1',
+                               solution_name='personalize-demo-soln-hrnn',
+                               recipe_arn='arn:aws:personalize:::recipe/aws-hrnn',
+                               campaign_name='personalize-demo-camp2',
+                               min_provisioned_tps=1,
+                               role_propagation_delay=60,
+                               personalize=None, s3=None, iam=None,
+                               **pipeline_kwargs):
+    """
+    Returns a Pipeline with the same steps and names as
+    Building_my_First_Campaign. The IAM role, bucket policy and S3 upload
+    run alongside the schema and dataset group creation.
+    """
+    personalize = personalize or get_client('personalize')
+    s3 = s3 or get_client('s3')
+    iam = iam or get_client('iam')
+
+    def created(ctx, key, create):
+        # ctx[key] if an earlier run of this step created it; otherwise
+        # create() it and checkpoint it before the step waits on it
+        if key not in ctx:
+            ctx[key] = create()
+            ctx['checkpoint']({key: ctx[key]})
+        return ctx[key]
+
+    def create_schema(ctx):
+        response = personalize.create_schema(
+            name=schema_name,
+            schema=json.dumps(INTERACTIONS_SCHEMA)
+        )
+        return {'schema_arn': response['schemaArn']}
+
+    def create_dataset_group(ctx):
+        arn = created(ctx, 'dataset_group_arn', lambda: personalize.create_dataset_group(
+            name=dataset_group_name)['datasetGroupArn'])
+        wait_for_resource(personalize, 'dataset_group', arn)
+        return {'dataset_group_arn': arn}
+
+    def create_dataset(ctx):
+        arn = created(ctx, 'dataset_arn', lambda: personalize.create_dataset(
+            name=dataset_name,
+            datasetType='INTERACTIONS',
+            datasetGroupArn=ctx['dataset_group_arn'],
+            schemaArn=ctx['schema_arn']
+        )['datasetArn'])
+        # the import job needs the dataset ACTIVE
+        wait_for_resource(personalize, 'dataset', arn)
+        return {'dataset_arn': arn}
+
+    def upload_interactions(ctx):
+        data_location = 's3://{}/{}'.format(bucket, filename)
+        prepare_interactions(data_path, data_location, s3=s3)
+        return {'data_location': data_location}
+
+    def attach_bucket_policy(ctx):
+        policy = {
+            "Version": "2012-10-17",
+            "Id": "PersonalizeS3BucketAccessPolicy",
+            "Statement": [
+                {
+                    "Sid": "PersonalizeS3BucketAccessPolicy",
+                    "Effect": "Allow",
+                    "Principal": {
+                        "Service": "personalize.amazonaws.com"
+                    },
+                    "Action": [
+                        "s3:GetObject",
+                        "s3:ListBucket"
+                    ],
+                    "Resource": [
+                        "arn:aws:s3:::{}".format(bucket),
+                        "arn:aws:s3:::{}/*".format(bucket)
+                    ]
+                }
+            ]
+        }
+        s3.put_bucket_policy(Bucket=bucket, Policy=json.dumps(policy))
+        return {'bucket_policy': bucket}
+
+    def create_role(ctx):
+        assume_role_policy_document = {
+            "Version": "2012-10-17",
+            "Statement": [
+                {
+                    "Effect": "Allow",
+                    "Principal": {
+                        "Service": "personalize.amazonaws.com"
+                    },
+                    "Action": "sts:AssumeRole"
+                }
+            ]
+        }
+        arn = created(ctx, 'role_arn', lambda: iam.create_role(
+            RoleName=role_name,
+            AssumeRolePolicyDocument=json.dumps(assume_role_policy_document)
+        )['Role']['Arn'])
+        iam.attach_role_policy(
+            RoleName=role_name,
+            PolicyArn="arn:aws:iam::aws:policy/service-role/AmazonPersonalizeFullAccess"
+        )
+        iam.attach_role_policy(
+            RoleName=role_name,
+            PolicyArn='arn:aws:iam::aws:policy/AmazonS3FullAccess'
+        )
+        iam.get_waiter('role_exists').wait(RoleName=role_name)
+        # Policy attachment has no status to poll; this overlaps with the
+        # dataset group wait instead of blocking the whole notebook.
+        time.sleep(role_propagation_delay)
+        return {'role_arn': arn}
+
+    def create_import_job(ctx):
+        arn = created(ctx, 'dataset_import_job_arn', lambda: personalize.create_dataset_import_job(
+            jobName=import_job_name,
+            datasetArn=ctx['dataset_arn'],
+            dataSource={
+                "dataLocation": ctx['data_location']
+            },
+            roleArn=ctx['role_arn']
+        )['datasetImportJobArn'])
+        wait_for_resource(personalize, 'dataset_import_job', arn)
+        return {'dataset_import_job_arn': arn}
+
+    def create_solution(ctx):
+        response = personalize.create_solution(
+            name=solution_name,
+            datasetGroupArn=ctx['dataset_group_arn'],
+            recipeArn=recipe_arn
+        )
+        return {'solution_arn': response['solutionArn']}
+
+    def create_solution_version(ctx):
+        arn = created(ctx, 'solution_version_arn', lambda: personalize.create_solution_version(
+            solutionArn=ctx['solution_arn'])['solutionVersionArn'])
+        wait_for_resource(personalize, 'solution_version', arn)
+        return {'solution_version_arn': arn}
+
+    def create_campaign(ctx):
+        arn = created(ctx, 'campaign_arn', lambda: personalize.create_campaign(
+            name=campaign_name,
+            solutionVersionArn=ctx['solution_version_arn'],
+            minProvisionedTPS=min_provisioned_tps
+        )['campaignArn'])
+        wait_for_resource(personalize, 'campaign', arn)
+        return {'campaign_arn': arn}
+
+    steps = [
+        Step('schema', create_schema),
+        Step('dataset_group', create_dataset_group),
+        Step('dataset', create_dataset, requires=['schema', 'dataset_group']),
+        Step('upload', upload_interactions),
+        Step('bucket_policy', attach_bucket_policy),
+        Step('iam_role', create_role),
+        Step('import_job', create_import_job,
+             requires=['dataset', 'upload', 'bucket_policy', 'iam_role']),
+        Step('solution', create_solution, requires=['import_job']),
+        Step('solution_version', create_solution_version, requires=['solution']),
+        Step('campaign', create_campaign, requires=['solution_version']),
+    ]
+    return Pipeline(steps, **pipeline_kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--bucket', required=True)
+    parser.add_argument('--filename', default='movie-lens-100k.csv')
+    parser.add_argument('--state-file', default='personalize_state.json')
+    parser.add_argument('--max-workers', type=int, default=4)
+    args = parser.parse_args()
+
+    pipeline = build_personalize_pipeline(args.bucket, filename=args.filename,
+                                          state_file=args.state_file,
+                                          max_workers=args.max_workers)
+    result = pipeline.run()
+    for key in sorted(result):
+        print("{}: {}".format(key, result[key]))
@@ -0,0 +1,293 @@
+"""
+Local HTTP stand-in for the Personalize Events API, GetRecommendations and
+the parts of the Personalize control plane that cleanup needs.
+
+Point a boto3 client at it with PersonalizeStub.client() to benchmark the
+notebook code paths without an AWS account. Latency and throttling are
+configurable so it can mimic a campaign's provisioned capacity.
+
+Control-plane resources are registered with add_resource and support the
+List*, Describe* and Delete* calls. A deleted resource reports DELETE
+PENDING for delete_delay seconds before describe raises
+ResourceNotFoundException, and deleting a resource that others still
+reference raises ResourceInUseException, as Personalize does.
+
+GetRecommendations answers any campaign with numResults items from catalog,
+chosen deterministically from the user's events that the stub has received
+at least update_delay seconds earlier, so recommendations change a while
+after an event is sent, like a campaign picking up real-time events. With
+event_tps or recommendation_tps set, calls beyond that many per second are
+throttled, like a campaign's provisioned TPS.
+"""
+import json
+import random
+import threading
+import time
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:  # Python < 3.7
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+    class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+import boto3
+from botocore.config import Config
+
+# kind -> (operation suffix, list response key, parent ARN field)
+CONTROL_PLANE = {
+    'dataset_group': ('DatasetGroup', 'datasetGroups', None),
+    'dataset': ('Dataset', 'datasets', 'datasetGroupArn'),
+    'schema': ('Schema', 'schemas', None),
+    'solution': ('Solution', 'solutions', 'datasetGroupArn'),
+    'campaign': ('Campaign', 'campaigns', 'solutionArn'),
+    'event_tracker': ('EventTracker', 'eventTrackers', 'datasetGroupArn'),
+    'filter': ('Filter', 'Filters', 'datasetGroupArn'),
+}
+_OPERATIONS = dict((prefix + suffix + ('s' if prefix == 'List' else ''), (prefix, kind))
+                   for kind, (suffix, _, _) in CONTROL_PLANE.items()
+                   for prefix in ('List', 'Describe', 'Delete'))
+
+
+def _camel(kind):
+    head, _, rest = kind.partition('_')
+    return head + ''.join(word.title() for word in rest.split('_') if word)
+
+
+class _Server(ThreadingHTTPServer):
+    daemon_threads = True
+    # the default backlog of 5 drops connections under a few dozen threads
+    request_queue_size = 128
+
+
+class StubError(Exception):
+
+    def __init__(self, error_type, message):
+        super(StubError, self).__init__(message)
+        self.error_type = error_type
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if stub.latency:
+            time.sleep(stub.latency)
+
+        path = self.path.rstrip('/')
+        if ((stub.throttle_rate and random.random() < stub.throttle_rate) or
+                not stub.admit(path)):
+            with stub.lock:
+                stub.throttled += 1
+            self._reply(400, {'__type': 'ThrottlingException', 'message': 'Rate exceeded'},
+                        error_type='ThrottlingException')
+            return
+
+        target = self.headers.get('X-Amz-Target', '')
+        if target.startswith('AmazonPersonalize.'):
+            try:
+                payload = stub.control(target.split('.', 1)[1], json.loads(body.decode('utf-8') or '{}'))
+            except StubError as e:
+                self._reply(400, {'__type': e.error_type, 'message': str(e)}, error_type=e.error_type)
+                return
+            self._reply(200, payload)
+        elif path == '/events':
+            stub.put_events(json.loads(body.decode('utf-8') or '{}'))
+            self._reply(200, {})
+        elif path == '/recommendations':
+            self._reply(200, stub.recommend(json.loads(body.decode('utf-8') or '{}')))
+        else:
+            self._reply(404, {'__type': 'ResourceNotFoundException', 'message': self.path},
+                        error_type='ResourceNotFoundException')
+
+    def _reply(self, status, payload, error_type=None):
+        data = json.dumps(payload).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        if error_type:
+            self.send_header('x-amzn-ErrorType', error_type)
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class PersonalizeStub(object):
+    """
+    Threaded local server that accepts PutEvents and GetRecommendations
+    calls.
+
+    latency is added to every request in seconds, and throttle_rate is the
+    fraction of requests answered with a ThrottlingException. event_tps and
+    recommendation_tps cap the PutEvents and GetRecommendations calls
+    accepted per second. Events affect recommendations update_delay seconds
+    after they arrive, and control-plane deletes take delete_delay seconds
+    to complete.
+    """
+
+    def __init__(self, latency=0.0, throttle_rate=0.0, host='127.0.0.1', port=0, delete_delay=0.0,
+                 update_delay=0.0, event_tps=None, recommendation_tps=None, catalog=None):
+        self.latency = latency
+        self.throttle_rate = throttle_rate
+        self.delete_delay = delete_delay
+        self.update_delay = update_delay
+        self.capacity = {'/events': event_tps, '/recommendations': recommendation_tps}
+        self.catalog = [str(item) for item in catalog] if catalog is not None else \
+            [str(item) for item in range(1, 1683)]
+        self.resources = {}
+        self.deleted = []
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.throttled = 0
+        self.events = []
+        self.user_events = {}
+        self._windows = {}
+        self._server = _Server((host, port), _Handler)
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def endpoint_url(self):
+        host, port = self._server.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def admit(self, path):
+        """
+        Counts a call against path's per-second capacity; False if it is
+        over capacity and should be throttled.
+        """
+        tps = self.capacity.get(path)
+        if not tps:
+            return True
+        second = int(time.time())
+        with self.lock:
+            window = self._windows.get(path)
+            if window is None or window[0] != second:
+                window = self._windows[path] = [second, 0]
+            window[1] += 1
+            return window[1] <= tps
+
+    def put_events(self, request):
+        received = time.time()
+        user_id = request.get('userId')
+        with self.lock:
+            self.calls += 1
+            history = self.user_events.setdefault(user_id, [])
+            for event in request.get('eventList', []):
+                self.events.append((user_id, request.get('sessionId'), event))
+                item_id = json.loads(event.get('properties') or '{}').get('itemId')
+                history.append((received, item_id))
+
+    def recommend(self, request):
+        """
+        GetRecommendations response for request: a function of the user's
+        visible events, so it only changes when one becomes visible.
+        """
+        user_id = request.get('userId')
+        cutoff = time.time() - self.update_delay
+        with self.lock:
+            self.calls += 1
+            visible = [item for received, item in self.user_events.get(user_id, ()) if received <= cutoff]
+        seed = '{}:{}:{}'.format(user_id, len(visible), visible[-1] if visible else '')
+        items = random.Random(seed).sample(self.catalog, min(int(request.get('numResults') or 25),
+                                                             len(self.catalog)))
+        return {'itemList': [{'itemId': item} for item in items],
+                'recommendationId': 'RID-{}'.format(abs(hash(seed)))}
+
+    def add_resource(self, kind, arn, status='ACTIVE', **fields):
+        """
+        Registers a control-plane resource. fields are returned by describe
+        and list, and should include the parent ARN (e.g. datasetGroupArn
+        for a dataset, solutionArn for a campaign) and a dataset's
+        schemaArn.
+        """
+        if kind not in CONTROL_PLANE:
+            raise ValueError("Unknown resource kind: {}".format(kind))
+        resource = dict(fields, status=status)
+        resource[_camel(kind) + 'Arn'] = arn
+        with self.lock:
+            self.resources[arn] = (kind, resource, None)
+        return arn
+
+    def _expire(self):
+        # Drops resources whose deletion has completed; call with the lock held.
+        now = time.time()
+        for arn, (kind, _, gone_at) in list(self.resources.items()):
+            if gone_at is not None and gone_at <= now:
+                del self.resources[arn]
+                self.deleted.append((kind, arn))
+
+    def control(self, operation, request):
+        """
+        Answers one control-plane call; raises StubError for AWS errors.
+        """
+        if operation not in _OPERATIONS:
+            raise StubError('UnknownOperationException', operation)
+        prefix, kind = _OPERATIONS[operation]
+        _, list_key, parent_field = CONTROL_PLANE[kind]
+        with self.lock:
+            self.calls += 1
+            self._expire()
+            if prefix == 'List':
+                matches = [dict(resource) for k, resource, _ in self.resources.values()
+                           if k == kind and (not parent_field or not request.get(parent_field) or
+                                             resource.get(parent_field) == request[parent_field])]
+                start = int(request.get('nextToken') or 0)
+                end = start + int(request.get('maxResults') or 100)
+                response = {list_key: matches[start:end]}
+                if end < len(matches):
+                    response['nextToken'] = str(end)
+                return response
+
+            arn = request.get(_camel(kind) + 'Arn')
+            if arn not in self.resources:
+                raise StubError('ResourceNotFoundException', '{} not found'.format(arn))
+            _, resource, gone_at = self.resources[arn]
+            if prefix == 'Describe':
+                return {_camel(kind): dict(resource)}
+            if gone_at is not None:
+                raise StubError('ResourceInUseException', '{} is already being deleted'.format(arn))
+            users = [other for other, (_, fields, _) in self.resources.items()
+                     if arn in fields.values() and other != arn]
+            if users:
+                raise StubError('ResourceInUseException', '{} is used by {}'.format(arn, users[0]))
+            if kind == 'schema':
+                del self.resources[arn]
+                self.deleted.append((kind, arn))
+            else:
+                resource['status'] = 'DELETE PENDING'
+                self.resources[arn] = (kind, resource, time.time() + self.delete_delay)
+            return {}
+
+    def client(self, service_name='personalize-events', max_pool_connections=50):
+        """
+        Returns a boto3 client for service_name that talks to this stub,
+        with botocore retries disabled so callers see every throttle.
+        """
+        return boto3.client(
+            service_name,
+            endpoint_url=self.endpoint_url,
+            region_name='us-east-1',
+            aws_access_key_id='stub',
+            aws_secret_access_key='stub',
+            config=Config(retries={'max_attempts': 0}, max_pool_connections=max_pool_connections))
@@ -0,0 +1,185 @@
+"""
+Dependency-aware teardown of an Amazon Personalize dataset group.
+
+Cleanup.ipynb deleted hardcoded ARNs one at a time with a fixed minute of
+sleep after each, then tried to delete every schema in the account. Here the
+resources are discovered from the dataset group ARN and deleted in stages
+that run on personalize_pipeline's scheduler, so stages that do not depend
+on each other run concurrently:
+
+    campaigns                          -> solutions (and their versions)
+    solutions, event trackers, filters -> datasets (and their import jobs)
+    datasets                           -> the datasets' schemas, dataset group
+
+Each stage issues its deletes and then polls them together with
+wait_for_deletion, so a stage ends as soon as its slowest resource is
+gone. Schemas still used by another dataset group are kept. Try it without
+an AWS account against PersonalizeStub(delete_delay=...).client('personalize'),
+or run it with:
+
+    python personalize_teardown.py <dataset-group-arn> [--dry-run]
+"""
+import argparse
+import threading
+import time
+from collections import OrderedDict
+
+from aws_clients import get_client
+from personalize_pipeline import Pipeline, Step
+from personalize_waiter import Backoff, RESOURCES, error_code, wait_for_deletion
+
+# (kind, stage, stages that must finish first), in the order resources are listed.
+STAGES = [
+    ('campaign', 'campaigns', ()),
+    ('event_tracker', 'event_trackers', ()),
+    ('filter', 'filters', ()),
+    ('solution', 'solutions', ('campaigns',)),
+    ('dataset', 'datasets', ('solutions', 'event_trackers', 'filters')),
+    ('schema', 'schemas', ('datasets',)),
+    ('dataset_group', 'dataset_group', ('datasets',)),
+]
+
+
+def _list(client, operation, key, **kwargs):
+    # Follows nextToken through every page of a List* call.
+    items = []
+    while True:
+        response = getattr(client, operation)(**kwargs)
+        items.extend(response.get(key, []))
+        if not response.get('nextToken'):
+            return items
+        kwargs['nextToken'] = response['nextToken']
+
+
+def find_resources(client, dataset_group_arn):
+    """
+    OrderedDict of kind -> ARNs of everything in the dataset group, plus
+    the schemas its datasets use, in STAGES order.
+    """
+    group = {'datasetGroupArn': dataset_group_arn}
+    solutions = [s['solutionArn'] for s in _list(client, 'list_solutions', 'solutions', **group)]
+    datasets = [d['datasetArn'] for d in _list(client, 'list_datasets', 'datasets', **group)]
+    schemas = []
+    for arn in datasets:
+        schema = client.describe_dataset(datasetArn=arn)['dataset'].get('schemaArn')
+        if schema and schema not in schemas:
+            schemas.append(schema)
+    found = {
+        'campaign': [c['campaignArn'] for solution in solutions
+                     for c in _list(client, 'list_campaigns', 'campaigns', solutionArn=solution)],
+        'event_tracker': [e['eventTrackerArn'] for e in
+                          _list(client, 'list_event_trackers', 'eventTrackers', **group)],
+        'filter': [f['filterArn'] for f in _list(client, 'list_filters', 'Filters', **group)],
+        'solution': solutions,
+        'dataset': datasets,
+        'schema': schemas,
+        'dataset_group': [dataset_group_arn],
+    }
+    return OrderedDict((kind, found[kind]) for kind, _, _ in STAGES)
+
+
+class Teardown(object):
+    """
+    Deletes everything find_resources reports for a dataset group. After
+    run(), results holds one (kind, arn, result, seconds) tuple per
+    resource, where result is 'deleted', 'not found' or 'in use' (schemas
+    shared with another dataset group), and seconds runs from the delete
+    call until the resource was gone.
+    """
+
+    def __init__(self, client, dataset_group_arn, max_workers=4, timeout=60*60,
+                 backoff=None, log=print):
+        self.client = client
+        self.dataset_group_arn = dataset_group_arn
+        self.max_workers = max_workers
+        self.timeout = timeout
+        self.backoff = backoff or Backoff(initial_delay=2, max_delay=30)
+        self.log = log
+        self.resources = None
+        self.results = []
+        self._lock = threading.Lock()
+
+    def plan(self):
+        self.resources = find_resources(self.client, self.dataset_group_arn)
+        return self.resources
+
+    def run(self):
+        """
+        Deletes the planned resources (planning first if needed) and returns
+        results. Raises personalize_pipeline.PipelineError if a stage fails;
+        stages that depend on it are not started.
+        """
+        resources = self.resources or self.plan()
+        steps = [Step(stage, self._stage(kind, resources[kind]), requires)
+                 for kind, stage, requires in STAGES]
+        Pipeline(steps, state_file=None, max_workers=self.max_workers, log=self.log).run()
+        self.print_results()
+        return self.results
+
+    def _stage(self, kind, arns):
+        def delete(ctx):
+            pending = {}
+            for arn in arns:
+                started = time.time()
+                result = self._delete(kind, arn)
+                if result == 'deleted' and kind in RESOURCES:
+                    pending[arn] = started
+                else:
+                    self._record(kind, arn, result, time.time() - started)
+            if pending:
+                wait_for_deletion(self.client, [(kind, arn) for arn in pending], timeout=self.timeout,
+                                  backoff=self.backoff, log=None)
+                for arn, started in pending.items():
+                    self._record(kind, arn, 'deleted', time.time() - started)
+            return {}
+        return delete
+
+    def _delete(self, kind, arn):
+        arn_param = _camel(kind) + 'Arn'
+        try:
+            getattr(self.client, 'delete_' + kind)(**{arn_param: arn})
+        except Exception as e:
+            code = error_code(e)
+            if code == 'ResourceNotFoundException':
+                return 'not found'
+            if code == 'ResourceInUseException' and kind == 'schema':
+                return 'in use'
+            raise
+        return 'deleted'
+
+    def _record(self, kind, arn, result, seconds):
+        with self._lock:
+            self.results.append((kind, arn, result, seconds))
+
+    def print_results(self):
+        if not self.log:
+            return
+        for kind, arn, result, seconds in self.results:
+            self.log("{:<14}{:<10}{:>8.1f}s  {}".format(kind, result, seconds, arn))
+
+
+def _camel(kind):
+    head, _, rest = kind.partition('_')
+    return head + ''.join(word.title() for word in rest.split('_') if word)
+
+
+def teardown_dataset_group(client, dataset_group_arn, **kwargs):
+    """
+    Deletes a dataset group and everything in it; see Teardown.
+    """
+    return Teardown(client, dataset_group_arn, **kwargs).run()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Delete a Personalize dataset group and everything in it')
+    parser.add_argument('dataset_group_arn')
+    parser.add_argument('--dry-run', action='store_true', help='only list what would be deleted')
+    parser.add_argument('--max-workers', type=int, default=4)
+    args = parser.parse_args()
+
+    teardown = Teardown(get_client('personalize'), args.dataset_group_arn, max_workers=args.max_workers)
+    for kind, arns in teardown.plan().items():
+        for arn in arns:
+            print("{:<14}{}".format(kind, arn))
+    if not args.dry_run:
+        teardown.run()
@@ -0,0 +1,210 @@
+"""
+Waiters for Amazon Personalize resources.
+
+Polls the matching ``describe_*`` call with exponential backoff and jitter
+until a resource reaches a terminal state, instead of sleeping a fixed minute
+between checks. Several ARNs can be waited on together so the caller returns
+as soon as the slowest one is ready. wait_for_deletion polls the same way
+until describe reports the resource as not found.
+"""
+import random
+import time
+
+
+def _status(key):
+    def extract(response):
+        return response[key]['status']
+    return extract
+
+
+def _campaign_status(response):
+    # An update to an ACTIVE campaign is tracked on latestCampaignUpdate.
+    campaign = response['campaign']
+    update = campaign.get('latestCampaignUpdate')
+    if campaign['status'] == 'ACTIVE' and update:
+        return update['status']
+    return campaign['status']
+
+
+# kind -> (describe operation, ARN parameter, status extractor, log label)
+RESOURCES = {
+    'dataset_group': ('describe_dataset_group', 'datasetGroupArn',
+                      _status('datasetGroup'), 'DatasetGroup'),
+    'dataset': ('describe_dataset', 'datasetArn',
+                _status('dataset'), 'Dataset'),
+    'dataset_import_job': ('describe_dataset_import_job', 'datasetImportJobArn',
+                           _status('datasetImportJob'), 'DatasetImportJob'),
+    'solution': ('describe_solution', 'solutionArn',
+                 _status('solution'), 'Solution'),
+    'solution_version': ('describe_solution_version', 'solutionVersionArn',
+                         _status('solutionVersion'), 'SolutionVersion'),
+    'campaign': ('describe_campaign', 'campaignArn',
+                 _campaign_status, 'Campaign'),
+    'event_tracker': ('describe_event_tracker', 'eventTrackerArn',
+                      _status('eventTracker'), 'EventTracker'),
+    'filter': ('describe_filter', 'filterArn',
+               _status('filter'), 'Filter'),
+}
+
+SUCCESS_STATES = ('ACTIVE',)
+FAILURE_STATES = ('CREATE FAILED', 'DELETE FAILED', 'UPDATE FAILED')
+# Reported by _Poll.describe once the resource no longer exists.
+DELETED = 'DELETED'
+
+
+def normalize_status(status):
+    """
+    Personalize reports "CREATE FAILED" but "CREATE IN_PROGRESS";
+    fold underscores to spaces so both spellings compare equal.
+    """
+    return status.replace('_', ' ').upper()
+
+
+class WaiterError(Exception):
+    def __init__(self, message, arn=None, status=None):
+        super(WaiterError, self).__init__(message)
+        self.arn = arn
+        self.status = status
+
+
+class ResourceFailedError(WaiterError):
+    pass
+
+
+class WaiterTimeoutError(WaiterError):
+    pass
+
+
+class Backoff(object):
+    """
+    Exponential backoff schedule with jitter, capped at max_delay seconds.
+    """
+
+    def __init__(self, initial_delay=5, max_delay=60, factor=2, jitter=0.5):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.factor = factor
+        self.jitter = jitter
+
+    def delay(self, attempt):
+        delay = min(self.max_delay, self.initial_delay * self.factor ** attempt)
+        return random.uniform(delay * (1 - self.jitter), delay)
+
+
+def error_code(error):
+    """
+    AWS error code of a botocore ClientError, or None for other exceptions.
+    """
+    return getattr(error, 'response', {}).get('Error', {}).get('Code')
+
+
+class _Poll(object):
+
+    def __init__(self, kind, arn):
+        if kind not in RESOURCES:
+            raise ValueError("Unknown resource kind: {}".format(kind))
+        self.kind = kind
+        self.arn = arn
+        self.attempt = 0
+        self.next_poll = 0
+        self.status = None
+        self.response = None
+
+    def describe(self, client):
+        operation, arn_param, extract, _ = RESOURCES[self.kind]
+        try:
+            self.response = getattr(client, operation)(**{arn_param: self.arn})
+        except Exception as e:
+            if error_code(e) != 'ResourceNotFoundException':
+                raise
+            self.response = {}
+            self.status = DELETED
+            return self.status
+        self.status = normalize_status(extract(self.response))
+        return self.status
+
+    @property
+    def label(self):
+        return RESOURCES[self.kind][3]
+
+
+def wait_for_resources(client, resources, timeout=3*60*60, backoff=None,
+                       log=print, sleep=time.sleep, clock=time.time):
+    """
+    Waits until every (kind, arn) pair in resources is ACTIVE.
+
+    Each ARN keeps its own backoff schedule, and the loop only sleeps until the
+    next ARN is due, so the total wait tracks the slowest resource. Raises
+    ResourceFailedError as soon as any resource reaches a failed state and
+    WaiterTimeoutError once the overall deadline passes. Returns a dict of
+    arn -> last describe response.
+    """
+    return _wait(client, resources, SUCCESS_STATES, FAILURE_STATES + (DELETED,), timeout, backoff,
+                 log, sleep, clock)
+
+
+def wait_for_deletion(client, resources, timeout=60*60, backoff=None,
+                      log=print, sleep=time.sleep, clock=time.time):
+    """
+    Waits until every (kind, arn) pair in resources is gone, i.e. its
+    describe call raises ResourceNotFoundException. DELETE FAILED raises
+    ResourceFailedError; every other status, including the CREATE FAILED of
+    a resource deleted after failing, counts as still deleting. Otherwise
+    behaves like wait_for_resources.
+    """
+    return _wait(client, resources, (DELETED,), ('DELETE FAILED',), timeout, backoff, log, sleep, clock)
+
+
+def _wait(client, resources, success_states, failure_states, timeout, backoff, log, sleep, clock):
+    backoff = backoff or Backoff()
+    deadline = clock() + timeout
+    pending = [_Poll(kind, arn) for kind, arn in resources]
+    done = {}
+
+    while pending:
+        now = clock()
+        for poll in [p for p in pending if p.next_poll <= now]:
+            status = poll.describe(client)
+            if log:
+                log("{}: {}".format(poll.label, status))
+            if status in success_states:
+                pending.remove(poll)
+                done[poll.arn] = poll.response
+            elif status in failure_states:
+                raise ResourceFailedError(
+                    "{} {} is {}: {}".format(poll.label, poll.arn, status,
+                                             _failure_reason(poll.response)),
+                    arn=poll.arn, status=status)
+            else:
+                poll.next_poll = clock() + backoff.delay(poll.attempt)
+                poll.attempt += 1
+        if not pending:
+            break
+
+        now = clock()
+        if now >= deadline:
+            stuck = pending[0]
+            raise WaiterTimeoutError(
+                "Timed out waiting for {} {} (last status {})".format(
+                    stuck.label, stuck.arn, stuck.status),
+                arn=stuck.arn, status=stuck.status)
+        sleep(max(0, min(min(p.next_poll for p in pending), deadline) - now))
+
+    return done
+
+
+def wait_for_resource(client, kind, arn, **kwargs):
+    """
+    Waits for a single resource, see wait_for_resources.
+    Returns the last describe response.
+    """
+    return wait_for_resources(client, [(kind, arn)], **kwargs)[arn]
+
+
+def _failure_reason(response):
+    if not response:
+        return 'resource not found'
+    for value in response.values():
+        if isinstance(value, dict) and 'failureReason' in value:
+            return value['failureReason']
+    return 'no failure reason given'
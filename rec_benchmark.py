@@ -0,0 +1,273 @@
+"""
+Offline recommendation quality and latency benchmark.
+
+Replays held-out interactions (the FM notebook's leave-last-out test_df, or
+a leave-last-out split of a MovieLens u.data file) against a recommender
+backend and records precision@K, NDCG@K, catalog coverage, per-request
+latency percentiles and throughput at a given concurrency. Reports are
+plain JSON, and compare_reports flags regressions against a baseline
+report, e.g. between two solution versions:
+
+    python rec_benchmark.py ./ml-100k/u.data --campaign-arn <arn> --report v2.json --baseline v1.json
+
+Backends only need a name and recommend(user, k) returning item ids, so
+the Personalize runtime (or a stub), the FM endpoint and the local FM
+scorer are measured the same way.
+"""
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from fm_split import leave_last_out
+
+
+def precision_at_k(recommended, relevant, k):
+    hits = sum(1 for item in recommended[:k] if item in relevant)
+    return hits / float(k)
+
+
+def ndcg_at_k(recommended, relevant, k):
+    """
+    NDCG@k with binary relevance.
+    """
+    dcg = sum(1.0 / np.log2(rank + 2) for rank, item in enumerate(recommended[:k]) if item in relevant)
+    ideal = sum(1.0 / np.log2(rank + 2) for rank in range(min(len(relevant), k)))
+    return dcg / ideal if ideal else 0.0
+
+
+def holdout_sets(users, items):
+    """
+    OrderedDict of user -> set of held-out items, with ids as strings.
+    """
+    holdout = OrderedDict()
+    for user, item in zip(users, items):
+        holdout.setdefault(str(user), set()).add(str(item))
+    return holdout
+
+
+def movielens_holdout(path='./ml-100k/u.data', n=1, rating_threshold=None):
+    """
+    Leave-last-n-out split of a u.data file by TIMESTAMP. Returns (train
+    frame, holdout dict). With rating_threshold, only interactions rated
+    above it are used (as in the Personalize import).
+    """
+    data = pd.read_csv(path, sep='\t', names=['USER_ID', 'ITEM_ID', 'RATING', 'TIMESTAMP'])
+    if rating_threshold is not None:
+        data = data[data['RATING'] > rating_threshold].reset_index(drop=True)
+    train, test = leave_last_out(data['USER_ID'].values, order=data['TIMESTAMP'].values, n=n, min_train=1)
+    test = data.iloc[test]
+    return data.iloc[train], holdout_sets(test['USER_ID'], test['ITEM_ID'])
+
+
+class PersonalizeBackend(object):
+    """
+    get_recommendations on a campaign. client may be a personalize-runtime
+    client, a stub client or a RecommendationCache.
+    """
+
+    name = 'personalize'
+
+    def __init__(self, client, campaign_arn):
+        self.client = client
+        self.campaign_arn = campaign_arn
+
+    def recommend(self, user, k):
+        response = self.client.get_recommendations(campaignArn=self.campaign_arn, userId=str(user),
+                                                   numResults=k)
+        return [item['itemId'] for item in response['itemList']]
+
+
+class FMScorerBackend(object):
+    """
+    Local ranking with fm_scoring.FMScorer. features gives the side
+    features for a user (e.g. days_since_first) and defaults to none.
+    """
+
+    name = 'fm-local'
+
+    def __init__(self, scorer, features=None):
+        self.scorer = scorer
+        self.features = features
+
+    def recommend(self, user, k):
+        features = self.features(user) if self.features else None
+        return self.scorer.recommend(int(user), k, features=features)[0].tolist()
+
+
+class FMEndpointBackend(object):
+    """
+    Ranks candidate items for a user by scoring them all on the FM
+    endpoint through an fm_inference.BatchPredictor with an encoder.
+    """
+
+    name = 'fm-endpoint'
+
+    def __init__(self, predictor, candidates, features=None):
+        self.predictor = predictor
+        self.candidates = np.asarray(candidates)
+        self.features = features
+
+    def recommend(self, user, k):
+        frame = pd.DataFrame({'user': int(user), 'item': self.candidates})
+        for name, value in (self.features(user) if self.features else {}).items():
+            frame[name] = value
+        for name in self.predictor.encoder.numeric:
+            if name not in frame:
+                frame[name] = 0.0
+        scores = self.predictor.predict(frame)
+        best = np.argsort(-scores, kind='stable')[:k]
+        return self.candidates[best].tolist()
+
+
+class PopularityBackend(object):
+    """
+    Recommends the k most frequent training items to everyone; the
+    baseline any model should beat.
+    """
+
+    name = 'popularity'
+
+    def __init__(self, items):
+        self.ranked = [str(item) for item in pd.Series(items).value_counts().index]
+
+    def recommend(self, user, k):
+        return self.ranked[:k]
+
+
+def _percentiles(latencies):
+    if not latencies:
+        return dict.fromkeys(('p50', 'p95', 'p99', 'mean', 'max'), None)
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99])
+    return {'p50': float(p50), 'p95': float(p95), 'p99': float(p99),
+            'mean': float(np.mean(latencies)), 'max': max(latencies)}
+
+
+def _format(value, spec):
+    return 'n/a' if value is None else format(value, spec)
+
+
+def run_benchmark(backend, holdout, k=10, concurrency=1, catalog_size=None, max_users=None, log=print):
+    """
+    Asks backend for k items for each user in holdout (at most max_users)
+    from concurrency threads and returns the report dict. Coverage is the
+    fraction of catalog_size items recommended to anyone.
+    """
+    users = list(holdout)[:max_users] if max_users else list(holdout)
+    lock = threading.Lock()
+    latencies = []
+    errors = []
+
+    def evaluate(user):
+        start = time.time()
+        try:
+            recommended = [str(item) for item in backend.recommend(user, k)]
+        except Exception as e:
+            with lock:
+                errors.append('{}: {}'.format(user, e))
+            return None
+        with lock:
+            latencies.append((time.time() - start) * 1000)
+        return recommended
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(evaluate, users))
+    elapsed = time.time() - start
+
+    scored = [(recommended, holdout[user]) for user, recommended in zip(users, results) if recommended is not None]
+    recommended_items = set(item for recommended, _ in scored for item in recommended[:k])
+    report = OrderedDict([
+        ('backend', backend.name),
+        ('k', k),
+        ('concurrency', concurrency),
+        ('users', len(users)),
+        ('errors', len(errors)),
+        ('precision_at_k', float(np.mean([precision_at_k(r, rel, k) for r, rel in scored])) if scored else None),
+        ('ndcg_at_k', float(np.mean([ndcg_at_k(r, rel, k) for r, rel in scored])) if scored else None),
+        ('coverage', len(recommended_items) / float(catalog_size) if catalog_size else None),
+        ('distinct_items', len(recommended_items)),
+        ('latency_ms', _percentiles(latencies)),
+        ('throughput_per_sec', len(scored) / elapsed if elapsed else None),
+        ('elapsed_seconds', elapsed),
+        ('timestamp', time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime())),
+    ])
+    if log:
+        log("{}: precision@{} {}, NDCG@{} {}, {} users/s, p95 {} ms, {} errors".format(
+            backend.name, k, _format(report['precision_at_k'], '.4f'), k, _format(report['ndcg_at_k'], '.4f'),
+            _format(report['throughput_per_sec'], '.1f'), _format(report['latency_ms']['p95'], '.1f'),
+            len(errors)))
+        for error in errors[:5]:
+            log("  " + error)
+    return report
+
+
+def write_report(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def load_report(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_reports(baseline, current, max_quality_drop=0.02, max_latency_increase=0.2):
+    """
+    Regressions of current against baseline, as messages: precision,
+    NDCG or coverage down by more than max_quality_drop (absolute), p95
+    latency up or throughput down by more than max_latency_increase
+    (relative), or new errors.
+    """
+    problems = []
+    for metric in ('precision_at_k', 'ndcg_at_k', 'coverage'):
+        before, after = baseline.get(metric), current.get(metric)
+        if before is not None and after is not None and after < before - max_quality_drop:
+            problems.append("{} dropped from {:.4f} to {:.4f}".format(metric, before, after))
+    before, after = baseline['latency_ms'].get('p95'), current['latency_ms'].get('p95')
+    if before and after and after > before * (1 + max_latency_increase):
+        problems.append("p95 latency rose from {:.1f} ms to {:.1f} ms".format(before, after))
+    before, after = baseline.get('throughput_per_sec'), current.get('throughput_per_sec')
+    if before and after is not None and after < before * (1 - max_latency_increase):
+        problems.append("throughput fell from {:.1f}/s to {:.1f}/s".format(before, after))
+    if current.get('errors', 0) > baseline.get('errors', 0):
+        problems.append("errors rose from {} to {}".format(baseline.get('errors', 0), current['errors']))
+    return problems
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark recommendation quality and latency on held-out interactions')
+    parser.add_argument('data', nargs='?', default='./ml-100k/u.data', help='u.data-style interactions')
+    parser.add_argument('--campaign-arn', help='benchmark this Personalize campaign (popularity baseline if omitted)')
+    parser.add_argument('--endpoint-url', help='personalize-runtime endpoint, e.g. a local stub')
+    parser.add_argument('--rating-threshold', type=int, default=3)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--max-users', type=int)
+    parser.add_argument('--report', default='benchmark_report.json')
+    parser.add_argument('--baseline', help='earlier report to check for regressions')
+    args = parser.parse_args()
+
+    train, holdout = movielens_holdout(args.data, rating_threshold=args.rating_threshold)
+    if args.campaign_arn:
+        from aws_clients import get_client
+        backend = PersonalizeBackend(get_client('personalize-runtime', endpoint_url=args.endpoint_url),
+                                     args.campaign_arn)
+    else:
+        backend = PopularityBackend(train['ITEM_ID'])
+    report = run_benchmark(backend, holdout, k=args.k, concurrency=args.concurrency,
+                           catalog_size=train['ITEM_ID'].nunique(), max_users=args.max_users)
+    write_report(report, args.report)
+    print("Report written to {}".format(args.report))
+
+    if args.baseline:
+        problems = compare_reports(load_report(args.baseline), report)
+        for problem in problems:
+            print("REGRESSION: " + problem)
+        sys.exit(1 if problems else 0)
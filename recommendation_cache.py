@@ -0,0 +1,158 @@
+"""
+Client-side cache in front of personalize-runtime get_recommendations.
+
+Responses are cached per (campaign ARN, user ID, item ID, numResults) for ttl
+seconds in a size-bounded LRU. Concurrent misses for the same key share a
+single request, and a user's entries are dropped as soon as an EventSender
+built with on_sent=cache.on_events_sent delivers a click for them, since
+clicks are exactly what changes the recommendations.
+"""
+import json
+import threading
+import time
+from collections import OrderedDict
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.response = None
+        self.error = None
+        self.stale = False
+
+
+class RecommendationCache(object):
+    """
+    Wraps a personalize-runtime client. get_recommendations takes the same
+    keyword arguments as the client and returns the same response dict;
+    cached responses are shared, so treat them as read-only.
+    """
+
+    def __init__(self, client, ttl=60, max_entries=10000, clock=time.time):
+        self.client = client
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.clock = clock
+
+        self._lock = threading.Lock()
+        # key -> (expires_at, response), least recently used first
+        self._entries = OrderedDict()
+        self._keys_by_user = {}
+        self._in_flight = {}
+        self._stats = dict.fromkeys(
+            ('hits', 'misses', 'coalesced', 'expired', 'evicted', 'invalidated'), 0)
+
+    @staticmethod
+    def _key(campaignArn, userId, itemId, numResults, extra):
+        return (campaignArn,
+                None if userId is None else str(userId),
+                None if itemId is None else str(itemId),
+                numResults,
+                json.dumps(extra, sort_keys=True) if extra else None)
+
+    def get_recommendations(self, campaignArn, userId=None, itemId=None, numResults=None, **kwargs):
+        key = self._key(campaignArn, userId, itemId, numResults, kwargs)
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > self.clock():
+                    self._entries.move_to_end(key)
+                    self._stats['hits'] += 1
+                    return entry[1]
+                self._drop(key)
+                self._stats['expired'] += 1
+
+            call = self._in_flight.get(key)
+            if call is not None:
+                self._stats['coalesced'] += 1
+                leader = False
+            else:
+                self._stats['misses'] += 1
+                call = self._in_flight[key] = _Call()
+                leader = True
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.response
+
+        params = dict(kwargs, campaignArn=campaignArn)
+        if userId is not None:
+            params['userId'] = str(userId)
+        if itemId is not None:
+            params['itemId'] = str(itemId)
+        if numResults is not None:
+            params['numResults'] = numResults
+        try:
+            call.response = self.client.get_recommendations(**params)
+        except BaseException as e:
+            # including KeyboardInterrupt, or a None response would be
+            # cached and handed to the followers
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                # Skip storing if the user was invalidated while we were fetching.
+                if call.error is None and not call.stale:
+                    self._store(key, call.response)
+            call.done.set()
+        return call.response
+
+    def _store(self, key, response):
+        self._entries[key] = (self.clock() + self.ttl, response)
+        self._entries.move_to_end(key)
+        self._keys_by_user.setdefault(key[1], set()).add(key)
+        while len(self._entries) > self.max_entries:
+            self._drop(next(iter(self._entries)))
+            self._stats['evicted'] += 1
+
+    def _drop(self, key):
+        del self._entries[key]
+        keys = self._keys_by_user.get(key[1])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_user[key[1]]
+
+    def invalidate_user(self, user_id):
+        """
+        Drops every cached response for user_id, including any request
+        already in flight.
+        """
+        user = str(user_id)
+        with self._lock:
+            for key, call in self._in_flight.items():
+                if key[1] == user:
+                    call.stale = True
+            for key in list(self._keys_by_user.get(user, ())):
+                self._drop(key)
+                self._stats['invalidated'] += 1
+
+    def on_events_sent(self, user_id, session_id, events):
+        """
+        EventSender on_sent callback.
+        """
+        self.invalidate_user(user_id)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._keys_by_user.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        """
+        Counters, current size and hit rate (coalesced lookups count as hits).
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        lookups = stats['hits'] + stats['coalesced'] + stats['misses']
+        stats['hit_rate'] = (stats['hits'] + stats['coalesced']) / lookups if lookups else 0.0
+        return stats
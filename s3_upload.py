@@ -0,0 +1,321 @@
+"""
+Uploads to Amazon S3.
+
+S3Uploader shares one pooled client across threads, uploads several objects
+at once and the parts of large objects concurrently, and skips objects whose
+content hash matches what is already in S3. S3MultipartWriter is a
+write-only file object that streams data of any size into a multipart upload
+without a temporary file, holding only a few parts in memory.
+"""
+import copy
+import hashlib
+import io
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ALL_COMPLETED, FIRST_COMPLETED, wait
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import ClientError
+
+from aws_clients import DEFAULT_MAX_POOL_CONNECTIONS, get_client
+
+# S3 rejects multipart parts smaller than 5 MiB (except the last one).
+MIN_PART_SIZE = 5 * 1024 * 1024
+DEFAULT_PART_SIZE = 8 * 1024 * 1024
+MAX_PART_SIZE = 5 * 1024 * 1024 * 1024
+MAX_PARTS = 10000
+# S3MultipartWriter doubles its part size after every this many parts, so
+# 8 MiB parts reach S3's 5 TB object limit well within MAX_PARTS.
+PARTS_PER_SIZE_STEP = 1000
+HASH_METADATA_KEY = 'sha256'
+
+
+def split_s3_url(url):
+    """
+    's3://bucket/key' -> ('bucket', 'key')
+    """
+    if not url.startswith('s3://'):
+        raise ValueError("Not an s3:// URL: {}".format(url))
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+
+def part_size_for(size, part_size=DEFAULT_PART_SIZE):
+    """
+    Smallest doubling of part_size that fits size bytes in MAX_PARTS parts.
+    """
+    while part_size * MAX_PARTS < size and part_size * 2 <= MAX_PART_SIZE:
+        part_size *= 2
+    return part_size
+
+
+class S3MultipartWriter(object):
+    """
+    File-like writer for s3://bucket/key. Data is uploaded in part_size
+    chunks; close() completes the upload (or does a single put_object if
+    everything fit in one part). Leaving a with block on an exception
+    aborts the upload so no orphaned parts are billed.
+
+    The total size is not known up front, so part_size doubles after every
+    PARTS_PER_SIZE_STEP parts to stay under S3's MAX_PARTS limit; memory
+    held by in-flight parts grows with it.
+    """
+
+    def __init__(self, bucket, key, client=None, part_size=DEFAULT_PART_SIZE, max_workers=4,
+                 **extra_args):
+        if part_size < MIN_PART_SIZE:
+            raise ValueError("part_size must be at least {} bytes".format(MIN_PART_SIZE))
+        self.bucket = bucket
+        self.key = key
+        self.client = client or get_client('s3')
+        self.part_size = part_size
+        self.max_workers = max_workers
+        self.extra_args = extra_args
+        self.bytes_written = 0
+        self.closed = False
+        self._buffer = bytearray()
+        self._upload_id = None
+        self._parts = []
+        self._pending = set()
+        self._pool = None
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("write to closed S3MultipartWriter")
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self._buffer.extend(data)
+        self.bytes_written += len(data)
+        while len(self._buffer) >= self.part_size:
+            part = bytes(self._buffer[:self.part_size])
+            del self._buffer[:self.part_size]
+            self._upload_part(part)
+            sent = len(self._parts) + len(self._pending)
+            if sent % PARTS_PER_SIZE_STEP == 0 and self.part_size * 2 <= MAX_PART_SIZE:
+                self.part_size *= 2
+        return len(data)
+
+    def _upload_part(self, data):
+        if self._upload_id is None:
+            response = self.client.create_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                           **self.extra_args)
+            self._upload_id = response['UploadId']
+            self._pool = ThreadPoolExecutor(max_workers=self.max_workers)
+        # Block while max_workers parts are in flight so memory stays bounded.
+        while len(self._pending) >= self.max_workers:
+            self._collect(FIRST_COMPLETED)
+        number = len(self._parts) + len(self._pending) + 1
+        self._pending.add(self._pool.submit(self._send_part, number, data))
+
+    def _send_part(self, number, data):
+        response = self.client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self._upload_id,
+                                           PartNumber=number, Body=data)
+        return {'PartNumber': number, 'ETag': response['ETag']}
+
+    def _collect(self, return_when):
+        finished, self._pending = wait(self._pending, return_when=return_when)
+        for future in finished:
+            self._parts.append(future.result())
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self._upload_id is None:
+            self.client.put_object(Bucket=self.bucket, Key=self.key, Body=bytes(self._buffer),
+                                   **self.extra_args)
+        else:
+            try:
+                if self._buffer:
+                    self._upload_part(bytes(self._buffer))
+                self._collect(ALL_COMPLETED)
+                self._parts.sort(key=lambda part: part['PartNumber'])
+                self.client.complete_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                      UploadId=self._upload_id,
+                                                      MultipartUpload={'Parts': self._parts})
+            except Exception:
+                self.abort()
+                raise
+            self._pool.shutdown()
+            # a completed upload can no longer be aborted
+            self._upload_id = None
+        self._buffer = bytearray()
+
+    def abort(self):
+        """
+        Discards the upload and any parts sent so far. Safe to call more
+        than once, and a no-op after a successful close().
+        """
+        self.closed = True
+        self._buffer = bytearray()
+        if self._pool is not None:
+            wait(self._pending)
+            self._pending = set()
+            self._pool.shutdown()
+        upload_id, self._upload_id = self._upload_id, None
+        if upload_id is not None:
+            try:
+                self.client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=upload_id)
+            except ClientError as e:
+                if e.response.get('Error', {}).get('Code') != 'NoSuchUpload':
+                    raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+
+def content_hash(source, block_size=DEFAULT_PART_SIZE):
+    """
+    Hex sha256 of a path, bytes or seekable file object (which is rewound).
+    """
+    digest = hashlib.sha256()
+    if isinstance(source, (bytes, bytearray, memoryview)):
+        digest.update(source)
+        return digest.hexdigest()
+    if isinstance(source, str):
+        f = open(source, 'rb')
+    else:
+        f = source
+        start = f.tell()
+    try:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    finally:
+        if isinstance(source, str):
+            f.close()
+        else:
+            f.seek(start)
+    return digest.hexdigest()
+
+
+class S3Uploader(object):
+    """
+    Uploads paths, bytes or file objects using one shared, pooled client.
+
+    Objects above part_size go up as multipart uploads with parts sent
+    concurrently, max_workers objects at a time; each object gets an equal
+    share of the client's connection pool for its parts, and objects too
+    large for MAX_PARTS parts of part_size use larger parts. With
+    skip_unchanged, each object's sha256 is stored in its metadata and an
+    upload is skipped when S3 already has the same content under that key.
+    """
+
+    def __init__(self, client=None, max_workers=8, part_size=DEFAULT_PART_SIZE,
+                 skip_unchanged=True, log=print):
+        self.client = client or get_client(
+            's3', max_pool_connections=max(DEFAULT_MAX_POOL_CONNECTIONS, max_workers * 2))
+        self.max_workers = max_workers
+        self.part_size = part_size
+        self.skip_unchanged = skip_unchanged
+        self.log = log
+        # max_workers uploads at once, each with its own part threads, must
+        # not need more connections than the pool has
+        pool_size = self.client.meta.config.max_pool_connections
+        self.transfer_config = TransferConfig(multipart_threshold=part_size,
+                                              multipart_chunksize=part_size,
+                                              max_concurrency=max(1, pool_size // max_workers))
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self._stats = {'uploaded': 0, 'skipped': 0, 'bytes': 0, 'seconds': 0.0}
+
+    def _remote_hash(self, bucket, key):
+        try:
+            response = self.client.head_object(Bucket=bucket, Key=key)
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return response.get('Metadata', {}).get(HASH_METADATA_KEY)
+
+    def upload(self, source, bucket, key, extra_args=None):
+        """
+        Uploads one path, bytes or seekable file object to s3://bucket/key.
+        Returns True if it was uploaded and False if skipped as unchanged.
+        """
+        extra_args = dict(extra_args or {})
+        if isinstance(source, (bytes, bytearray, memoryview)):
+            source = io.BytesIO(source)
+        size = os.path.getsize(source) if isinstance(source, str) else _remaining(source)
+
+        if self.skip_unchanged:
+            digest = content_hash(source)
+            if self._remote_hash(bucket, key) == digest:
+                with self._lock:
+                    self._stats['skipped'] += 1
+                return False
+            extra_args['Metadata'] = dict(extra_args.get('Metadata', {}), **{HASH_METADATA_KEY: digest})
+
+        config = self.transfer_config
+        chunksize = part_size_for(size, self.part_size)
+        if chunksize != self.part_size:
+            config = copy.copy(config)
+            config.multipart_chunksize = chunksize
+
+        start = time.time()
+        if isinstance(source, str):
+            self.client.upload_file(source, bucket, key, ExtraArgs=extra_args, Config=config)
+        else:
+            self.client.upload_fileobj(source, bucket, key, ExtraArgs=extra_args, Config=config)
+        with self._lock:
+            self._stats['uploaded'] += 1
+            self._stats['bytes'] += size
+            self._stats['seconds'] += time.time() - start
+        return True
+
+    def upload_many(self, uploads):
+        """
+        Uploads (source, bucket, key) tuples concurrently. uploads may be a
+        generator; only a few items are pulled ahead of the uploads, so
+        shards can be produced while earlier ones are still in flight.
+        Returns the stats for this batch.
+        """
+        self.reset_stats()
+        start = time.time()
+        running = set()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for source, bucket, key in uploads:
+                running.add(pool.submit(self.upload, source, bucket, key))
+                if len(running) >= self.max_workers:
+                    finished, running = wait(running, return_when=FIRST_COMPLETED)
+                    for future in finished:
+                        future.result()
+            for future in wait(running)[0]:
+                future.result()
+        stats = self.stats(time.time() - start)
+        if self.log:
+            self.log("Uploaded {uploaded} objects ({mb:.1f} MB, {mb_per_sec:.1f} MB/s), "
+                     "skipped {skipped} unchanged".format(mb=stats['bytes'] / 1e6, **stats))
+        return stats
+
+    def stats(self, elapsed=None):
+        """
+        Counts, bytes and throughput. Without elapsed, throughput is per
+        upload time summed over threads.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+        seconds = elapsed if elapsed is not None else stats['seconds']
+        stats['elapsed'] = seconds
+        stats['mb_per_sec'] = stats['bytes'] / 1e6 / seconds if seconds else 0.0
+        return stats
+
+
+def _remaining(f):
+    position = f.tell()
+    f.seek(0, os.SEEK_END)
+    end = f.tell()
+    f.seek(position)
+    return end - position
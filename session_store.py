@@ -0,0 +1,172 @@
+"""
+Session IDs for event tracking, with inactivity expiry and bounded size.
+
+The second notebook keeps a module-level session_dict that is never pruned.
+SessionStore hands out a session per user, starts a new one after ttl
+seconds of inactivity, evicts the least recently used users when it grows
+past max_sessions or max_bytes, and can persist to SQLite so a restarted
+producer keeps its sessions.
+"""
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+# Rough per-entry cost of the OrderedDict node and the value list.
+_ENTRY_OVERHEAD = 200
+
+
+class SessionStore(object):
+    """
+    Thread-safe user -> session ID map.
+
+    path, if given, is a SQLite file. Changes are written every
+    sync_interval seconds and on sync()/close().
+    """
+
+    def __init__(self, ttl=30*60, max_sessions=100000, max_bytes=None, path=None,
+                 sync_interval=5.0, clock=time.time):
+        self.ttl = ttl
+        self.max_sessions = max_sessions
+        self.max_bytes = max_bytes
+        self.sync_interval = sync_interval
+        self.clock = clock
+
+        self._lock = threading.RLock()
+        # user_id -> [session_id, last_seen], least recently used first
+        self._sessions = OrderedDict()
+        self._bytes = 0
+        self._dirty = set()
+        self._removed = set()
+        self._last_sync = clock()
+        self._stats = dict.fromkeys(('hits', 'misses', 'expired', 'evicted'), 0)
+
+        self._db = None
+        if path:
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("CREATE TABLE IF NOT EXISTS sessions "
+                             "(user_id TEXT PRIMARY KEY, session_id TEXT, last_seen REAL)")
+            self._load()
+
+    def _load(self):
+        cutoff = self.clock() - self.ttl
+        rows = self._db.execute("SELECT user_id, session_id, last_seen FROM sessions "
+                                "WHERE last_seen >= ? ORDER BY last_seen", (cutoff,))
+        for user_id, session_id, last_seen in rows:
+            self._insert(user_id, session_id, last_seen)
+        self._db.execute("DELETE FROM sessions WHERE last_seen < ?", (cutoff,))
+        self._db.commit()
+        self._evict()
+
+    @staticmethod
+    def _size(user_id, session_id):
+        return sys.getsizeof(user_id) + sys.getsizeof(session_id) + _ENTRY_OVERHEAD
+
+    def _insert(self, user_id, session_id, last_seen):
+        self._sessions[user_id] = [session_id, last_seen]
+        self._bytes += self._size(user_id, session_id)
+
+    def _remove(self, user_id):
+        session_id, _ = self._sessions.pop(user_id)
+        self._bytes -= self._size(user_id, session_id)
+        self._dirty.discard(user_id)
+        self._removed.add(user_id)
+
+    def _expire(self, now):
+        # Entries are kept in access order, so expired ones are at the front.
+        while self._sessions:
+            user_id, (_, last_seen) = next(iter(self._sessions.items()))
+            if now - last_seen < self.ttl:
+                break
+            self._remove(user_id)
+            self._stats['expired'] += 1
+
+    def _evict(self):
+        while self._sessions and (len(self._sessions) > self.max_sessions or
+                                  (self.max_bytes and self._bytes > self.max_bytes)):
+            self._remove(next(iter(self._sessions)))
+            self._stats['evicted'] += 1
+
+    def session_id(self, user_id):
+        """
+        Returns the active session for user_id, starting a new one if the
+        user has none or has been inactive for longer than ttl.
+        """
+        user_id = str(user_id)
+        with self._lock:
+            now = self.clock()
+            self._expire(now)
+            entry = self._sessions.get(user_id)
+            if entry is not None:
+                self._stats['hits'] += 1
+                entry[1] = now
+                self._sessions.move_to_end(user_id)
+                session_id = entry[0]
+            else:
+                self._stats['misses'] += 1
+                session_id = str(uuid.uuid4())
+                self._insert(user_id, session_id, now)
+                self._removed.discard(user_id)
+                self._evict()
+            if user_id in self._sessions:
+                self._dirty.add(user_id)
+            if self._db is not None and now - self._last_sync >= self.sync_interval:
+                self.sync()
+            return session_id
+
+    def get(self, user_id):
+        """
+        Returns the active session for user_id without creating or touching it.
+        """
+        with self._lock:
+            entry = self._sessions.get(str(user_id))
+            if entry is None or self.clock() - entry[1] >= self.ttl:
+                return None
+            return entry[0]
+
+    def end(self, user_id):
+        """
+        Ends the user's session so the next event starts a new one.
+        """
+        with self._lock:
+            if str(user_id) in self._sessions:
+                self._remove(str(user_id))
+
+    def sync(self):
+        """
+        Writes pending changes to the SQLite file.
+        """
+        if self._db is None:
+            return
+        with self._lock:
+            rows = [(user_id,) + tuple(self._sessions[user_id]) for user_id in self._dirty]
+            removed = [(user_id,) for user_id in self._removed]
+            self._db.executemany("INSERT OR REPLACE INTO sessions VALUES (?, ?, ?)", rows)
+            self._db.executemany("DELETE FROM sessions WHERE user_id = ?", removed)
+            self._db.commit()
+            self._dirty.clear()
+            self._removed.clear()
+            self._last_sync = self.clock()
+
+    def close(self):
+        if self._db is not None:
+            self.sync()
+            self._db.close()
+            self._db = None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def stats(self):
+        """
+        Hit, miss, expiry and eviction counts plus current size.
+        """
+        with self._lock:
+            stats = dict(self._stats)
+            stats['sessions'] = len(self._sessions)
+            stats['approx_bytes'] = self._bytes
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = stats['hits'] / lookups if lookups else 0.0
+        return stats
@@ -0,0 +1,303 @@
+"""
+Binary cache for BlazingText vectors.txt.
+
+pd.read_csv('vectors.txt', delimiter=' ', skiprows=2, header=None) parses
+the text file on every run and drop() then copies it. load_vector_cache
+parses it once into a directory next to the file (vectors.txt.cache/):
+
+- vectors.npy: the float32 matrix, memory-mapped on later loads
+- norms.npy: row L2 norms, so cosine search needs no normalized copy
+- titles.bin, title_offsets.npy: the titles as one newline-separated
+  UTF-8 blob and where each one starts
+- title_table.npy: an open-addressing hash table (crc32, linear probing)
+  from title to row, so lookups work without building a dict
+- manifest.json: size, mtime and sha256 of the source file
+
+A load whose source size and mtime match the manifest only maps the files.
+If the mtime changed, the source is rehashed and the cache is reused only
+if the sha256 is unchanged; otherwise it is rebuilt.
+"""
+import csv
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import zlib
+
+import numpy as np
+import pandas as pd
+
+CACHE_VERSION = 1
+EMPTY = -1
+
+
+def read_vectors_text(path):
+    """
+    Parses BlazingText/word2vec vectors.txt: a 'count dim' header, the
+    '</s>' row, then one 'title v1 ... vdim' row per title. Returns
+    (titles, float32 matrix).
+    """
+    with open(path) as f:
+        dim = int(f.readline().split()[1])
+    frame = pd.read_csv(path, sep=' ', skiprows=2, header=None, usecols=range(dim + 1),
+                        quoting=csv.QUOTE_NONE, keep_default_na=False,
+                        dtype=dict([(0, object)] + [(i, np.float32) for i in range(1, dim + 1)]))
+    titles = frame[0].values.astype(str)
+    vectors = np.ascontiguousarray(frame.iloc[:, 1:].values, dtype=np.float32)
+    return titles, vectors
+
+
+def _title_hashes(encoded):
+    return np.array([zlib.crc32(title) for title in encoded], dtype=np.uint32).astype(np.int64)
+
+
+class Vocabulary(object):
+    """
+    Title <-> row lookups over the cached blob, offsets and hash table.
+    Indexing by row gives the title; get_indexer/index go the other way.
+    """
+
+    def __init__(self, blob, offsets, table):
+        self.blob = blob
+        self.offsets = offsets
+        self.table = table
+        self._mask = len(table) - 1
+
+    @classmethod
+    def build(cls, titles):
+        encoded = [title.encode('utf-8') for title in titles]
+        blob = np.frombuffer(b''.join(title + b'\n' for title in encoded), dtype=np.uint8)
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(title) + 1 for title in encoded], out=offsets[1:])
+
+        size = 1
+        while size < 2 * len(encoded):
+            size *= 2
+        table = np.full(size, EMPTY, dtype=np.int32)
+        rows = np.arange(len(encoded))
+        slots = _title_hashes(encoded) & (size - 1)
+        # Insert in rounds: each free slot takes its lowest waiting row and
+        # the rest probe the next slot, as row-by-row linear probing would.
+        while len(rows):
+            free = table[slots] == EMPTY
+            candidates, first = np.unique(slots[free], return_index=True)
+            table[candidates] = rows[free][first]
+            placed = np.zeros(len(rows), dtype=bool)
+            placed[np.flatnonzero(free)[first]] = True
+            rows, slots = rows[~placed], (slots[~placed] + 1) & (size - 1)
+        return cls(blob, offsets, table)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def _title_bytes(self, row):
+        return self.blob[self.offsets[row]:self.offsets[row + 1] - 1].tobytes()
+
+    def __getitem__(self, row):
+        return self._title_bytes(row).decode('utf-8')
+
+    def titles(self):
+        """
+        All titles as an array of str.
+        """
+        return np.array(self.blob.tobytes().decode('utf-8').split('\n')[:-1])
+
+    def index(self, title):
+        """
+        Row of title, or -1 if it is not in the vocabulary.
+        """
+        key = title.encode('utf-8')
+        slot = zlib.crc32(key) & self._mask
+        while True:
+            row = self.table[slot]
+            if row == EMPTY:
+                return -1
+            if self._title_bytes(row) == key:
+                return int(row)
+            slot = (slot + 1) & self._mask
+
+    def __contains__(self, title):
+        return self.index(title) >= 0
+
+    def get_indexer(self, titles):
+        return np.array([self.index(title) for title in titles], dtype=np.int64)
+
+    def save(self, directory):
+        self.blob.tofile(os.path.join(directory, 'titles.bin'))
+        np.save(os.path.join(directory, 'title_offsets.npy'), self.offsets)
+        np.save(os.path.join(directory, 'title_table.npy'), self.table)
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        blob_path = os.path.join(directory, 'titles.bin')
+        if os.path.getsize(blob_path) and mmap_mode:
+            blob = np.memmap(blob_path, dtype=np.uint8, mode=mmap_mode)
+        else:
+            blob = np.fromfile(blob_path, dtype=np.uint8)
+        return cls(blob,
+                   np.load(os.path.join(directory, 'title_offsets.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(directory, 'title_table.npy'), mmap_mode=mmap_mode))
+
+
+class VectorCache(object):
+    """
+    vocabulary, vectors and norms of one vectors.txt, as loaded by
+    load_vector_cache.
+    """
+
+    def __init__(self, directory, vocabulary, vectors, norms, manifest):
+        self.directory = directory
+        self.vocabulary = vocabulary
+        self.vectors = vectors
+        self.norms = norms
+        self.manifest = manifest
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def vector(self, title):
+        row = self.vocabulary.index(title)
+        if row < 0:
+            raise KeyError(title)
+        return self.vectors[row]
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            manifest = json.load(f)
+        return cls(directory, Vocabulary.load(directory, mmap_mode),
+                   np.load(os.path.join(directory, 'vectors.npy'), mmap_mode=mmap_mode),
+                   np.load(os.path.join(directory, 'norms.npy'), mmap_mode=mmap_mode),
+                   manifest)
+
+
+def _sha256(path, block_size=8 * 1024 * 1024):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def _source_stat(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime_ns': getattr(stat, 'st_mtime_ns', int(stat.st_mtime * 1e9))}
+
+
+def _read_manifest(directory):
+    try:
+        with open(os.path.join(directory, 'manifest.json')) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        return None
+    return manifest if manifest.get('version') == CACHE_VERSION else None
+
+
+def staging_directory(directory):
+    """
+    A new, empty directory next to directory to write its replacement in.
+    """
+    directory = os.path.abspath(directory)
+    return tempfile.mkdtemp(prefix='.{}.staging-'.format(os.path.basename(directory)),
+                            dir=os.path.dirname(directory))
+
+
+def swap_directory(staging, directory):
+    """
+    Replaces directory with the finished staging directory. The old one is
+    renamed aside (to directory + '.old') before the new one is renamed in
+    and only deleted after, so a crash at any point leaves a complete
+    directory for recover_directory to restore.
+    """
+    directory = os.path.abspath(directory)
+    aside = directory + '.old'
+    if os.path.isdir(aside):
+        shutil.rmtree(aside)
+    if os.path.isdir(directory):
+        os.rename(directory, aside)
+    os.rename(staging, directory)
+    shutil.rmtree(aside, ignore_errors=True)
+
+
+def recover_directory(directory, marker='manifest.json'):
+    """
+    Finishes or rolls back a swap_directory that a crash interrupted. If
+    directory is missing, the newest staging directory that got as far as
+    writing marker (the last file written) is renamed in, or else the old
+    directory that was set aside. A leftover aside directory is removed.
+    """
+    directory = os.path.abspath(directory)
+    aside = directory + '.old'
+    parent = os.path.dirname(directory)
+    if not os.path.isdir(directory) and os.path.isdir(parent):
+        prefix = '.{}.staging-'.format(os.path.basename(directory))
+        staged = [os.path.join(parent, name) for name in os.listdir(parent) if name.startswith(prefix)]
+        staged = [path for path in staged if os.path.exists(os.path.join(path, marker))]
+        if staged:
+            os.rename(max(staged, key=os.path.getmtime), directory)
+        elif os.path.isdir(aside):
+            os.rename(aside, directory)
+    if os.path.isdir(directory) and os.path.isdir(aside):
+        shutil.rmtree(aside, ignore_errors=True)
+
+
+def build_vector_cache(path, directory=None, digest=None):
+    """
+    Parses path and (re)writes its cache directory. The files are written
+    to a temporary directory first and swapped in (see swap_directory), so
+    readers never see a half-written cache.
+    """
+    directory = directory or path + '.cache'
+    titles, vectors = read_vectors_text(path)
+    manifest = dict(_source_stat(path), version=CACHE_VERSION, sha256=digest or _sha256(path),
+                    rows=int(vectors.shape[0]), dim=int(vectors.shape[1]))
+
+    staging = staging_directory(directory)
+    try:
+        np.save(os.path.join(staging, 'vectors.npy'), vectors)
+        np.save(os.path.join(staging, 'norms.npy'), np.linalg.norm(vectors, axis=1).astype(np.float32))
+        Vocabulary.build(titles).save(staging)
+        with open(os.path.join(staging, 'manifest.json'), 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        swap_directory(staging, directory)
+    except Exception:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+    return directory
+
+
+def load_vector_cache(path, directory=None, mmap_mode='r', log=None):
+    """
+    VectorCache for vectors.txt at path, building or refreshing the cache
+    directory (default path + '.cache') when needed.
+    """
+    directory = directory or path + '.cache'
+    recover_directory(directory)
+    manifest = _read_manifest(directory)
+    stat = _source_stat(path)
+    if manifest is None:
+        reason = 'no cache'
+        digest = None
+    elif all(manifest[name] == stat[name] for name in stat):
+        return VectorCache.load(directory, mmap_mode)
+    else:
+        digest = _sha256(path)
+        if digest == manifest['sha256']:
+            manifest.update(stat)
+            with open(os.path.join(directory, 'manifest.json'), 'w') as f:
+                json.dump(manifest, f, indent=2, sort_keys=True)
+            return VectorCache.load(directory, mmap_mode)
+        reason = 'source changed'
+    if log:
+        log("Building vector cache for {} ({})".format(path, reason))
+    build_vector_cache(path, directory, digest)
+    return VectorCache.load(directory, mmap_mode)
+
+
+def load_vectors(path, mmap_mode='r'):
+    """
+    (vocabulary, vectors) for vectors.txt through the cache.
+    """
+    cache = load_vector_cache(path, mmap_mode=mmap_mode)
+    return cache.vocabulary, cache.vectors
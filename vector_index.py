@@ -0,0 +1,272 @@
+"""
+Similarity search over BlazingText product vectors.
+
+The notebook compares titles by looping over DataFrame columns or by
+sending words to the BlazingText endpoint. Here the trained vectors are
+memory-mapped as a contiguous float32 matrix from the vector_cache
+directory, and cosine similarity is a dot product divided by the cached row
+norms:
+
+- ExactIndex answers top-K queries with batched matrix products.
+- IVFIndex clusters the vectors with spherical k-means and scans only the
+  nprobe lists closest to each query, trading a little recall for speed on
+  large catalogs.
+
+SimilarProducts serves "more like this" by title and picks the index by
+catalog size. Run this module for a recall vs latency benchmark:
+
+    python vector_index.py vectors.txt
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import csr_matrix
+
+from vector_cache import Vocabulary, load_vector_cache, load_vectors
+
+# Catalogs up to this size are searched exactly by SimilarProducts.
+EXACT_MAX_ITEMS = 50000
+QUERY_BLOCK = 256
+
+
+def row_norms(vectors):
+    """
+    L2 norm of every row, with 1 for zero rows so they can be divided by.
+    """
+    norms = np.linalg.norm(np.asarray(vectors, dtype=np.float32), axis=1)
+    norms[norms == 0] = 1.0
+    return norms
+
+
+def normalize(vectors, norms=None):
+    """
+    Rows scaled to unit L2 norm as a new float32 array; zero rows stay zero.
+    """
+    norms = row_norms(vectors) if norms is None else np.where(norms == 0, 1.0, norms)
+    return (np.asarray(vectors, dtype=np.float32) / norms[:, None]).astype(np.float32)
+
+
+def _top_k_rows(scores, k):
+    # top k columns of every row, best first
+    k = min(k, scores.shape[1])
+    best = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+    best_scores = np.take_along_axis(scores, best, axis=1)
+    order = np.argsort(-best_scores, axis=1, kind='stable')
+    return np.take_along_axis(best, order, axis=1), np.take_along_axis(best_scores, order, axis=1)
+
+
+class ExactIndex(object):
+    """
+    Brute-force cosine search. vectors must be normalized unless their
+    row norms are passed, in which case they are searched in place
+    (e.g. memory-mapped) and scores are divided by the norms.
+    """
+
+    def __init__(self, vectors, norms=None):
+        self.vectors = vectors
+        self.inverse_norms = None
+        if norms is not None:
+            self.inverse_norms = (1.0 / np.where(norms == 0, 1.0, norms)).astype(np.float32)
+
+    def __len__(self):
+        return len(self.vectors)
+
+    def search(self, queries, k=10):
+        """
+        (ids, similarities), each (len(queries), k), best first. queries
+        must be normalized.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        ids = np.empty((len(queries), min(k, len(self))), dtype=np.int64)
+        sims = np.empty(ids.shape, dtype=np.float32)
+        for lo in range(0, len(queries), QUERY_BLOCK):
+            scores = queries[lo:lo + QUERY_BLOCK].dot(self.vectors.T)
+            if self.inverse_norms is not None:
+                scores *= self.inverse_norms
+            ids[lo:lo + QUERY_BLOCK], sims[lo:lo + QUERY_BLOCK] = _top_k_rows(scores, k)
+        return ids, sims
+
+
+def _nearest(vectors, centroids, block=16384):
+    return np.concatenate([vectors[lo:lo + block].dot(centroids.T).argmax(axis=1)
+                           for lo in range(0, len(vectors), block)])
+
+
+def spherical_kmeans(vectors, clusters, iterations=10, sample=100000, seed=0):
+    """
+    Unit-norm centroids of normalized vectors, trained on a random sample
+    of at most sample rows. Returns fewer than clusters centroids when the
+    sample has fewer rows.
+    """
+    rng = np.random.RandomState(seed)
+    if len(vectors) > sample:
+        vectors = vectors[np.sort(rng.choice(len(vectors), sample, replace=False))]
+    clusters = min(clusters, len(vectors))
+    centroids = np.array(vectors[rng.choice(len(vectors), clusters, replace=False)])
+    for _ in range(iterations):
+        assignment = _nearest(vectors, centroids)
+        members = csr_matrix((np.ones(len(vectors), dtype=np.float32), (assignment, np.arange(len(vectors)))),
+                             shape=(clusters, len(vectors)))
+        sums = np.asarray(members.dot(vectors))
+        empty = np.bincount(assignment, minlength=clusters) == 0
+        # reseed empty clusters with random points
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = normalize(sums)
+    return centroids
+
+
+class IVFIndex(object):
+    """
+    Inverted-file index: vectors are grouped by their nearest of nlist
+    centroids (default about 4 * sqrt(n)) and stored contiguously per list.
+    A query scans the nprobe lists whose centroids are most similar.
+    vectors must already be normalized.
+    """
+
+    def __init__(self, vectors, nlist=None, nprobe=8, iterations=10, seed=0):
+        nlist = nlist or max(1, min(len(vectors), int(4 * np.sqrt(len(vectors)))))
+        self.nprobe = nprobe
+        self.centroids = spherical_kmeans(vectors, nlist, iterations, seed=seed)
+        nlist = len(self.centroids)
+        assignment = _nearest(vectors, self.centroids)
+        self.ids = np.argsort(assignment, kind='stable')
+        self.vectors = np.ascontiguousarray(vectors[self.ids])
+        self.offsets = np.zeros(nlist + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assignment, minlength=nlist), out=self.offsets[1:])
+
+    def __len__(self):
+        return len(self.ids)
+
+    def search(self, queries, k=10, nprobe=None):
+        """
+        (ids, similarities) like ExactIndex.search; rows with fewer than k
+        candidates are padded with id -1 and similarity -inf.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        nprobe = min(nprobe or self.nprobe, len(self.centroids))
+        probes = ExactIndex(self.centroids).search(queries, nprobe)[0]
+        ids = np.full((len(queries), k), -1, dtype=np.int64)
+        sims = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        for i, (query, lists) in enumerate(zip(queries, probes)):
+            rows = np.concatenate([np.arange(self.offsets[l], self.offsets[l + 1]) for l in lists])
+            if not len(rows):
+                continue
+            best, best_sims = _top_k_rows(self.vectors[rows].dot(query)[None, :], k)
+            ids[i, :best.shape[1]] = self.ids[rows[best[0]]]
+            sims[i, :best.shape[1]] = best_sims[0]
+        return ids, sims
+
+
+class SimilarProducts(object):
+    """
+    "More like this" over product vectors. titles may be a Vocabulary or
+    a sequence of titles. index='auto' uses ExactIndex up to
+    EXACT_MAX_ITEMS titles, which searches vectors in place, and IVFIndex
+    (with ivf_kwargs, over a normalized copy) above.
+    """
+
+    def __init__(self, titles, vectors, index='auto', norms=None, **ivf_kwargs):
+        self.lookup = titles if isinstance(titles, Vocabulary) else pd.Index(np.asarray(titles))
+        self.vectors = vectors
+        self.norms = row_norms(vectors) if norms is None else norms
+        if index == 'auto':
+            index = 'exact' if len(vectors) <= EXACT_MAX_ITEMS else 'ivf'
+        if index == 'exact':
+            self.index = ExactIndex(vectors, self.norms)
+        else:
+            self.index = IVFIndex(normalize(vectors, self.norms), **ivf_kwargs)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """
+        Loads vectors.txt through vector_cache; after the first run this
+        only memory-maps the cached files.
+        """
+        cache = load_vector_cache(path)
+        return cls(cache.vocabulary, cache.vectors, norms=cache.norms, **kwargs)
+
+    def similar(self, titles, k=10):
+        """
+        DataFrame of the k most similar titles to each of titles (excluding
+        the title itself) with columns title, similar_title, similarity.
+        """
+        titles = [titles] if isinstance(titles, str) else list(titles)
+        positions = self.lookup.get_indexer(titles)
+        if (positions < 0).any():
+            raise KeyError("Unknown titles: {}".format(np.asarray(titles)[positions < 0].tolist()))
+        ids, sims = self.index.search(normalize(self.vectors[positions], self.norms[positions]), k + 1)
+        keep = (ids != positions[:, None]) & (ids >= 0)
+        rows = [(title, self.lookup[i], s) for title, row_ids, row_sims, row_keep in zip(titles, ids, sims, keep)
+                for i, s in list(zip(row_ids[row_keep], row_sims[row_keep]))[:k]]
+        return pd.DataFrame(rows, columns=['title', 'similar_title', 'similarity'])
+
+
+def recall_at_k(found, expected):
+    """
+    Mean fraction of each row of expected ids that appears in found.
+    """
+    return np.mean([len(np.intersect1d(f, e)) / float(len(e)) for f, e in zip(found, expected)])
+
+
+def benchmark(vectors, k=10, queries=1000, nprobes=(1, 2, 4, 8, 16, 32), nlist=None, seed=0):
+    """
+    Recall@k against exact search and per-query latency (ms) for
+    IVFIndex at each nprobe, with the exact index as the first row.
+    """
+    vectors = normalize(vectors)
+    rng = np.random.RandomState(seed)
+    sample = vectors[rng.choice(len(vectors), min(queries, len(vectors)), replace=False)]
+
+    def timed(search):
+        latencies = []
+        found = []
+        for query in sample:
+            start = time.time()
+            found.append(search(query)[0][0])
+            latencies.append((time.time() - start) * 1000)
+        return found, np.percentile(latencies, [50, 95, 99])
+
+    exact, latency = timed(lambda q: ExactIndex(vectors).search(q, k))
+    batch_start = time.time()
+    ExactIndex(vectors).search(sample, k)
+    batched = (time.time() - batch_start) * 1000 / len(sample)
+    results = [{'index': 'exact', 'nprobe': None, 'recall': 1.0, 'p50_ms': latency[0],
+                'p95_ms': latency[1], 'p99_ms': latency[2], 'batched_ms': batched}]
+
+    build_start = time.time()
+    ivf = IVFIndex(vectors, nlist=nlist, seed=seed)
+    build = time.time() - build_start
+    for nprobe in nprobes:
+        found, latency = timed(lambda q: ivf.search(q, k, nprobe=nprobe))
+        results.append({'index': 'ivf', 'nprobe': nprobe, 'recall': recall_at_k(found, exact),
+                        'p50_ms': latency[0], 'p95_ms': latency[1], 'p99_ms': latency[2],
+                        'build_seconds': build})
+    return results
+
+
+def _synthetic_vectors(n, dim, clusters=200, seed=0):
+    rng = np.random.RandomState(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    return centers[rng.randint(0, clusters, n)] + 0.6 * rng.normal(size=(n, dim)).astype(np.float32)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Recall vs latency of exact and IVF search over product vectors')
+    parser.add_argument('vectors', nargs='?', help='vectors.txt; synthetic vectors are used if omitted')
+    parser.add_argument('--items', type=int, default=200000, help='number of synthetic vectors')
+    parser.add_argument('--dim', type=int, default=100)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--nlist', type=int)
+    args = parser.parse_args()
+
+    vectors = load_vectors(args.vectors)[1] if args.vectors else _synthetic_vectors(args.items, args.dim)
+    print("{} vectors, {} dims".format(*vectors.shape))
+    print("{:>6} {:>7} {:>7} {:>9} {:>9} {:>9}".format('index', 'nprobe', 'recall', 'p50 ms', 'p95 ms', 'p99 ms'))
+    results = benchmark(vectors, args.k, args.queries, nlist=args.nlist)
+    for row in results:
+        print("{index:>6} {nprobe!s:>7} {recall:7.3f} {p50_ms:9.2f} {p95_ms:9.2f} {p99_ms:9.2f}".format(**row))
+    print("exact search batched over all queries: {:.2f} ms/query; IVF build {:.1f}s".format(
+        results[0]['batched_ms'], results[1]['build_seconds']))